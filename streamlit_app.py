@@ -1,40 +1,45 @@
 import streamlit as st
-import io, zipfile, re, csv, os, time, requests, base64, hashlib, json, tempfile, shutil
+import io, zipfile, re, csv, os, time, requests, base64, hashlib, json, tempfile, shutil, functools, threading, sqlite3, random, itertools, socket
 from urllib.parse import urlencode
 import xml.etree.ElementTree as ET
 import pandas as pd
-from typing import Optional, List, Dict, Any, Tuple
+from typing import Optional, List, Dict, Any, Tuple, Iterable, Iterator
 from io import BytesIO, StringIO
 from datetime import datetime
-from pyzbar import pyzbar
 from PIL import Image
 import numpy as np
 import tempfile
-
-# Configuração da página
-st.set_page_config(layout="wide", page_title="Ferramentas Inobest — O365 + OrangeHRM")
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+try:
+    import fcntl
+except ImportError:  # Windows: sem lock de ficheiro entre processos
+    fcntl = None
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except Exception:  # Streamlit antigo
+    add_script_run_ctx = get_script_run_ctx = None
 
 import zipfile, tempfile, numpy as np, cv2
 from PIL import Image
-from pyzbar import pyzbar
 
 # ---------- Utils QR ----------
 
 def converter_pdf_para_imagens(caminho_pdf, dpi=300):
-    """Converte PDF em imagens PIL usando PyMuPDF (fitz)."""
+    """Converte PDF em imagens PIL usando PyMuPDF (fitz); os erros propagam (correm numa tarefa, sem UI)."""
+    import fitz  # PyMuPDF
+    doc = fitz.open(caminho_pdf)
     try:
-        import fitz  # PyMuPDF
-        doc = fitz.open(caminho_pdf)
         imagens = []
         for pagina in doc:
             pix = pagina.get_pixmap(dpi=dpi)
             img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
             imagens.append(img)
-        doc.close()
         return imagens
-    except Exception as e:
-        st.error(f"Erro a converter PDF: {e}")
-        return []
+    finally:
+        doc.close()
 
 def _enhance_for_qr(img_bgr: np.ndarray) -> np.ndarray:
     """Leve limpeza para melhorar leitura do QR."""
@@ -57,6 +62,7 @@ def _rotate_image(img_bgr: np.ndarray, angle: int) -> np.ndarray:
     return img_bgr
 
 def _decode_qr_from_bgr(img_bgr: np.ndarray):
+    from pyzbar import pyzbar  # precisa da libzbar; importado só quando o Extrator QR lê um ficheiro
     # Tenta melhoria + rotações
     candidates = [img_bgr, _enhance_for_qr(img_bgr)]
     for base in candidates:
@@ -117,39 +123,38 @@ def _parse_qr_at(qr_text: str) -> dict:
     return out
 
 def extrair_qr_fatura(caminho_ficheiro: str) -> Optional[Dict[str, Any]]:
-    """Extrai primeiro QR encontrado do ficheiro (imagem/PDF) e devolve dict de campos normalizados."""
-    try:
-        ext = os.path.splitext(caminho_ficheiro)[1].lower()
-        qr_codes = []
-        if ext == ".pdf":
-            imagens = converter_pdf_para_imagens(caminho_ficheiro)
-            for img in imagens:
-                qr_codes = extrair_qr_de_imagem(img)
-                if qr_codes:
-                    break
-        else:
-            qr_codes = extrair_qr_de_imagem(caminho_ficheiro)
-
-        if not qr_codes:
-            return None
+    """
+    Extrai primeiro QR encontrado do ficheiro (imagem/PDF) e devolve dict de campos normalizados;
+    None se não houver QR. Erros de leitura (ex.: PDF inválido) propagam para quem chama.
+    """
+    ext = os.path.splitext(caminho_ficheiro)[1].lower()
+    qr_codes = []
+    if ext == ".pdf":
+        imagens = converter_pdf_para_imagens(caminho_ficheiro)
+        for img in imagens:
+            qr_codes = extrair_qr_de_imagem(img)
+            if qr_codes:
+                break
+    else:
+        qr_codes = extrair_qr_de_imagem(caminho_ficheiro)
 
-        qr_data = qr_codes[0].data.decode("utf-8", errors="replace")
-        parsed = _parse_qr_at(qr_data)
-        return {
-            "Ficheiro": os.path.basename(caminho_ficheiro),
-            "Status": "Sucesso",
-            **parsed,
-        }
-    except Exception:
+    if not qr_codes:
         return None
 
-def processar_zip(uploaded_file):
-    """Processa ZIP com faturas (PDF/JPG/PNG) e devolve lista de dicts."""
-    with tempfile.TemporaryDirectory() as pasta_temp:
-        zip_path = os.path.join(pasta_temp, "upload.zip")
-        with open(zip_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+    qr_data = qr_codes[0].data.decode("utf-8", errors="replace")
+    parsed = _parse_qr_at(qr_data)
+    return {
+        "Ficheiro": os.path.basename(caminho_ficheiro),
+        "Status": "Sucesso",
+        **parsed,
+    }
 
+def processar_zip(zip_path: str, report=None):
+    """
+    Processa ZIP com faturas (PDF/JPG/PNG) e devolve lista de dicts.
+    `report(fração, mensagem)` é chamado antes de cada ficheiro (progresso/cancelamento da tarefa).
+    """
+    with tempfile.TemporaryDirectory() as pasta_temp:
         pasta_extraida = os.path.join(pasta_temp, "extraido")
         with zipfile.ZipFile(zip_path, "r") as zip_ref:
             zip_ref.extractall(pasta_extraida)
@@ -165,27 +170,54 @@ def processar_zip(uploaded_file):
         if not ficheiros:
             return resultados
 
-        progress = st.progress(0)
-        info = st.empty()
         total = len(ficheiros)
         for i, caminho in enumerate(ficheiros, 1):
-            info.text(f"A processar: {os.path.basename(caminho)} ({i}/{total})")
-            data = extrair_qr_fatura(caminho)
+            if report is not None:
+                report((i - 1) / total, f"A processar: {os.path.basename(caminho)} ({i}/{total})")
+            status = "QR code não encontrado"
+            try:
+                data = extrair_qr_fatura(caminho)
+            except Exception as e:  # fica no Status do ficheiro (a tarefa não tem UI)
+                data, status = None, f"Erro: {e}"
             if data:
                 resultados.append(data)
             else:
                 resultados.append({
                     "Ficheiro": os.path.basename(caminho),
-                    "Status": "QR code não encontrado",
+                    "Status": status,
                     "NIF_Emitente": "", "NIF_Adquirente": "", "Pais": "",
                     "Tipo_Documento": "", "Estado": "", "Data": "",
                     "Numero_Fatura": "", "ATCUD": "", "Espaco_Fiscal": "",
                     "Base_Tributavel": "", "Total_IVA": "", "Total_com_IVA": "",
                 })
-            progress.progress(i/total)
-        info.empty(); progress.empty()
         return resultados
 
+def _qr_job(job) -> Dict[str, Any]:
+    """Tarefa em segundo plano: lê os QR das faturas do ZIP e grava faturas.csv."""
+    resultados = processar_zip(job.path("input.zip"), job.report)
+    if not resultados:
+        raise ValueError("Nenhuma fatura foi processada. Verifique o conteúdo do ZIP.")
+    df = pd.DataFrame(resultados)
+    df.to_csv(job.path("faturas.csv"), index=False, encoding="utf-8-sig")
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return {"output": {"name": "faturas.csv", "file_name": f"faturas_{ts}.csv", "mime": "text/csv",
+                       "label": "📥 Descarregar CSV"}}
+
+def _render_qr_job(job):
+    df = job.load("faturas.csv", lambda path: pd.read_csv(path, dtype=str, keep_default_na=False, encoding="utf-8-sig"))
+    sucesso = (df["Status"] == "Sucesso").sum()
+    falhas = len(df) - sucesso
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Total", len(df))
+    c2.metric("Sucesso", sucesso)
+    c3.metric("Falhas", falhas)
+    st.subheader("📊 Preview")
+    st.dataframe(df, use_container_width=True)
+    _job_download_button(job, key="qr_download")
+    if falhas:
+        with st.expander(f"⚠️ Ver {falhas} fatura(s) sem QR ou com erro"):
+            st.dataframe(df[df["Status"] != "Sucesso"][["Ficheiro", "Status"]], use_container_width=True)
+
 # ---------- UI da Tab ----------
 def tab_extrator_qr():
     st.header("📄 Extrator de Faturas (QR)")
@@ -198,29 +230,14 @@ def tab_extrator_qr():
     uploaded_file = st.file_uploader("📦 Escolha um ficheiro ZIP com faturas (PDF/JPG/PNG)", type=["zip"])
     if not uploaded_file:
         st.info("Aguardo o seu ZIP...")
-        return
-    st.info(f"Ficheiro: {uploaded_file.name} ({uploaded_file.size/1024:.0f} KB)")
-    if st.button("🚀 Processar Faturas", type="primary"):
-        with st.spinner("A processar faturas..."):
-            resultados = processar_zip(uploaded_file)
-            if not resultados:
-                st.error("Nenhuma fatura foi processada. Verifique o conteúdo do ZIP.")
-                return
-            df = pd.DataFrame(resultados)
-            sucesso = (df["Status"] == "Sucesso").sum()
-            falhas = len(df) - sucesso
-            c1, c2, c3 = st.columns(3)
-            c1.metric("Total", len(df))
-            c2.metric("Sucesso", sucesso)
-            c3.metric("Falhas", falhas)
-            st.subheader("📊 Preview")
-            st.dataframe(df, use_container_width=True)
-            csv = df.to_csv(index=False, encoding="utf-8-sig")
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            st.download_button("📥 Descarregar CSV", data=csv, file_name=f"faturas_{ts}.csv", mime="text/csv", type="primary")
-            if falhas:
-                with st.expander(f"⚠️ Ver {falhas} fatura(s) sem QR"):
-                    st.dataframe(df[df["Status"] != "Sucesso"][["Ficheiro", "Status"]], use_container_width=True)
+    else:
+        st.info(f"Ficheiro: {uploaded_file.name} ({uploaded_file.size/1024:.0f} KB)")
+        if st.button("🚀 Processar Faturas", type="primary"):
+            data = uploaded_file.getvalue()
+            _submit_tool_job("qr", uploaded_file.name, hashlib.sha1(data).hexdigest(), _qr_job, {"input.zip": data})
+    job = _tool_job("qr")
+    if job is not None:
+        _render_tool_job(job, _render_qr_job)
 
 # =============================
 # O365 AUTH (Global App Login)
@@ -390,13 +407,6 @@ def _is_admin_o365() -> bool:
     email = st.session_state.get("o365_auth", {}).get("email", "").lower()
     return email in [a.lower() for a in admins]
 
-# Enforce global login
-if not ensure_o365_login():
-    st.stop()
-
-# Header with logout
-o365_logout_button()
-
 # ========================================
 # Admin-only password gate for OAuth tab
 # ========================================
@@ -412,26 +422,37 @@ def _get_oauth_admin_password() -> str:
         pwd = os.environ.get("OAUTH_ADMIN_PASSWORD")
     return pwd or ""
 
-def _read_shared_refresh_token(path: str, fallback: str) -> str:
+def _read_shared_token_state(path: str) -> Dict[str, Any]:
+    """Conteúdo do ficheiro partilhado de tokens ({} se não existir ou for inválido)."""
     try:
         if path and os.path.exists(path):
             with open(path, "r", encoding="utf-8") as f:
                 data = json.load(f)
-            rt = (data or {}).get("refresh_token", "")
-            if rt and isinstance(rt, str):
-                return rt.strip()
+            if isinstance(data, dict):
+                return data
     except Exception:
         pass
+    return {}
+
+def _read_shared_refresh_token(path: str, fallback: str) -> str:
+    rt = _read_shared_token_state(path).get("refresh_token", "")
+    if rt and isinstance(rt, str):
+        return rt.strip()
     return (fallback or "").strip()
 
-def _write_shared_refresh_token(path: str, refresh_token: str) -> None:
+def _write_shared_refresh_token(path: str, refresh_token: str, access_token: str = "", expires_at: float = 0.0) -> None:
     if not path or not refresh_token:
         return
     try:
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        tmp = f"{path}.tmp-{int(time.time()*1000)}"
+        tmp = f"{path}.tmp-{os.getpid()}-{int(time.time()*1000)}"
+        data: Dict[str, Any] = {"refresh_token": refresh_token}
+        if access_token:
+            # Outros processos reutilizam o access token em vez de o renovarem de novo
+            data["access_token"] = access_token
+            data["expires_at"] = expires_at
         with open(tmp, "w", encoding="utf-8") as f:
-            json.dump({"refresh_token": refresh_token}, f)
+            json.dump(data, f)
         os.replace(tmp, path)  # atomic on same filesystem
     except Exception:
         pass
@@ -483,83 +504,521 @@ def _ensure_oauth_admin() -> str:
     return "needs-auth"
 
 # ========================================
-# Excel Aggregator (ZIP of Excel -> single CSV in ZIP)
+# Tarefas em segundo plano (conversões longas: QR, Excel, SAF-T)
 # ========================================
 
-def excel_aggregator_app():
-    st.header("Agregador de Ficheiros Excel (via ZIP)")
-    st.write("Carregue um ficheiro ZIP contendo os seus ficheiros Excel (.xls ou .xlsx) para agregá-los num único ficheiro CSV, depois comprimido num novo ZIP.")
+_JOB_FINISHED = ("done", "error", "cancelled")
+_JOB_STATUS_LABELS = {
+    "queued": "Em fila", "running": "A correr", "done": "Concluída", "error": "Falhou", "cancelled": "Cancelada",
+}
 
-    # session state init
-    if 'excel_processed_data_zip' not in st.session_state:
-        st.session_state.excel_processed_data_zip = None
-    if 'excel_processed_data_csv_preview' not in st.session_state:
-        st.session_state.excel_processed_data_csv_preview = None
-    if 'excel_processing_done' not in st.session_state:
-        st.session_state.excel_processing_done = False
-    if 'excel_arquivos_com_erro_state' not in st.session_state:
-        st.session_state.excel_arquivos_com_erro_state = []
-    if 'excel_last_uploaded_file_id' not in st.session_state:
-        st.session_state.excel_last_uploaded_file_id = None
+class _JobCancelled(Exception):
+    """Levantada dentro da tarefa (em job.report) depois de o utilizador a cancelar."""
 
-    uploaded_zip_file = st.file_uploader(
-        "Arraste e largue o seu ficheiro ZIP aqui ou clique para procurar",
-        type=["zip"],
-        accept_multiple_files=False,
-        key="zip_uploader_excel"
-    )
+@st.cache_resource(show_spinner=False)
+def _process_token() -> str:
+    """Identifica este processo nas tarefas gravadas (o pid repete-se entre reinícios de um contentor)."""
+    return os.urandom(8).hex()
 
-    # Detect new upload to reset state
-    if uploaded_zip_file is not None:
+def _process_alive(pid: int) -> bool:
+    if os.name == "nt":
+        return True  # sem os.kill(pid, 0); na dúvida a tarefa não é dada como interrompida
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+class _Job:
+    """
+    Uma conversão submetida por um utilizador. Estado, progresso e ficheiros (entrada e
+    resultado) ficam na pasta da tarefa, com o estado em job.json, para sobreviverem a
+    reruns, separadores fechados e reinícios do processo.
+    """
+    def __init__(self, workdir: str, state: Dict[str, Any]):
+        self.workdir = workdir
+        self.id = state["id"]
+        self.kind = state["kind"]
+        self.owner = state["owner"]
+        self.title = state.get("title", "")
+        self.key = state.get("key", "")
+        self.inputs: List[str] = state.get("inputs") or []
+        self.status = state.get("status", "queued")
+        self.progress = float(state.get("progress", 0.0))
+        self.message = state.get("message", "")
+        self.error = state.get("error", "")
+        self.meta: Dict[str, Any] = state.get("meta") or {}
+        self.created_at = float(state.get("createdAt", time.time()))
+        self.started_at = float(state.get("startedAt", 0.0))
+        self.finished_at = float(state.get("finishedAt", 0.0))
+        self.pid = int(state.get("pid") or 0)
+        self.host = state.get("host", "")
+        self.token = state.get("token", "")
+        self.heartbeat_at = float(state.get("heartbeatAt", 0.0))
+        self._cancel = threading.Event()
+        self._save_lock = threading.Lock()
+        self._saved_at = 0.0
+        self._loaded: Dict[str, Any] = {}
+
+    @property
+    def finished(self) -> bool:
+        return self.status in _JOB_FINISHED
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self):
+        """Pede o cancelamento; o marcador `cancel` chega também a uma tarefa de outro processo."""
+        self._cancel.set()
         try:
-            current_file_id = getattr(uploaded_zip_file, 'file_id', None) or f"{uploaded_zip_file.name}:{uploaded_zip_file.size}"
+            open(self.path("cancel"), "w").close()
+        except OSError:
+            pass
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.workdir, name)
+
+    def report(self, progress: float, message: str = ""):
+        """Chamado pela tarefa: atualiza o progresso (gravado no máximo a cada 0,5 s) e interrompe-a se foi cancelada."""
+        if self._cancel.is_set():
+            raise _JobCancelled()
+        self.progress = min(max(float(progress), 0.0), 1.0)
+        self.message = message
+        if time.time() - self._saved_at >= 0.5:
+            if os.path.exists(self.path("cancel")):
+                self._cancel.set()
+                raise _JobCancelled()
+            self.save()
+
+    def load(self, name: str, reader) -> Any:
+        """Resultado gravado pela tarefa (lido com `reader(path)`), lido do disco uma vez por processo."""
+        if name not in self._loaded:
+            self._loaded[name] = reader(self.path(name))
+        return self._loaded[name]
+
+    def reload(self) -> bool:
+        """Relê o estado de uma tarefa de outro processo; False se a pasta já não existe."""
+        try:
+            with open(self.path("job.json"), encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
         except Exception:
-            current_file_id = uploaded_zip_file.name
-        if current_file_id != st.session_state.excel_last_uploaded_file_id:
-            st.session_state.excel_last_uploaded_file_id = current_file_id
-            st.session_state.excel_processing_done = False
-            st.session_state.excel_processed_data_zip = None
-            st.session_state.excel_processed_data_csv_preview = None
-            st.session_state.excel_arquivos_com_erro_state = []
-            _safe_rerun()
-    elif st.session_state.excel_last_uploaded_file_id is not None:
-        st.session_state.excel_last_uploaded_file_id = None
-        st.session_state.excel_processing_done = False
-        st.session_state.excel_processed_data_zip = None
-        st.session_state.excel_processed_data_csv_preview = None
-        st.session_state.excel_arquivos_com_erro_state = []
-        _safe_rerun()
+            return True  # a meio de uma escrita; fica o estado anterior
+        self.status = state.get("status", self.status)
+        self.progress = float(state.get("progress", self.progress))
+        self.message = state.get("message", "")
+        self.error = state.get("error", "")
+        self.meta = state.get("meta") or {}
+        self.started_at = float(state.get("startedAt", 0.0))
+        self.finished_at = float(state.get("finishedAt", 0.0))
+        self.heartbeat_at = float(state.get("heartbeatAt", 0.0))
+        return True
+
+    def save(self, strict: bool = False):
+        """
+        Grava job.json de forma atómica (worker e heartbeat gravam em série); só a submissão
+        (strict) falha se não conseguir gravar.
+        """
+        with self._save_lock:
+            self._saved_at = self.heartbeat_at = time.time()
+            state = {
+                "id": self.id, "kind": self.kind, "owner": self.owner, "title": self.title, "key": self.key,
+                "inputs": self.inputs, "status": self.status, "progress": self.progress, "message": self.message,
+                "error": self.error, "meta": self.meta, "createdAt": self.created_at,
+                "startedAt": self.started_at, "finishedAt": self.finished_at,
+                "pid": self.pid, "host": self.host, "token": self.token, "heartbeatAt": self.heartbeat_at,
+            }
+            try:
+                tmp = self.path(f"job.json.tmp-{os.getpid()}-{threading.get_ident()}")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.path("job.json"))
+            except Exception:
+                if strict:
+                    raise
+
+class _JobQueue:
+    """
+    Fila de tarefas do processo: pool de workers, uma pasta por tarefa em `root` e limpeza
+    das tarefas terminadas há mais de `ttl` segundos. Ao arrancar recupera as tarefas
+    gravadas; as que estavam por terminar só ficam marcadas como interrompidas se o processo
+    que as corria já não existe (as de outro processo vivo são relidas do disco). As tarefas
+    por terminar desta fila regravam job.json (heartbeat) a cada `heartbeat_timeout`/4 s, no
+    máximo 30 s; noutra máquina contam como vivas enquanto o heartbeat tiver menos de
+    `heartbeat_timeout` segundos.
+    """
+    INCOMPLETE_GRACE = 300.0  # pasta sem job.json mais recente do que isto pode estar a ser criada
+    RESCAN_INTERVAL = 10.0  # jobs() relê `root` quando o mtime muda ou, no máximo, com este intervalo
+
+    def __init__(self, root: str, workers: int, ttl: float, token: Optional[str] = None,
+                 heartbeat_timeout: float = 300.0):
+        self.root, self.ttl, self.heartbeat_timeout = root, ttl, heartbeat_timeout
+        self.token = token or _process_token()
+        self.host = socket.gethostname()
+        os.makedirs(root, exist_ok=True)
+        self._jobs: Dict[str, _Job] = {}
+        self._submitted: set = set()  # ids corridos por esta fila; os restantes vêm do disco
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._closed = threading.Event()
+        self._scanned_at, self._scanned_mtime = 0.0, 0.0
+        with self._lock:
+            self._scan()
+            self._purge()
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def close(self, wait: bool = True):
+        """Pára o heartbeat e os workers (testes e scripts; a fila da app vive com o processo)."""
+        self._closed.set()
+        self._pool.shutdown(wait=wait)
+
+    def _heartbeat(self):
+        """Regrava job.json das tarefas desta fila por terminar, mesmo numa fase que não chama report()."""
+        interval = max(min(self.heartbeat_timeout / 4, 30.0), 0.05)
+        while not self._closed.wait(interval):
+            with self._lock:
+                jobs = [self._jobs[i] for i in self._submitted if i in self._jobs]
+            for job in jobs:
+                if not job.finished and time.time() - job._saved_at >= interval:
+                    job.save()
+
+    def _scan(self):
+        """
+        Lê de `root` as tarefas que esta fila ainda não conhece (ao arrancar, ou criadas por outro
+        processo a partilhar JOB_DIR) e esquece as que outro processo já apagou.
+        """
+        now = time.time()
+        try:
+            mtime = os.path.getmtime(self.root)
+            names = set(os.listdir(self.root))
+        except OSError:
+            return
+        self._scanned_at, self._scanned_mtime = now, mtime
+        for job_id in [j for j in self._jobs if j not in names]:
+            del self._jobs[job_id]
+            self._submitted.discard(job_id)
+        for name in sorted(names):
+            workdir = os.path.join(self.root, name)
+            if name in self._jobs or not os.path.isdir(workdir):
+                continue
+            try:
+                with open(os.path.join(workdir, "job.json"), encoding="utf-8") as f:
+                    job = _Job(workdir, json.load(f))
+            except Exception:
+                try:
+                    age = now - os.path.getmtime(workdir)
+                except OSError:
+                    continue
+                if age > self.INCOMPLETE_GRACE:  # processo parou a meio da submissão
+                    shutil.rmtree(workdir, ignore_errors=True)
+                continue
+            self._reap(job)
+            self._jobs[job.id] = job
 
-    if uploaded_zip_file is not None and not st.session_state.excel_processing_done:
-        excel_files_in_zip: List[str] = []
-        arquivos_com_erro: List[str] = []
+    def _rescan_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self.root)
+        except OSError:
+            return
+        if mtime != self._scanned_mtime or time.time() - self._scanned_at >= self.RESCAN_INTERVAL:
+            self._scan()
 
-        temp_csv_buffer = StringIO()
-        header_written = False
+    def _owner_alive(self, job: _Job) -> bool:
+        if not job.pid:
+            return False  # gravada antes de as tarefas registarem o processo
+        if job.token == self.token:
+            return True
+        if job.host != self.host:
+            # Outra máquina a partilhar JOB_DIR: viva enquanto o heartbeat for recente.
+            return time.time() - job.heartbeat_at < self.heartbeat_timeout
+        if job.pid == os.getpid():
+            return False  # mesmo pid, outro token: processo anterior do contentor
+        return _process_alive(job.pid)
+
+    def _reap(self, job: _Job):
+        """Marca como interrompida uma tarefa por terminar cujo processo já não existe."""
+        if not job.finished and not self._owner_alive(job):
+            job.status, job.finished_at = "error", time.time()
+            job.error = "Interrompida por um reinício do servidor; submeta de novo."
+            job.save()
+
+    def _sync(self):
+        """Relê do disco as tarefas por terminar que correm noutra fila ou noutro processo."""
+        for job_id, job in list(self._jobs.items()):
+            if job.finished or job_id in self._submitted:
+                continue
+            if not job.reload():
+                del self._jobs[job_id]
+            else:
+                self._reap(job)
+
+    def _purge(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished_at > self.ttl:
+                del self._jobs[job_id]
+                self._submitted.discard(job_id)
+                shutil.rmtree(job.workdir, ignore_errors=True)
+
+    def submit(self, kind: str, owner: str, title: str, key: str, fn, inputs: Dict[str, bytes]) -> _Job:
+        """
+        Grava as entradas na pasta da tarefa e põe `fn(job) -> meta` na fila. A mesma conversão
+        (utilizador, tipo e chave) em curso ou concluída é reaproveitada em vez de recalculada.
+        """
+        with self._lock:
+            self._purge()
+            for job in self._jobs.values():
+                if (job.owner, job.kind, job.key) == (owner, kind, key) and job.status not in ("error", "cancelled"):
+                    return job
+            job_id = f"{datetime.now():%Y%m%d-%H%M%S}-{os.urandom(3).hex()}"
+            workdir = os.path.join(self.root, job_id)
+            os.makedirs(workdir)
+            job = _Job(workdir, {"id": job_id, "kind": kind, "owner": owner, "title": title, "key": key,
+                                 "inputs": list(inputs), "createdAt": time.time(),
+                                 "pid": os.getpid(), "host": self.host, "token": self.token})
+            try:
+                job.save(strict=True)  # job.json antes das entradas: a pasta nunca fica sem dono
+                for name, data in inputs.items():
+                    with open(os.path.join(workdir, name), "wb") as f:
+                        f.write(data)
+            except Exception:
+                shutil.rmtree(workdir, ignore_errors=True)
+                raise
+            self._jobs[job_id] = job
+            self._submitted.add(job_id)
+        self._pool.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job: _Job, fn):
+        if os.path.exists(job.path("cancel")):
+            job.cancel()
+        status = "cancelled"
+        if not job.cancelled:
+            job.status, job.started_at = "running", time.time()
+            job.save()
+            try:
+                job.meta = fn(job) or {}
+                status, job.progress = "done", 1.0
+            except _JobCancelled:
+                pass
+            except Exception as e:
+                status, job.error = "error", str(e) or type(e).__name__
+        for name in job.inputs:  # as entradas só servem para correr a tarefa
+            try:
+                os.remove(job.path(name))
+            except OSError:
+                pass
+        # O estado final fica para o fim: quem vê a tarefa terminada já tem finished_at e
+        # as entradas apagadas.
+        job.message, job.finished_at = "", time.time()
+        job.status = status
+        job.save()
+
+    def cancel(self, job: _Job):
+        job.cancel()
+        if job.status == "queued" and job.id in self._submitted:
+            job.status, job.finished_at = "cancelled", time.time()
+            job.save()
+
+    def remove(self, job: _Job):
+        """Esquece uma tarefa terminada e apaga os seus ficheiros."""
+        with self._lock:
+            if job.finished and self._jobs.pop(job.id, None) is not None:
+                self._submitted.discard(job.id)
+                shutil.rmtree(job.workdir, ignore_errors=True)
+
+    def get(self, job_id: Optional[str]) -> Optional[_Job]:
+        with self._lock:
+            self._sync()
+            return self._jobs.get(job_id or "")
+
+    def jobs(self, owner: str) -> List[_Job]:
+        """Tarefas do utilizador, mais recentes primeiro (incluindo as submetidas noutros processos)."""
+        with self._lock:
+            self._rescan_if_changed()
+            self._sync()
+            self._purge()
+            return sorted((j for j in self._jobs.values() if j.owner == owner), key=lambda j: -j.created_at)
+
+# Job settings (env JOB_* first, then secrets [jobs])
+def _job_setting(key: str, default: str = "") -> str:
+    v = os.getenv(f"JOB_{key.upper()}")
+    if v is not None and isinstance(v, str) and v.strip():
+        return v.strip()
+    try:
+        sv = st.secrets.get("jobs", {}).get(key, default)
+        return sv.strip() if isinstance(sv, str) else sv
+    except Exception:
+        return default
 
-        st.info(f"A iniciar o processamento do ficheiro ZIP: **{uploaded_zip_file.name}**...")
+def _job_dir() -> str:
+    """Diretório das tarefas e dos seus resultados (JOB_DIR; montar como volume em produção)."""
+    path = _job_setting("dir") or os.path.join(tempfile.gettempdir(), "inobest-jobs")
+    os.makedirs(path, exist_ok=True)
+    return path
 
-        try:
-            with zipfile.ZipFile(uploaded_zip_file, 'r') as zf:
-                for file_info in zf.infolist():
-                    if not file_info.is_dir() and (file_info.filename.lower().endswith('.xls') or file_info.filename.lower().endswith('.xlsx')):
-                        excel_files_in_zip.append(file_info.filename)
-
-                if not excel_files_in_zip:
-                    st.warning("Nenhum ficheiro Excel (.xls ou .xlsx) encontrado dentro do ficheiro ZIP.")
-                    st.session_state.excel_processing_done = False
-                    st.session_state.excel_processed_data_zip = None
-                    st.session_state.excel_processed_data_csv_preview = None
-                    st.session_state.excel_arquivos_com_erro_state = []
-                    st.session_state.excel_last_uploaded_file_id = None
-                    _safe_rerun()
-
-                st.write(f"Encontrados **{len(excel_files_in_zip)}** ficheiro(s) Excel no ZIP. A iniciar leitura...")
-                progress_text = st.empty()
-                progress_bar = st.progress(0)
+@st.cache_resource(show_spinner=False)
+def _job_queue_for(root: str, workers: int, ttl: float, heartbeat_timeout: float) -> _JobQueue:
+    return _JobQueue(root, workers, ttl, heartbeat_timeout=heartbeat_timeout)
 
+def _job_queue() -> _JobQueue:
+    """
+    Fila partilhada (JOB_WORKERS, por omissão 2; resultados guardados JOB_TTL s, por omissão 2 dias;
+    tarefas de outra máquina sem heartbeat há JOB_HEARTBEAT_TIMEOUT s, por omissão 5 min, são interrompidas).
+    """
+    try:
+        workers = max(int(_job_setting("workers") or 2), 1)
+    except (TypeError, ValueError):
+        workers = 2
+    try:
+        ttl = float(_job_setting("ttl") or 172800)
+    except (TypeError, ValueError):
+        ttl = 172800.0
+    try:
+        heartbeat_timeout = max(float(_job_setting("heartbeat_timeout") or 300), 1.0)
+    except (TypeError, ValueError):
+        heartbeat_timeout = 300.0
+    return _job_queue_for(_job_dir(), workers, ttl, heartbeat_timeout)
+
+def _job_owner() -> str:
+    return st.session_state.get("o365_auth", {}).get("email", "") or "service"
+
+def _read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _job_download_button(job: _Job, key: str):
+    """Botão de download do ficheiro principal da tarefa (lido do disco só ao clicar)."""
+    output = job.meta.get("output")
+    if not output or not os.path.exists(job.path(output["name"])):
+        return
+    st.download_button(
+        label=output["label"],
+        data=functools.partial(_read_file_bytes, job.path(output["name"])),
+        file_name=output.get("file_name") or output["name"],
+        mime=output["mime"],
+        key=key,
+        type="primary",
+    )
+
+def _submit_tool_job(kind: str, title: str, key: str, fn, inputs: Dict[str, bytes]) -> _Job:
+    job = _job_queue().submit(kind, _job_owner(), title, key, fn, inputs)
+    st.session_state[f"job_open_{kind}"] = job.id
+    return job
+
+def _tool_job(kind: str) -> Optional[_Job]:
+    """Tarefa aberta nesta ferramenta: a última submetida nesta sessão ou a escolhida em «Minhas tarefas»."""
+    job = _job_queue().get(st.session_state.get(f"job_open_{kind}"))
+    return job if job is not None and job.owner == _job_owner() else None
+
+def _render_tool_job(job: _Job, render_result):
+    """Progresso (atualizado a cada segundo, com cancelar) e, no fim, o resultado da tarefa."""
+    if not job.finished:
+        @st.fragment(run_every=1.0)
+        def _progress():
+            if job.finished:
+                st.rerun()  # resultado pronto: redesenha a página inteira
+            elapsed = time.time() - (job.started_at or job.created_at)
+            st.progress(job.progress, text=f"{_JOB_STATUS_LABELS[job.status]}: {job.message or job.title} · {elapsed:.0f}s")
+            if job.cancelled:
+                st.caption("A cancelar…")
+            elif st.button("Cancelar", key=f"cancel_job_{job.id}"):
+                _job_queue().cancel(job)
+                st.caption("A cancelar…")
+
+        _progress()
+        st.caption("Pode mudar de página ou fechar o separador: a tarefa continua e o resultado fica em «Minhas tarefas».")
+        return
+    if job.status == "error":
+        st.error(f"{job.title}: {job.error}")
+    elif job.status == "cancelled":
+        st.warning(f"{job.title}: tarefa cancelada.")
+    else:
+        st.caption(f"Resultado de «{job.title}» ({datetime.fromtimestamp(job.finished_at).strftime('%d/%m %H:%M')}).")
+        render_result(job)
+
+def _open_job(job: _Job):
+    st.session_state[f"job_open_{job.kind}"] = job.id
+    if not _PAGES:  # sem st.navigation: a ferramenta é escolhida no rádio da barra lateral
+        st.session_state["active_tool"] = next(title for title, _, path in _TOOLS if path == job.kind)
+
+def render_jobs_page():
+    st.header("Minhas tarefas")
+    queue = _job_queue()
+    jobs = queue.jobs(_job_owner())
+    if not jobs:
+        st.info("Ainda não submeteu nenhuma conversão (Agregador de Excel, SAF-T ou Extrator QR Code).")
+        return
+    st.caption(f"Os resultados ficam guardados {queue.ttl / 3600:.0f} h depois de cada tarefa terminar.")
+
+    @st.fragment(run_every=1.0 if any(not j.finished for j in jobs) else None)
+    def _list():
+        running = any(not j.finished for j in jobs)
+        for job in jobs:
+            tool = next((title for title, _, path in _TOOLS if path == job.kind), job.kind)
+            submitted = datetime.fromtimestamp(job.created_at).strftime("%d/%m %H:%M")
+            with st.container(border=True):
+                c1, c2 = st.columns([3, 1])
+                with c1:
+                    st.markdown(f"**{job.title}** · {tool} · {submitted}")
+                    if not job.finished:
+                        st.progress(job.progress, text=f"{_JOB_STATUS_LABELS[job.status]}: {job.message}")
+                    elif job.status == "error":
+                        st.caption(f"{_JOB_STATUS_LABELS[job.status]}: {job.error}")
+                    else:
+                        took = job.finished_at - (job.started_at or job.finished_at)
+                        st.caption(f"{_JOB_STATUS_LABELS[job.status]} em {took:.0f}s.")
+                    if job.status == "done":
+                        _job_download_button(job, key=f"download_job_{job.id}")
+                with c2:
+                    if job.status == "done" and st.button("Abrir", key=f"open_job_{job.id}", on_click=_open_job, args=(job,)):
+                        if job.kind in _PAGES:
+                            st.switch_page(_PAGES[job.kind])
+                    if not job.finished:
+                        if not job.cancelled and st.button("Cancelar", key=f"cancel_job_{job.id}"):
+                            queue.cancel(job)
+                    elif st.button("Remover", key=f"remove_job_{job.id}"):
+                        queue.remove(job)
+                        st.rerun()
+        if running and all(j.finished for j in jobs):
+            st.rerun()  # tudo terminado: deixa de atualizar
+
+    _list()
+
+# ========================================
+# Excel Aggregator (ZIP of Excel -> single CSV in ZIP)
+# ========================================
+
+def _excel_aggregate_job(job) -> Dict[str, Any]:
+    """
+    Tarefa em segundo plano: agrega todas as folhas dos Excel do ZIP num único CSV (;),
+    escrito diretamente dentro de resultado_agregado.zip, e guarda uma pré-visualização.
+    """
+    arquivos_com_erro: List[str] = []
+    avisos: List[str] = []
+    out_path = job.path("resultado_agregado.zip")
+    header_written = False
+    try:
+        with zipfile.ZipFile(job.path("input.zip"), 'r') as zf:
+            excel_files_in_zip = [
+                file_info.filename for file_info in zf.infolist()
+                if not file_info.is_dir() and file_info.filename.lower().endswith(('.xls', '.xlsx'))
+            ]
+            if not excel_files_in_zip:
+                raise ValueError("Nenhum ficheiro Excel (.xls ou .xlsx) encontrado dentro do ficheiro ZIP.")
+
+            with zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED) as zf_out, \
+                    zf_out.open('resultado_agregado.csv', 'w') as raw, \
+                    io.TextIOWrapper(raw, encoding='utf-8', newline='') as temp_csv:
                 for i, filename_in_zip in enumerate(excel_files_in_zip):
-                    progress_text.text(f"A processar ficheiro {i+1}/{len(excel_files_in_zip)}: **{filename_in_zip}**")
+                    job.report(i / len(excel_files_in_zip),
+                               f"A processar ficheiro {i+1}/{len(excel_files_in_zip)}: {filename_in_zip}")
                     try:
                         with zf.open(filename_in_zip) as excel_file_in_zip:
                             excel_content = BytesIO(excel_file_in_zip.read())
@@ -575,90 +1034,89 @@ def excel_aggregator_app():
                             if temp_dfs_from_file:
                                 df_current_file = pd.concat(temp_dfs_from_file, ignore_index=True)
                                 df_current_file.to_csv(
-                                    temp_csv_buffer,
+                                    temp_csv,
                                     sep=';',
-                                    mode='a',
                                     header=not header_written,
                                     index=False,
-                                    encoding='utf-8',
                                     quoting=csv.QUOTE_MINIMAL,
                                 )
-                                if not header_written:
-                                    header_written = True
+                                header_written = True
                             else:
-                                st.warning(f"O ficheiro '{filename_in_zip}' não contém dados em nenhuma folha ou está vazio.")
+                                avisos.append(f"O ficheiro '{filename_in_zip}' não contém dados em nenhuma folha ou está vazio.")
+                    except _JobCancelled:
+                        raise
                     except Exception as e:
                         arquivos_com_erro.append(f"{filename_in_zip} ({e})")
-                        st.error(f"Erro ao processar '{filename_in_zip}' dentro do ZIP: {e}")
-
-                    progress_bar.progress((i + 1) / len(excel_files_in_zip))
+    except zipfile.BadZipFile:
+        raise ValueError("O ficheiro carregado não é um ZIP válido ou está corrompido.") from None
+    except BaseException:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    if not header_written:
+        os.remove(out_path)
+        raise ValueError("Nenhum dado válido pôde ser processado dos ficheiros Excel no ZIP.")
+
+    meta: Dict[str, Any] = {
+        "erros": arquivos_com_erro,
+        "avisos": avisos,
+        "output": {"name": "resultado_agregado.zip", "mime": "application/zip",
+                   "label": "Descarregar Resultado Agregado (resultado_agregado.zip)"},
+    }
+    job.report(1.0, "A preparar a pré-visualização...")
+    try:
+        with zipfile.ZipFile(out_path) as zf_out, zf_out.open('resultado_agregado.csv') as f:
+            pd.read_csv(f, sep=';', encoding='utf-8', nrows=5).to_parquet(job.path("preview.parquet"), index=False)
+    except Exception as e:
+        meta["preview_error"] = str(e)
+    return meta
+
+def _render_excel_job(job):
+    st.success("Todos os ficheiros Excel válidos foram lidos e agregados!")
+    for aviso in job.meta.get("avisos", []):
+        st.warning(aviso)
+    if job.meta.get("preview_error"):
+        st.warning(f"Não foi possível gerar a pré-visualização: {job.meta['preview_error']}.")
+    elif os.path.exists(job.path("preview.parquet")):
+        st.subheader("Pré-visualização dos Dados Agregados (CSV):")
+        st.dataframe(job.load("preview.parquet", pd.read_parquet), use_container_width=True)
+    _job_download_button(job, key="excel_download")
+    if job.meta.get("erros"):
+        st.warning("Alguns ficheiros dentro do ZIP tiveram erros:")
+        for erro in job.meta["erros"]:
+            st.write(f"- {erro}")
 
-                progress_text.text("Todos os ficheiros foram processados. A finalizar...")
+def excel_aggregator_app():
+    st.header("Agregador de Ficheiros Excel (via ZIP)")
+    st.write("Carregue um ficheiro ZIP contendo os seus ficheiros Excel (.xls ou .xlsx) para agregá-los num único ficheiro CSV, depois comprimido num novo ZIP.")
 
-        except zipfile.BadZipFile:
-            st.error("O ficheiro carregado não é um ZIP válido ou está corrompido.")
-            st.session_state.excel_processing_done = False
-            st.session_state.excel_processed_data_zip = None
-            st.session_state.excel_processed_data_csv_preview = None
-            st.session_state.excel_arquivos_com_erro_state = []
-            st.session_state.excel_last_uploaded_file_id = None
-            _safe_rerun()
-        except Exception as e:
-            st.error(f"Ocorreu um erro inesperado ao processar o ZIP: {e}")
-            st.session_state.excel_processing_done = False
-            st.session_state.excel_processed_data_zip = None
-            st.session_state.excel_processed_data_csv_preview = None
-            st.session_state.excel_arquivos_com_erro_state = []
-            st.session_state.excel_last_uploaded_file_id = None
-            _safe_rerun()
+    if 'excel_last_uploaded_file_id' not in st.session_state:
+        st.session_state.excel_last_uploaded_file_id = None
 
-        if header_written:
-            st.session_state.excel_processing_done = True
-            st.session_state.excel_arquivos_com_erro_state = arquivos_com_erro
+    uploaded_zip_file = st.file_uploader(
+        "Arraste e largue o seu ficheiro ZIP aqui ou clique para procurar",
+        type=["zip"],
+        accept_multiple_files=False,
+        key="zip_uploader_excel"
+    )
 
-            with st.spinner("A carregar dados agregados e a preparar para download..."):
-                temp_csv_buffer.seek(0)
-                try:
-                    df_final_preview = pd.read_csv(temp_csv_buffer, sep=';', encoding='utf-8')
-                    st.session_state.excel_processed_data_csv_preview = df_final_preview.head()
-                    temp_csv_buffer.seek(0)
-                except Exception as e:
-                    st.warning(f"Não foi possível gerar a pré-visualização: {e}.")
-                    st.session_state.excel_processed_data_csv_preview = None
-                    temp_csv_buffer.seek(0)
-
-            with st.spinner("A comprimir o CSV num ficheiro ZIP..."):
-                zip_output_buffer = BytesIO()
-                with zipfile.ZipFile(zip_output_buffer, 'w', zipfile.ZIP_DEFLATED) as zf_out:
-                    zf_out.writestr('resultado_agregado.csv', temp_csv_buffer.getvalue())
-                zip_output_buffer.seek(0)
-                st.session_state.excel_processed_data_zip = zip_output_buffer.getvalue()
+    # Novo upload: submete a agregação como tarefa (o mesmo ZIP já processado é reaproveitado)
+    if uploaded_zip_file is not None:
+        try:
+            current_file_id = getattr(uploaded_zip_file, 'file_id', None) or f"{uploaded_zip_file.name}:{uploaded_zip_file.size}"
+        except Exception:
+            current_file_id = uploaded_zip_file.name
+        if current_file_id != st.session_state.excel_last_uploaded_file_id:
+            st.session_state.excel_last_uploaded_file_id = current_file_id
+            data = uploaded_zip_file.getvalue()
+            _submit_tool_job("excel", uploaded_zip_file.name, hashlib.sha1(data).hexdigest(),
+                             _excel_aggregate_job, {"input.zip": data})
+    else:
+        st.session_state.excel_last_uploaded_file_id = None
 
-            _safe_rerun()
-        else:
-            st.error("Nenhum dado válido pôde ser processado dos ficheiros Excel no ZIP.")
-            st.session_state.excel_processing_done = False
-            st.session_state.excel_processed_data_zip = None
-            st.session_state.excel_processed_data_csv_preview = None
-            st.session_state.excel_arquivos_com_erro_state = []
-            st.session_state.excel_last_uploaded_file_id = None
-
-    if st.session_state.excel_processing_done:
-        st.success("Todos os ficheiros Excel válidos foram lidos e agregados!")
-        if st.session_state.excel_processed_data_csv_preview is not None:
-            st.subheader("Pré-visualização dos Dados Agregados (CSV):")
-            st.dataframe(st.session_state.excel_processed_data_csv_preview, use_container_width=True)
-        if st.session_state.excel_processed_data_zip is not None:
-            st.download_button(
-                label="Descarregar Resultado Agregado (resultado_agregado.zip)",
-                data=st.session_state.excel_processed_data_zip,
-                file_name="resultado_agregado.zip",
-                mime="application/zip"
-            )
-        if st.session_state.excel_arquivos_com_erro_state:
-            st.warning("Alguns ficheiros dentro do ZIP tiveram erros:")
-            for erro in st.session_state.excel_arquivos_com_erro_state:
-                st.write(f"- {erro}")
+    job = _tool_job("excel")
+    if job is not None:
+        _render_tool_job(job, _render_excel_job)
     elif uploaded_zip_file is None:
         st.info("A aguardar o carregamento de um ficheiro ZIP contendo os ficheiros Excel...")
 
@@ -666,92 +1124,509 @@ def excel_aggregator_app():
 # SAF-T Faturação -> CSV
 # ========================================
 
-def parse_saft_xml_bytes(xml_bytes: bytes) -> Tuple[str, str, str]:
-    """Recebe bytes XML e retorna (base_name, customers_csv_text, invoices_csv_text)."""
+_SAFT_CUSTOMER_COLUMNS = ['CustomerID', 'CustomerTaxID', 'CompanyName', 'Country']
+_SAFT_INVOICE_COLUMNS = [
+    'InvoiceNo', 'InvoiceStatus', 'Period', 'InvoiceDate', 'InvoiceType', 'CustomerID',
+    'ProductCode', 'ProductDescription', 'Quantity', 'UnitOfMeasure', 'UnitPrice', 'Description',
+    'Amount', 'TaxAmount', 'TaxCountryRegion', 'Reference', 'Reason'
+]
+# Colunas com muitos valores repetidos: guardadas como category (códigos inteiros) para
+# reduzir memória e acelerar os groupby em ficheiros com milhões de linhas.
+_SAFT_CATEGORY_COLUMNS = [
+    'InvoiceNo', 'InvoiceStatus', 'InvoiceType', 'CustomerID', 'ProductCode',
+    'ProductDescription', 'UnitOfMeasure', 'TaxCountryRegion',
+]
+_SAFT_NUMERIC_COLUMNS = ['Quantity', 'UnitPrice', 'Amount', 'TaxAmount']
+# As linhas são convertidas para colunas tipadas em blocos deste tamanho: só um bloco de
+# cada vez fica em listas de str (antes eram todas as linhas do ficheiro até ao fim).
+_SAFT_FRAME_CHUNK_ROWS = 100_000
+
+# Tolerância (em euros) na comparação de somas calculadas com totais declarados
+_SAFT_RECON_TOLERANCE = 0.01
+
+def _saft_amount(el) -> float:
+    """Valor numérico de um elemento SAF-T (0.0 se ausente ou inválido)."""
+    if el is None or not el.text:
+        return 0.0
     try:
-        xmlstring = xml_bytes.decode('utf-8')
-    except Exception:
-        xmlstring = xml_bytes.decode('latin-1', errors='replace')
-
-    # remove default namespace to simplify XPath
-    xmlstring = re.sub(r'\sxmlns="[^"]+"', '', xmlstring, count=0)
-    root = ET.fromstring(xmlstring)
-
-    customers_buf = io.StringIO()
-    invoices_buf = io.StringIO()
-    csvwritercustomer = csv.writer(customers_buf, lineterminator='\n')
-    csvwriterinvoices = csv.writer(invoices_buf, lineterminator='\n')
-
-    Customer_head: List[str] = []
-    count = 0
-    for Customer in root.findall('./MasterFiles/Customer'):
-        if count == 0:
-            if Customer.find('CustomerID') is not None: Customer_head.append('CustomerID')
-            if Customer.find('CustomerTaxID') is not None: Customer_head.append('CustomerTaxID')
-            if Customer.find('CompanyName') is not None: Customer_head.append('CompanyName')
-            if Customer.find('./BillingAddress/Country') is not None: Customer_head.append('Country')
-            csvwritercustomer.writerow(Customer_head)
-            count += 1
+        return float(el.text)
+    except ValueError:
+        return 0.0
+
+_SAFT_CHECK_COLUMNS = ['Controlo', 'Declarado', 'Calculado', 'Diferenca', 'OK']
+_SAFT_MISMATCH_COLUMNS = [
+    'InvoiceNo', 'InvoiceStatus', 'Linhas', 'NetTotal', 'NetLinhas',
+    'TaxPayable', 'TaxLinhas', 'GrossTotal', 'GrossLinhas',
+]
+
+def _saft_reconciliation_report(sales_invoices, n_docs: int, total_debit: float, total_credit: float,
+                                total_tax: float, doc_mismatches: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Compara as somas acumuladas durante a escrita das linhas com os totais de controlo
+    declarados em SalesInvoices (NumberOfEntries, TotalDebit, TotalCredit).
+    """
+    def _declared(tag: str) -> Optional[float]:
+        el = sales_invoices.find(tag) if sales_invoices is not None else None
+        if el is None or not el.text:
+            return None
+        try:
+            return float(el.text)
+        except ValueError:
+            return None
+
+    checks: List[Dict[str, Any]] = []
+    for label, declared, computed in (
+        ("NumberOfEntries", _declared('NumberOfEntries'), float(n_docs)),
+        ("TotalDebit", _declared('TotalDebit'), round(total_debit, 2)),
+        ("TotalCredit", _declared('TotalCredit'), round(total_credit, 2)),
+    ):
+        diff = None if declared is None else round(computed - declared, 2)
+        checks.append({
+            "Controlo": label,
+            "Declarado": declared,
+            "Calculado": computed,
+            "Diferenca": diff,
+            "OK": None if declared is None else abs(diff) <= _SAFT_RECON_TOLERANCE,
+        })
+    checks.append({
+        "Controlo": "TaxPayable (soma das linhas)", "Declarado": None,
+        "Calculado": round(total_tax, 2), "Diferenca": None, "OK": None,
+    })
+    return {
+        "checks": pd.DataFrame(checks, columns=_SAFT_CHECK_COLUMNS),
+        "mismatched_invoices": pd.DataFrame(doc_mismatches, columns=_SAFT_MISMATCH_COLUMNS),
+        "ok": all(c["OK"] is not False for c in checks) and not doc_mismatches,
+    }
+
+def _write_saft_reconciliation(recon: Dict[str, Any], path: str):
+    """Grava o relatório de reconciliação em JSON (as tabelas como listas de registos)."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"ok": %s, "checks": %s, "mismatched_invoices": %s}' % (
+            json.dumps(bool(recon["ok"])),
+            recon["checks"].to_json(orient="records", force_ascii=False),
+            recon["mismatched_invoices"].to_json(orient="records", force_ascii=False),
+        ))
+
+def _read_saft_reconciliation(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return {
+        "checks": pd.DataFrame(data["checks"], columns=_SAFT_CHECK_COLUMNS),
+        "mismatched_invoices": pd.DataFrame(data["mismatched_invoices"], columns=_SAFT_MISMATCH_COLUMNS),
+        "ok": data["ok"],
+    }
+
+def _saft_concat_invoice_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Junta os blocos tipados das linhas. As colunas category são unidas com categorias
+    ordenadas, como numa conversão única (pd.concat passá-las-ia a object).
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    columns: Dict[str, Any] = {}
+    for col in _SAFT_INVOICE_COLUMNS:
+        parts = [chunk[col] for chunk in chunks]
+        if col in _SAFT_CATEGORY_COLUMNS:
+            columns[col] = pd.api.types.union_categoricals(parts, sort_categories=True)
         else:
-            ID = Customer.find('CustomerID').text if Customer.find('CustomerID') is not None else ''
-            TaxID = Customer.find('CustomerTaxID').text if Customer.find('CustomerTaxID') is not None else ''
-            Name = Customer.find('CompanyName').text if Customer.find('CompanyName') is not None else ''
-            Country = Customer.find('./BillingAddress/Country').text if Customer.find('./BillingAddress/Country') is not None else ''
-            csvwritercustomer.writerow([ID, TaxID, Name, Country])
-
-    Invoices_head: List[str] = []
-    first = True
-    for Invoice in root.findall('./SourceDocuments/SalesInvoices/Invoice'):
-        if first:
-            Invoices_head += [
-                'InvoiceNo', 'InvoiceStatus', 'Period', 'InvoiceDate', 'InvoiceType', 'CustomerID',
-                'ProductCode', 'ProductDescription', 'Quantity', 'UnitOfMeasure', 'UnitPrice', 'Description',
-                'Amount', 'TaxAmount', 'TaxCountryRegion', 'Reference', 'Reason'
-            ]
-            csvwriterinvoices.writerow(Invoices_head)
-            first = False
-        for Line in Invoice.findall('./Line'):
-            row: List[str] = []
-            row.append(Invoice.find('InvoiceNo').text if Invoice.find('InvoiceNo') is not None else '')
-            row.append(Invoice.find('./DocumentStatus/InvoiceStatus').text if Invoice.find('./DocumentStatus/InvoiceStatus') is not None else '')
-            try:
-                row.append(Invoice.find('Period').text)
-            except Exception:
-                invoice_date = Invoice.find('InvoiceDate').text if Invoice.find('InvoiceDate') is not None else ''
-                row.append(invoice_date[5:7] if invoice_date else '')
-            row.append(Invoice.find('InvoiceDate').text if Invoice.find('InvoiceDate') is not None else '')
-            row.append(Invoice.find('InvoiceType').text if Invoice.find('InvoiceType') is not None else '')
-            row.append(Invoice.find('CustomerID').text if Invoice.find('CustomerID') is not None else '')
-            row.append(Line.find('ProductCode').text if Line.find('ProductCode') is not None else '')
-            row.append(Line.find('ProductDescription').text if Line.find('ProductDescription') is not None else '')
-            row.append(Line.find('Quantity').text if Line.find('Quantity') is not None else '')
-            row.append(Line.find('UnitOfMeasure').text if Line.find('UnitOfMeasure') is not None else '')
-            row.append(Line.find('UnitPrice').text if Line.find('UnitPrice') is not None else '')
-            row.append(Line.find('Description').text if Line.find('Description') is not None else '')
-            debit = Line.find('DebitAmount'); credit = Line.find('CreditAmount')
-            if debit is not None and debit.text:
-                row.append("-" + debit.text)
-            elif credit is not None and credit.text:
-                row.append(credit.text)
-            else:
-                row.append('')
-            taxamt_el = Line.find('./Tax/TaxAmount'); row.append(taxamt_el.text if taxamt_el is not None else '0')
-            taxcr_el = Line.find('./Tax/TaxCountryRegion'); row.append(taxcr_el.text if taxcr_el is not None else '')
-            ref_el = Line.find('./References/Reference'); row.append(ref_el.text if ref_el is not None else '')
-            reason_el = Line.find('./References/Reason'); row.append(reason_el.text if reason_el is not None else '')
-            csvwriterinvoices.writerow(row)
+            columns[col] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns, columns=_SAFT_INVOICE_COLUMNS)
+
+def _saft_invoice_lines_frame(columns: Dict[str, List[str]]) -> pd.DataFrame:
+    """Converte as colunas (listas de texto) das linhas de faturas num DataFrame tipado."""
+    df = pd.DataFrame(columns, columns=_SAFT_INVOICE_COLUMNS)
+    for col in _SAFT_NUMERIC_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    df['Period'] = pd.to_numeric(df['Period'], errors='coerce').astype('Int16')
+    df['InvoiceDate'] = pd.to_datetime(df['InvoiceDate'], format='%Y-%m-%d', errors='coerce')
+    for col in _SAFT_CATEGORY_COLUMNS:
+        df[col] = df[col].astype('category')
+    return df
+
+# Atributos de MasterFiles juntados às linhas no export desnormalizado (via índices em memória)
+_SAFT_DENORM_CUSTOMER_COLUMNS = ['CustomerTaxID', 'CompanyName', 'Country']
+_SAFT_PRODUCT_COLUMNS = ['ProductType', 'ProductGroup', 'ProductNumberCode']
+_SAFT_DENORM_COLUMNS = _SAFT_INVOICE_COLUMNS + _SAFT_DENORM_CUSTOMER_COLUMNS + _SAFT_PRODUCT_COLUMNS
+# Elementos de documento em SourceDocuments/* libertados assim que são processados
+_SAFT_SOURCE_DOCUMENT_TAGS = {'Invoice', 'StockMovement', 'WorkDocument', 'Payment'}
+
+def _saft_text(el, path: str, default: str = '') -> str:
+    found = el.find(path)
+    return found.text if found is not None and found.text is not None else default
+
+def _saft_iterparse(xml_bytes: bytes):
+    """
+    iterparse em streaming que remove o namespace dos tags (equivalente ao antigo
+    re.sub de xmlns) e devolve (evento, elemento, pai). Os elementos de MasterFiles
+    e os documentos de SourceDocuments são retirados do pai depois do evento "end",
+    para que a árvore completa nunca fique em memória.
+    """
+    stack: List[Any] = []
+    for event, elem in ET.iterparse(io.BytesIO(xml_bytes), events=("start", "end")):
+        if event == "start":
+            if '}' in elem.tag:
+                elem.tag = elem.tag.rsplit('}', 1)[1]
+            stack.append(elem)
+            continue
+        stack.pop()
+        parent = stack[-1] if stack else None
+        yield event, elem, parent
+        depth = len(stack)
+        if parent is not None and (
+            (depth == 2 and parent.tag == 'MasterFiles')
+            or (depth == 3 and elem.tag in _SAFT_SOURCE_DOCUMENT_TAGS)
+        ):
+            elem.clear()
+            parent.remove(elem)
+
+# Codificações disponíveis para os CSV exportados (rótulo -> codec Python)
+_SAFT_CSV_ENCODINGS = {"latin-1": "latin-1", "UTF-8": "utf-8-sig"}
+# Acima deste tamanho o ZIP gerado passa de memória para ficheiro temporário em disco
+_SAFT_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+def _saft_zip_csv_writer(zf: zipfile.ZipFile, name: str, encoding: str):
+    """Abre uma entrada do ZIP em escrita e devolve (stream de texto, csv.writer) que codifica linha a linha."""
+    stream = io.TextIOWrapper(zf.open(name, 'w', force_zip64=True), encoding=encoding, errors='replace', newline='')
+    return stream, csv.writer(stream, lineterminator='\n')
+
+def _saft_parse_stream(xml_bytes: bytes, zf: zipfile.ZipFile, base_name: str, encoding: str,
+                       denormalised: bool) -> Dict[str, Any]:
+    # O ZipFile só aceita uma entrada aberta de cada vez: Customers (MasterFiles) é fechada
+    # antes de abrir Invoices; as linhas desnormalizadas vão para um temporário em disco
+    # e são copiadas para o ZIP no fim.
+    customers_stream, csvwritercustomer = _saft_zip_csv_writer(zf, base_name + "-Customers.csv", encoding)
+    invoices_stream = None; csvwriterinvoices = None
+    denorm_stream = None; csvwriterdenorm = None
+    if denormalised:
+        denorm_stream = io.TextIOWrapper(tempfile.TemporaryFile(), encoding=encoding, errors='replace', newline='')
+        csvwriterdenorm = csv.writer(denorm_stream, lineterminator='\n')
+    customer_cols: Dict[str, List[str]] = {c: [] for c in _SAFT_CUSTOMER_COLUMNS}
+    invoice_cols: Dict[str, List[str]] = {c: [] for c in _SAFT_INVOICE_COLUMNS}
+    invoice_chunks: List[pd.DataFrame] = []
+
+    # Índices hash construídos a partir de MasterFiles (que precede SourceDocuments no SAF-T)
+    customer_index: Dict[str, Tuple[str, ...]] = {}
+    product_index: Dict[str, Tuple[str, ...]] = {}
+    empty_customer = ('',) * len(_SAFT_DENORM_CUSTOMER_COLUMNS)
+    empty_product = ('',) * len(_SAFT_PRODUCT_COLUMNS)
+
+    csvwritercustomer.writerow(_SAFT_CUSTOMER_COLUMNS)
+    invoices_header_written = False
+
+    # Somas globais para controlo; documentos anulados (A) não entram em TotalDebit/TotalCredit
+    n_docs = 0; total_debit = 0.0; total_credit = 0.0; total_tax = 0.0
+    doc_mismatches: List[Dict[str, Any]] = []
+    sales_invoices = None
+
+    try:
+        for _event, elem, parent in _saft_iterparse(xml_bytes):
+            tag = elem.tag
+            parent_tag = parent.tag if parent is not None else ''
+            if tag == 'Customer' and parent_tag == 'MasterFiles':
+                ID = _saft_text(elem, 'CustomerID')
+                TaxID = _saft_text(elem, 'CustomerTaxID')
+                Name = _saft_text(elem, 'CompanyName')
+                Country = _saft_text(elem, './BillingAddress/Country')
+                if csvwritercustomer is not None:
+                    csvwritercustomer.writerow([ID, TaxID, Name, Country])
+                for col, value in zip(_SAFT_CUSTOMER_COLUMNS, (ID, TaxID, Name, Country)):
+                    customer_cols[col].append(value)
+                customer_index[ID] = (TaxID, Name, Country)
+            elif tag == 'Product' and parent_tag == 'MasterFiles':
+                product_index[_saft_text(elem, 'ProductCode')] = tuple(
+                    _saft_text(elem, c) for c in _SAFT_PRODUCT_COLUMNS
+                )
+            elif tag == 'SalesInvoices':
+                sales_invoices = elem
+            elif tag == 'Invoice' and parent_tag == 'SalesInvoices':
+                if not invoices_header_written:
+                    if customers_stream is not None:
+                        customers_stream.close(); customers_stream = None; csvwritercustomer = None
+                    invoices_stream, csvwriterinvoices = _saft_zip_csv_writer(zf, base_name + "-Invoices.csv", encoding)
+                    csvwriterinvoices.writerow(_SAFT_INVOICE_COLUMNS)
+                    if csvwriterdenorm is not None:
+                        csvwriterdenorm.writerow(_SAFT_DENORM_COLUMNS)
+                    invoices_header_written = True
+                Invoice = elem
+                n_docs += 1
+                doc_debit = 0.0; doc_credit = 0.0; doc_tax = 0.0; doc_lines = 0
+
+                # Campos do documento: lidos uma vez e repetidos em cada linha
+                invoice_no = _saft_text(Invoice, 'InvoiceNo')
+                status = _saft_text(Invoice, './DocumentStatus/InvoiceStatus')
+                invoice_date = _saft_text(Invoice, 'InvoiceDate')
+                period_el = Invoice.find('Period')
+                period = period_el.text if period_el is not None else (invoice_date[5:7] if invoice_date else '')
+                customer_id = _saft_text(Invoice, 'CustomerID')
+                head = [invoice_no, status, period or '', invoice_date,
+                        _saft_text(Invoice, 'InvoiceType'), customer_id]
+                customer_attrs = customer_index.get(customer_id, empty_customer)
+
+                for Line in Invoice.findall('./Line'):
+                    row: List[str] = head + [
+                        _saft_text(Line, 'ProductCode'),
+                        _saft_text(Line, 'ProductDescription'),
+                        _saft_text(Line, 'Quantity'),
+                        _saft_text(Line, 'UnitOfMeasure'),
+                        _saft_text(Line, 'UnitPrice'),
+                        _saft_text(Line, 'Description'),
+                    ]
+                    debit = Line.find('DebitAmount'); credit = Line.find('CreditAmount')
+                    doc_debit += _saft_amount(debit); doc_credit += _saft_amount(credit)
+                    doc_tax += _saft_amount(Line.find('./Tax/TaxAmount')); doc_lines += 1
+                    if debit is not None and debit.text:
+                        row.append("-" + debit.text)
+                    elif credit is not None and credit.text:
+                        row.append(credit.text)
+                    else:
+                        row.append('')
+                    row.append(_saft_text(Line, './Tax/TaxAmount', '0'))
+                    row.append(_saft_text(Line, './Tax/TaxCountryRegion'))
+                    row.append(_saft_text(Line, './References/Reference'))
+                    row.append(_saft_text(Line, './References/Reason'))
+                    csvwriterinvoices.writerow(row)
+                    if csvwriterdenorm is not None:
+                        csvwriterdenorm.writerow(
+                            row + list(customer_attrs) + list(product_index.get(row[6], empty_product))
+                        )
+                    for col, value in zip(_SAFT_INVOICE_COLUMNS, row):
+                        invoice_cols[col].append(value)
+                if len(invoice_cols['InvoiceNo']) >= _SAFT_FRAME_CHUNK_ROWS:
+                    invoice_chunks.append(_saft_invoice_lines_frame(invoice_cols))
+                    invoice_cols = {c: [] for c in _SAFT_INVOICE_COLUMNS}
+
+                if status != 'A':
+                    total_debit += doc_debit; total_credit += doc_credit; total_tax += doc_tax
+                totals_el = Invoice.find('DocumentTotals')
+                if totals_el is not None:
+                    net_lines = round(abs(doc_credit - doc_debit), 2); tax_lines = round(doc_tax, 2)
+                    net_total = _saft_amount(totals_el.find('NetTotal'))
+                    tax_payable = _saft_amount(totals_el.find('TaxPayable'))
+                    gross_total = _saft_amount(totals_el.find('GrossTotal'))
+                    if (abs(net_lines - net_total) > _SAFT_RECON_TOLERANCE
+                            or abs(tax_lines - tax_payable) > _SAFT_RECON_TOLERANCE
+                            or abs(net_lines + tax_lines - gross_total) > _SAFT_RECON_TOLERANCE):
+                        doc_mismatches.append({
+                            'InvoiceNo': invoice_no,
+                            'InvoiceStatus': status,
+                            'Linhas': doc_lines,
+                            'NetTotal': net_total, 'NetLinhas': net_lines,
+                            'TaxPayable': tax_payable, 'TaxLinhas': tax_lines,
+                            'GrossTotal': gross_total, 'GrossLinhas': round(net_lines + tax_lines, 2),
+                        })
+    except BaseException:
+        # Fechar entradas abertas para que o ZipFile possa ser fechado e descartado
+        for stream in (customers_stream, invoices_stream, denorm_stream):
+            if stream is not None:
+                stream.close()
+        raise
+
+    if customers_stream is not None:
+        customers_stream.close()
+    if invoices_stream is not None:
+        invoices_stream.close()
+    else:
+        zf.writestr(base_name + "-Invoices.csv", b"")
+    if denorm_stream is not None:
+        denorm_stream.flush()
+        raw = denorm_stream.detach()
+        raw.seek(0)
+        with zf.open(base_name + "-InvoiceLines-Denormalised.csv", 'w', force_zip64=True) as dst:
+            shutil.copyfileobj(raw, dst, 1024 * 1024)
+        raw.close()
+
+    reconciliation = _saft_reconciliation_report(
+        sales_invoices, n_docs, total_debit, total_credit, total_tax, doc_mismatches
+    )
+    zf.writestr(base_name + "-Reconciliation.csv",
+                reconciliation["checks"].to_csv(index=False).encode(encoding, errors='replace'))
+    zf.writestr(base_name + "-Reconciliation-Invoices.csv",
+                reconciliation["mismatched_invoices"].to_csv(index=False).encode(encoding, errors='replace'))
+    return {
+        "base_name": base_name,
+        "customers": pd.DataFrame(customer_cols, columns=_SAFT_CUSTOMER_COLUMNS),
+        "invoice_lines": _saft_concat_invoice_chunks(
+            invoice_chunks + ([_saft_invoice_lines_frame(invoice_cols)]
+                              if invoice_cols['InvoiceNo'] or not invoice_chunks else [])
+        ),
+        "reconciliation": reconciliation,
+    }
+
+def _saft_parse_to_zip(xml_bytes: bytes, base_name: str, encoding: str, denormalised: bool) -> Dict[str, Any]:
+    out = tempfile.SpooledTemporaryFile(max_size=_SAFT_SPOOL_MAX_BYTES)
+    try:
+        with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            result = _saft_parse_stream(xml_bytes, zf, base_name, encoding, denormalised)
+    except BaseException:
+        out.close()
+        raise
+    out.seek(0, os.SEEK_END)
+    result["zip_file"] = out
+    result["zip_size"] = out.tell()
+    return result
+
+def parse_saft_xml_bytes(xml_bytes: bytes, base_name: str = "saft_export", encoding: str = "latin-1",
+                         denormalised: bool = False) -> Dict[str, Any]:
+    """
+    Recebe bytes XML e devolve dict com:
+    - base_name
+    - zip_file / zip_size: SpooledTemporaryFile com o ZIP dos CSV ({base_name}-Customers.csv,
+      -Invoices.csv, -Reconciliation*.csv e, se denormalised=True, -InvoiceLines-Denormalised.csv
+      com atributos de cliente/produto). As linhas são codificadas (`encoding`) e escritas
+      diretamente nas entradas do ZIP, sem strings CSV intermédias.
+    - customers: DataFrame de clientes
+    - invoice_lines: DataFrame tipado das linhas (Amount/TaxAmount/Quantity numéricos, InvoiceDate datetime)
+    - reconciliation: controlo de totais (ver _saft_reconciliation_report)
+    O XML é lido em streaming (iterparse) numa única passagem: colunas, somas de controlo e
+    junções com MasterFiles (dicts por CustomerID/ProductCode) são feitas enquanto se escreve o CSV.
+    """
+    try:
+        return _saft_parse_to_zip(xml_bytes, base_name, encoding, denormalised)
+    except ET.ParseError:
+        try:
+            xml_bytes.decode('utf-8')
+            raise
+        except UnicodeDecodeError:
+            pass
+    # Ficheiros declarados como UTF-8 mas gravados em latin-1: re-codificar e tentar de novo
+    xmlstring = xml_bytes.decode('latin-1', errors='replace')
+    xmlstring = re.sub(r'^(\s*<\?xml[^>]*?encoding=)["\'][^"\']*["\']', r'\1"UTF-8"', xmlstring, count=1)
+    return _saft_parse_to_zip(xmlstring.encode('utf-8'), base_name, encoding, denormalised)
+
+# Dimensões disponíveis no painel de análise: rótulo -> coluna(s) de agrupamento
+_SAFT_ANALYTICS_DIMENSIONS = {
+    "Período": ["Period"],
+    "Mês (InvoiceDate)": ["Month"],
+    "Cliente": ["CustomerID"],
+    "Produto": ["ProductCode"],
+    "Região fiscal": ["TaxCountryRegion"],
+    "Tipo de documento": ["InvoiceType"],
+}
+
+def _saft_totals_by(df: pd.DataFrame, by: List[str]) -> pd.DataFrame:
+    """Totais vetorizados (groupby) de Amount/TaxAmount/Quantity para as colunas `by`."""
+    if "Month" in by and "Month" not in df.columns:
+        df = df.assign(Month=df["InvoiceDate"].dt.to_period("M"))
+    grouped = df.groupby(by, observed=True, sort=True)
+    out = grouped.agg(
+        Linhas=("Amount", "size"),
+        Documentos=("InvoiceNo", "nunique"),
+        Quantidade=("Quantity", "sum"),
+        Valor=("Amount", "sum"),
+        Imposto=("TaxAmount", "sum"),
+    )
+    out["Total"] = out["Valor"] + out["Imposto"]
+    return out.round(2)
+
+def _saft_analytics_panel(df: pd.DataFrame, customers: Optional[pd.DataFrame] = None):
+    st.subheader("📊 Análise")
+    if df.empty:
+        st.info("O ficheiro não contém linhas de faturas.")
+        return
+
+    statuses = sorted(str(s) for s in df["InvoiceStatus"].cat.categories)
+    c1, c2, c3 = st.columns([1, 1, 0.6])
+    with c1:
+        dim_label = st.selectbox("Agrupar por", list(_SAFT_ANALYTICS_DIMENSIONS.keys()), key="saft_dim")
+    with c2:
+        status_sel = st.multiselect(
+            "Estado do documento", statuses,
+            default=[s for s in statuses if s != "A"],  # A = anulado
+            key="saft_status_filter",
+        )
+    with c3:
+        top_n = st.number_input("Top N", min_value=5, max_value=500, value=20, step=5, key="saft_top_n")
+
+    mask = df["InvoiceStatus"].isin(status_sel) if status_sel else np.ones(len(df), dtype=bool)
+    view = df[mask]
+
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Linhas", f"{len(view):,}")
+    m2.metric("Documentos", f"{view['InvoiceNo'].nunique():,}")
+    m3.metric("Valor", f"{view['Amount'].sum():,.2f}")
+    m4.metric("Imposto", f"{view['TaxAmount'].sum():,.2f}")
+
+    totals = _saft_totals_by(view, _SAFT_ANALYTICS_DIMENSIONS[dim_label])
+    if dim_label == "Cliente" and customers is not None and not customers.empty:
+        names = customers.drop_duplicates("CustomerID").set_index("CustomerID")["CompanyName"]
+        totals.insert(0, "CompanyName", totals.index.map(names))
+    elif dim_label == "Produto":
+        desc = view.drop_duplicates("ProductCode").set_index("ProductCode")["ProductDescription"].astype(str)
+        totals.insert(0, "ProductDescription", totals.index.map(desc))
+
+    st.markdown(f"**Totais por {dim_label.lower()}**")
+    st.dataframe(totals, use_container_width=True)
+    st.markdown(f"**Top {int(top_n)} por valor**")
+    st.dataframe(totals.nlargest(int(top_n), "Valor"), use_container_width=True)
+
+
+def _saft_reconciliation_panel(recon: Dict[str, Any]):
+    st.subheader("🧮 Reconciliação de totais de controlo")
+    mismatched: pd.DataFrame = recon["mismatched_invoices"]
+    if recon["ok"]:
+        st.success("Os totais calculados coincidem com os totais de controlo declarados.")
+    else:
+        st.warning(
+            "Foram encontradas diferenças entre os totais calculados e os declarados"
+            + (f" ({len(mismatched)} documento(s) com linhas que não batem com DocumentTotals)." if len(mismatched) else ".")
+        )
+    st.dataframe(recon["checks"], use_container_width=True)
+    if len(mismatched):
+        with st.expander(f"Ver {len(mismatched)} documento(s) com diferenças"):
+            st.dataframe(mismatched, use_container_width=True)
+
+
+def _saft_base_name(xml_name: str) -> str:
+    """Prefixo dos CSV a partir do nome do XML, sem pastas (o XML pode vir de uma subpasta do ZIP)."""
+    return os.path.splitext(os.path.basename(xml_name.replace("\\", "/")))[0] or "saft_export"
+
+def _saft_job(job, base_name: str, encoding: str, denormalised: bool) -> Dict[str, Any]:
+    """Tarefa em segundo plano: ZIP dos CSV + DataFrames (Parquet) e reconciliação (JSON) para o painel de análise."""
+    job.report(0.0, "A analisar o XML...")
+    base_name = _saft_base_name(base_name)
+    with open(job.path("input.xml"), "rb") as f:
+        xml_bytes = f.read()
+    result = parse_saft_xml_bytes(xml_bytes, base_name=base_name, encoding=encoding, denormalised=denormalised)
+    del xml_bytes
+    zip_file = result.pop("zip_file")
+    try:
+        zip_file.seek(0)
+        with open(job.path("saft-CSVs.zip"), "wb") as out:
+            shutil.copyfileobj(zip_file, out)
+    finally:
+        zip_file.close()
+    result["customers"].to_parquet(job.path("customers.parquet"), index=False)
+    result["invoice_lines"].to_parquet(job.path("invoice_lines.parquet"), index=False)
+    _write_saft_reconciliation(result["reconciliation"], job.path("reconciliation.json"))
+    return {"output": {"name": "saft-CSVs.zip", "file_name": f"{base_name}-CSVs.zip", "mime": "application/zip",
+                       "label": f"Descarregar CSVs (ZIP, {result['zip_size']/1024/1024:.1f} MB)"}}
+
+def _render_saft_job(job):
+    if not os.path.exists(job.path("reconciliation.json")):
+        st.info("Esta tarefa foi gravada num formato antigo; submeta o ficheiro de novo para ver a análise.")
+        _job_download_button(job, key="saft_download")
+        return
+    customers_df: pd.DataFrame = job.load("customers.parquet", pd.read_parquet)
+    lines_df: pd.DataFrame = job.load("invoice_lines.parquet", pd.read_parquet)
+    with st.expander(f"Preview Customers ({len(customers_df)} registos)"):
+        st.dataframe(customers_df.head(1000), use_container_width=True)
+    with st.expander(f"Preview Invoices ({len(lines_df)} linhas)"):
+        st.dataframe(lines_df.head(1000), use_container_width=True)
 
-    customers_text = customers_buf.getvalue(); invoices_text = invoices_buf.getvalue()
-    customers_buf.close(); invoices_buf.close()
-    base_name = "saft_export"
-    return base_name, customers_text, invoices_text
+    _saft_reconciliation_panel(job.load("reconciliation.json", _read_saft_reconciliation))
+    _saft_analytics_panel(lines_df, customers_df)
 
+    # O ZIP está no disco da tarefa; só é lido quando o utilizador clica.
+    _job_download_button(job, key="saft_download")
 
 def saf_t_tab():
     st.header("SAF-T Faturação → CSV")
     uploaded = st.file_uploader("Escolha um ficheiro .xml ou um .zip contendo .xml", type=["xml", "zip"])
     if uploaded is None:
         st.info("Faça upload de um ficheiro SAF-T (.xml) ou um .zip que contenha um .xml.")
+        job = _tool_job("saft")
+        if job is not None:
+            _render_tool_job(job, _render_saft_job)
         return
     file_bytes = uploaded.read(); filename = uploaded.name
     xml_bytes = None; xml_name = None
@@ -767,30 +1642,31 @@ def saf_t_tab():
     else:
         xml_bytes = file_bytes; xml_name = filename
 
+    # A análise corre como tarefa: o resultado (no disco) mantém o painel de análise
+    # interativo nos reruns e fica disponível em «Minhas tarefas».
+    c1, c2 = st.columns([1, 0.4])
+    with c1:
+        denormalised = st.checkbox(
+            "Incluir linhas de faturas desnormalizadas (NIF/nome/país do cliente e atributos do produto)",
+            value=False, key="saft_denormalised",
+        )
+    with c2:
+        encoding_label = st.selectbox("Codificação dos CSV", list(_SAFT_CSV_ENCODINGS.keys()), key="saft_encoding")
+
     if st.button("Processar SAF-T"):
-        try:
-            base_name, customers_csv, invoices_csv = parse_saft_xml_bytes(xml_bytes)
-        except Exception as e:
-            st.error(f"Erro ao analisar o ficheiro XML: {e}")
-            return
-        st.subheader("Preview Customers (primeiras 2000 chars)")
-        st.code(customers_csv[:2000], language='text')
-        st.subheader("Preview Invoices (primeiras 2000 chars)")
-        st.code(invoices_csv[:2000], language='text')
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            customers_filename = xml_name.rsplit('.', 1)[0] + "-Customers.csv"
-            invoices_filename = xml_name.rsplit('.', 1)[0] + "-Invoices.csv"
-            zf.writestr(customers_filename, customers_csv.encode('latin-1', errors='replace'))
-            zf.writestr(invoices_filename, invoices_csv.encode('latin-1', errors='replace'))
-        zip_buffer.seek(0)
-        st.download_button(
-            label="Descarregar CSVs (ZIP)",
-            data=zip_buffer.getvalue(),
-            file_name=f"{xml_name.rsplit('.',1)[0]}-CSVs.zip",
-            mime="application/zip"
+        key = f"{hashlib.sha1(xml_bytes).hexdigest()}:{xml_name}:{int(denormalised)}:{encoding_label}"
+        title = f"{xml_name} ({encoding_label}{', desnormalizado' if denormalised else ''})"
+        _submit_tool_job(
+            "saft", title, key,
+            functools.partial(_saft_job, base_name=_saft_base_name(xml_name),
+                              encoding=_SAFT_CSV_ENCODINGS[encoding_label], denormalised=denormalised),
+            {"input.xml": xml_bytes},
         )
 
+    job = _tool_job("saft")
+    if job is not None:
+        _render_tool_job(job, _render_saft_job)
+
 # ========================================
 # OrangeHRM Timesheets Pivot
 # ========================================
@@ -811,7 +1687,7 @@ def _oauth_token_exchange_with_pkce(token_url: str, client_id: str, code: str, r
         "redirect_uri": redirect_uri,
         "code_verifier": code_verifier,
     }
-    r = requests.post(token_url, data=data, timeout=30)
+    r = _orangehrm_http().request("POST", token_url, data=data, timeout=30)
     ctype = r.headers.get("Content-Type", "")
     body = r.json() if "application/json" in ctype else {"raw": r.text}
     return r.status_code, body
@@ -827,89 +1703,675 @@ def _get_setting(key: str, default: str = "") -> str:
         return sv.strip() if isinstance(sv, str) else sv
     except Exception:
         return default
-        
-class _OrangeHRMClient:
-    def __init__(self, client_id: str, refresh_token: str, token_url: str, api_base: str):
-        self.client_id = client_id
-        self.token_url = token_url
-        self.api_base = api_base
 
-        if "orange_access_token" not in st.session_state:
-            st.session_state["orange_access_token"] = ""
-        if "orange_expires_at" not in st.session_state:
-            st.session_state["orange_expires_at"] = 0.0
-        if "orange_refresh_token" not in st.session_state:
-            st.session_state["orange_refresh_token"] = ""
+def _orangehrm_cache_dir() -> str:
+    """Diretório para caches persistentes do OrangeHRM (ORANGEHRM_CACHE_DIR; montar como volume em produção)."""
+    path = _get_setting("cache_dir") or os.path.join(tempfile.gettempdir(), "inobest-orangehrm")
+    os.makedirs(path, exist_ok=True)
+    return path
 
-        # Novo: refresh_token partilhado por ficheiro (com fallback às envs)
-        refresh_token_env = refresh_token  # vem das envs
-        shared_path = os.getenv("ORANGEHRM_REFRESH_TOKEN_FILE", "")
-        self._shared_rt_path = shared_path
-        rt = _read_shared_refresh_token(shared_path, refresh_token_env)
-        st.session_state["orange_refresh_token"] = rt
+class _PooledHTTP:
+    """
+    Cliente HTTP partilhado pelo processo para o OrangeHRM.
+    Cada thread tem a sua requests.Session, mas todas montam o mesmo HTTPAdapter,
+    cujo pool (urllib3) é thread-safe: as ligações TCP/TLS ficam abertas (keep-alive)
+    e são reutilizadas entre pedidos, sessões Streamlit e threads.
+    """
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self._adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = requests.Session()
+            s.mount("https://", self._adapter)
+            s.mount("http://", self._adapter)
+            s.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+            self._local.session = s
+        return s
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        return self._session().request(method, url, **kwargs)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Por host: pedidos feitos, ligações abertas e quantos pedidos reutilizaram uma ligação."""
+        rows: List[Dict[str, Any]] = []
+        pools = self._adapter.poolmanager.pools
+        with self._lock:
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                n_req = getattr(pool, "num_requests", 0)
+                n_conn = getattr(pool, "num_connections", 0)
+                rows.append({
+                    "host": f"{key.key_scheme}://{key.key_host}:{key.key_port or ''}".rstrip(":"),
+                    "pedidos": n_req,
+                    "ligacoes": n_conn,
+                    "reutilizados": max(n_req - n_conn, 0),
+                    "taxa_reutilizacao": round(1 - n_conn / n_req, 3) if n_req else 0.0,
+                    "pool_maxsize": self.pool_size,
+                })
+        return rows
 
-    @property
-    def access_token(self) -> str:
-        return st.session_state["orange_access_token"]
+@st.cache_resource(show_spinner=False)
+def _orangehrm_http_pool(pool_size: int) -> _PooledHTTP:
+    return _PooledHTTP(pool_size)
 
-    @property
-    def refresh_token(self) -> str:
-        return st.session_state["orange_refresh_token"]
+def _orangehrm_http() -> _PooledHTTP:
+    """Pool HTTP do processo (tamanho em ORANGEHRM_HTTP_POOL_SIZE, por omissão 16)."""
+    try:
+        pool_size = int(_get_setting("http_pool_size") or 16)
+    except (TypeError, ValueError):
+        pool_size = 16
+    return _orangehrm_http_pool(max(pool_size, 1))
+
+class _HostRateLimiter:
+    """Token bucket por host (pedidos/segundo), partilhado por todas as threads do processo."""
+    def __init__(self, rate_per_sec: float, burst: int):
+        self.rate = rate_per_sec
+        self.burst = max(burst, 1)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host: str):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (float(self.burst), now))
+                tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+                if tokens >= 1.0:
+                    self._buckets[host] = (tokens - 1.0, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1.0 - tokens) / self.rate
+            time.sleep(wait)
 
-    @property
-    def expires_at(self) -> float:
-        return st.session_state["orange_expires_at"]
+@st.cache_resource(show_spinner=False)
+def _orangehrm_rate_limiter_for(rate_per_sec: float, burst: int) -> _HostRateLimiter:
+    return _HostRateLimiter(rate_per_sec, burst)
 
-    def _save_tokens(self, token_resp: dict):
-        st.session_state["orange_access_token"] = token_resp["access_token"]
-        if "refresh_token" in token_resp and token_resp["refresh_token"]:
-            st.session_state["orange_refresh_token"] = token_resp["refresh_token"]
-            # Novo: escrever no armazenamento partilhado
-            _write_shared_refresh_token(self._shared_rt_path, token_resp["refresh_token"])
-        expires_in = int(token_resp.get("expires_in", 3600))
-        st.session_state["orange_expires_at"] = time.time() + max(expires_in - 60, 0)
+def _orangehrm_rate_limiter() -> _HostRateLimiter:
+    """Limite por host em ORANGEHRM_RATE_LIMIT_RPS (por omissão 100/s; 0 desliga)."""
+    try:
+        rate = float(_get_setting("rate_limit_rps") or 100)
+    except (TypeError, ValueError):
+        rate = 100.0
+    return _orangehrm_rate_limiter_for(rate, max(int(rate), 1))
 
-    def _needs_refresh(self) -> bool:
-        return (not self.access_token) or time.time() >= self.expires_at
+class _AdaptiveConcurrencyLimiter:
+    """
+    Limite de pedidos em voo por host, ajustado em AIMD:
+    - cada resposta rápida e bem-sucedida soma 1/limite (≈ +1 por "janela" de pedidos);
+    - um 429 corta o limite para metade, uma latência muito acima da base corta 10%
+      (só pedidos enviados depois do último corte contam, para uma rajada de 429 não o
+      levar logo a 1);
+    - o limite só sobe quando está de facto a ser usado por inteiro.
+    """
+    def __init__(self, initial: int, max_limit: int, latency_tolerance: float = 3.0):
+        self.max_limit = max(max_limit, 1)
+        self.limit = float(min(max(initial, 1), self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.base_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, started: float, throttled: bool = False):
+        """`started` é o time.monotonic() do envio do pedido."""
+        with self._cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            now = time.monotonic()
+            latency = now - started
+            if self.base_latency is None or latency < self.base_latency:
+                self.base_latency = latency
+            else:
+                # a base acompanha devagar subidas duradouras (ex.: servidor mais lento de dia)
+                self.base_latency += 0.01 * (latency - self.base_latency)
+            slow = latency > self.latency_tolerance * self.base_latency and latency > 0.05
+            if throttled or slow:
+                if started >= self._last_decrease:
+                    self.limit = max(1.0, self.limit * (0.5 if throttled else 0.9))
+                    self._last_decrease = now
+            elif saturated:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+class _CircuitOpenError(RuntimeError):
+    pass
+
+class _CircuitBreaker:
+    """
+    Disjuntor por host: após `threshold` falhas seguidas (erro de ligação ou 5xx) abre
+    durante `cooldown` segundos e os pedidos falham logo; depois deixa passar um pedido
+    de teste (meio-aberto) e fecha se este correr bem.
+    """
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(threshold, 1)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
 
-    def _refresh(self) -> bool:
-        # Novo: re-sync com armazenamento partilhado antes de chamar o token endpoint
-        path = getattr(self, "_shared_rt_path", "")
-        current_rt = _read_shared_refresh_token(path, st.session_state.get("orange_refresh_token", ""))
-        if current_rt and current_rt != st.session_state.get("orange_refresh_token"):
-            st.session_state["orange_refresh_token"] = current_rt
+    @property
+    def state(self) -> str:
+        if self.failures < self.threshold:
+            return "fechado"
+        return "meio-aberto" if time.monotonic() - self.opened_at >= self.cooldown else "aberto"
+
+    def check(self, host: str):
+        with self._lock:
+            if self.failures < self.threshold:
+                return
+            remaining = self.cooldown - (time.monotonic() - self.opened_at)
+            if remaining > 0 or self._probing:
+                raise _CircuitOpenError(
+                    f"OrangeHRM ({host}) indisponível após {self.failures} falhas seguidas; "
+                    f"nova tentativa dentro de {max(int(remaining), 1)}s."
+                )
+            self._probing = True
 
-        if not self.refresh_token:
-            return False
-        data = {
-            "grant_type": "refresh_token",
-            "client_id": self.client_id,
-            "refresh_token": self.refresh_token,
-        }
-        r = requests.post(self.token_url, data=data, timeout=30)
-        if r.ok:
-            self._save_tokens(r.json())
-            return True
-        else:
-            st.warning(f"Falha ao renovar token ({r.status_code}): {r.text}")
-            return False
+    def record(self, ok: bool):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+class _HostResilience:
+    """Limitador adaptativo e disjuntor de cada host, partilhados pelo processo."""
+    def __init__(self, initial: int, max_limit: int, threshold: int, cooldown: float):
+        self.initial, self.max_limit = initial, max_limit
+        self.threshold, self.cooldown = threshold, cooldown
+        self._hosts: Dict[str, Tuple[_AdaptiveConcurrencyLimiter, _CircuitBreaker]] = {}
+        self._lock = threading.Lock()
+
+    def for_host(self, host: str) -> Tuple[_AdaptiveConcurrencyLimiter, _CircuitBreaker]:
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = (
+                    _AdaptiveConcurrencyLimiter(self.initial, self.max_limit),
+                    _CircuitBreaker(self.threshold, self.cooldown),
+                )
+            return self._hosts[host]
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = list(self._hosts.items())
+        return [{
+            "host": host,
+            "limite_concorrencia": round(limiter.limit, 1),
+            "em_voo": limiter.in_flight,
+            "latencia_base_ms": round((limiter.base_latency or 0.0) * 1000, 1),
+            "disjuntor": breaker.state,
+            "falhas_seguidas": breaker.failures,
+        } for host, (limiter, breaker) in items]
+
+@st.cache_resource(show_spinner=False)
+def _orangehrm_resilience_for(initial: int, max_limit: int, threshold: int, cooldown: float) -> _HostResilience:
+    return _HostResilience(initial, max_limit, threshold, cooldown)
+
+def _orangehrm_resilience() -> _HostResilience:
+    """
+    Concorrência adaptativa até ORANGEHRM_MAX_CONCURRENCY (por omissão 32) e disjuntor
+    com ORANGEHRM_CIRCUIT_THRESHOLD falhas (por omissão 5) / ORANGEHRM_CIRCUIT_COOLDOWN s (por omissão 30).
+    """
+    try:
+        max_limit = max(int(_get_setting("max_concurrency") or 32), 1)
+        threshold = int(_get_setting("circuit_threshold") or 5)
+        cooldown = float(_get_setting("circuit_cooldown") or 30)
+    except (TypeError, ValueError):
+        max_limit, threshold, cooldown = 32, 5, 30.0
+    return _orangehrm_resilience_for(min(_orangehrm_fetch_concurrency(), max_limit), max_limit, threshold, cooldown)
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+_IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+def _orangehrm_max_retries() -> int:
+    """Tentativas extra em 429/5xx/erros de rede (ORANGEHRM_MAX_RETRIES, por omissão 4)."""
+    try:
+        return max(int(_get_setting("max_retries") or 4), 0)
+    except (TypeError, ValueError):
+        return 4
+
+def _retry_after_seconds(resp: requests.Response) -> Optional[float]:
+    """Retry-After em segundos (aceita número ou data HTTP); None se ausente/inválido."""
+    value = (resp.headers.get("Retry-After") or "").strip()
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, IndexError):
+        return None
 
-    def _ensure_token(self):
-        if self._needs_refresh():
-            ok = self._refresh()
-            if not ok:
-                raise RuntimeError("Não foi possível obter token de acesso (refresh falhou).")
+def _backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Backoff exponencial com "full jitter" (evita que as threads repitam todas ao mesmo tempo)."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
 
-    def request(self, method: str, path: str, retry_on_401: bool = True, **kwargs):
-        self._ensure_token()
-        url = path if path.startswith("http") else self.api_base + path.lstrip("/")
+def _orangehrm_fetch_concurrency() -> int:
+    """Número máximo de pedidos em paralelo por recolha (ORANGEHRM_FETCH_CONCURRENCY, por omissão 16)."""
+    try:
+        return max(int(_get_setting("fetch_concurrency") or 16), 1)
+    except (TypeError, ValueError):
+        return 16
+
+def _fetch_concurrently(fn, items: List[Any], max_workers: Optional[int] = None) -> List[Any]:
+    """
+    Aplica fn a cada item num pool de threads limitado e devolve os resultados pela ordem
+    dos itens (determinística). As threads herdam o contexto do script Streamlit para
+    poderem usar st.session_state / st.warning como o código sequencial.
+    """
+    items = list(items)
+    workers = min(max_workers or _orangehrm_fetch_concurrency(), len(items))
+    if workers <= 1:
+        return [fn(it) for it in items]
+    ctx = get_script_run_ctx() if get_script_run_ctx else None
+
+    def _attach_ctx():
+        if ctx is not None and add_script_run_ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    with ThreadPoolExecutor(max_workers=workers, initializer=_attach_ctx) as ex:
+        return list(ex.map(fn, items))
+
+def _start_daemon_thread(target, name: str) -> threading.Thread:
+    """Thread em segundo plano; herda o contexto do script atual (se existir) para poder usar st.*."""
+    t = threading.Thread(target=target, name=name, daemon=True)
+    ctx = get_script_run_ctx() if get_script_run_ctx else None
+    if ctx is not None and add_script_run_ctx is not None:
+        add_script_run_ctx(t, ctx)
+    t.start()
+    return t
+
+# =============================
+# Métricas HTTP por endpoint (painel de diagnóstico + ficheiro para o node exporter)
+# =============================
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _endpoint_template(url: str) -> str:
+    """URL -> template estável para agrupar métricas ("time/employees/{n}/timesheets")."""
+    path = urlsplit(url).path
+    for marker in ("/api/v2/", "/index.php/"):
+        if marker in path:
+            path = path.split(marker, 1)[1]
+            break
+    return re.sub(r"/\d+(?=/|$)", "/{n}", path.strip("/")) or "/"
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+class _EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.statuses: Dict[str, int] = {}
+        self.bytes = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.samples: deque = deque(maxlen=2048)  # janela recente para p50/p95/p99
+
+class _HTTPMetrics:
+    """
+    Contadores por (método, template de endpoint): pedidos, códigos de estado, bytes,
+    retries, cache hits e latências (histograma cumulativo + janela para percentis).
+    Com ORANGEHRM_METRICS_FILE, uma thread grava-os periodicamente (escrita atómica):
+    em JSON se o ficheiro terminar em .json, senão no formato de texto Prometheus
+    (para o textfile collector do node exporter).
+    """
+    def __init__(self, path: str = "", flush_interval: float = 30.0):
+        self.path = path
+        self.flush_interval = max(flush_interval, 1.0)
+        self.started_at = time.time()
+        self.last_flush_at = 0.0
+        self.last_flush_error = ""
+        self._stats: Dict[Tuple[str, str], _EndpointStats] = {}
+        self._lock = threading.Lock()
+        if path:
+            threading.Thread(target=self._flush_loop, name="orangehrm-metrics", daemon=True).start()
+
+    def _get(self, method: str, template: str) -> _EndpointStats:
+        key = (method.upper(), template)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = _EndpointStats()
+        return stats
+
+    def observe(self, method: str, url: str, status: Any, latency: float, nbytes: int = 0, retry: bool = False):
+        """Uma tentativa HTTP (`status` é o código ou o nome da exceção de rede)."""
+        template = _endpoint_template(url)
+        i = next((n for n, b in enumerate(_LATENCY_BUCKETS) if latency <= b), len(_LATENCY_BUCKETS))
+        with self._lock:
+            stats = self._get(method, template)
+            stats.count += 1
+            stats.statuses[str(status)] = stats.statuses.get(str(status), 0) + 1
+            stats.bytes += nbytes
+            stats.retries += 1 if retry else 0
+            stats.latency_sum += latency
+            stats.buckets[i] += 1
+            stats.samples.append(latency)
+
+    def cache_hit(self, template: str, n: int = 1, method: str = "GET"):
+        """Pedidos evitados por caches (catálogo, store local, índice de identidades, ...)."""
+        if n <= 0:
+            return
+        with self._lock:
+            self._get(method, template).cache_hits += n
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = [(k, s, sorted(s.samples)) for k, s in self._stats.items()]
+        rows = []
+        for (method, template), s, lat in sorted(items, key=lambda it: -it[1].count):
+            rows.append({
+                "endpoint": template,
+                "metodo": method,
+                "pedidos": s.count,
+                "p50_ms": round(_percentile(lat, 0.50) * 1000, 1),
+                "p95_ms": round(_percentile(lat, 0.95) * 1000, 1),
+                "p99_ms": round(_percentile(lat, 0.99) * 1000, 1),
+                "kb": round(s.bytes / 1024, 1),
+                "estados": ", ".join(f"{k}: {v}" for k, v in sorted(s.statuses.items())),
+                "retries": s.retries,
+                "cache_hits": s.cache_hits,
+            })
+        return rows
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            items = [(k, s, dict(s.statuses), list(s.buckets)) for k, s in self._stats.items()]
+        lines = [
+            "# HELP orangehrm_http_requests_total Pedidos HTTP ao OrangeHRM por endpoint e estado.",
+            "# TYPE orangehrm_http_requests_total counter",
+        ]
+        for (method, template), _s, statuses, _b in items:
+            for status, n in sorted(statuses.items()):
+                lines.append(f'orangehrm_http_requests_total{{method="{method}",endpoint="{template}",status="{status}"}} {n}')
+        lines += [
+            "# HELP orangehrm_http_request_duration_seconds Latência dos pedidos HTTP ao OrangeHRM.",
+            "# TYPE orangehrm_http_request_duration_seconds histogram",
+        ]
+        for (method, template), s, _st, buckets in items:
+            labels = f'method="{method}",endpoint="{template}"'
+            acc = 0
+            for bound, n in zip(_LATENCY_BUCKETS, buckets):
+                acc += n
+                lines.append(f'orangehrm_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {acc}')
+            lines.append(f'orangehrm_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {s.count}')
+            lines.append(f"orangehrm_http_request_duration_seconds_sum{{{labels}}} {s.latency_sum:.6f}")
+            lines.append(f"orangehrm_http_request_duration_seconds_count{{{labels}}} {s.count}")
+        for name, attr, help_text in (
+            ("orangehrm_http_response_bytes_total", "bytes", "Bytes recebidos do OrangeHRM."),
+            ("orangehrm_http_retries_total", "retries", "Tentativas repetidas (429/5xx/erros de rede)."),
+            ("orangehrm_cache_hits_total", "cache_hits", "Pedidos evitados por caches locais."),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (method, template), s, _st, _b in items:
+                lines.append(f'{name}{{method="{method}",endpoint="{template}"}} {getattr(s, attr)}')
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        if not self.path:
+            return
+        if self.path.endswith(".json"):
+            body = json.dumps({"started_at": self.started_at, "written_at": time.time(), "endpoints": self.snapshot()}, indent=2)
+        else:
+            body = self.to_prometheus()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(tmp, self.path)  # o collector nunca lê um ficheiro a meio
+        self.last_flush_at = time.time()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                self.last_flush_error = ""
+            except OSError as e:
+                self.last_flush_error = str(e)
+
+@st.cache_resource(show_spinner=False)
+def _orangehrm_metrics_for(path: str, flush_interval: float) -> _HTTPMetrics:
+    return _HTTPMetrics(path, flush_interval)
+
+def _orangehrm_metrics() -> _HTTPMetrics:
+    """Métricas do processo; ficheiro em ORANGEHRM_METRICS_FILE, gravado a cada ORANGEHRM_METRICS_FLUSH_INTERVAL s (30)."""
+    try:
+        interval = float(_get_setting("metrics_flush_interval") or 30)
+    except (TypeError, ValueError):
+        interval = 30.0
+    return _orangehrm_metrics_for(_get_setting("metrics_file") or "", interval)
+
+class _OrangeHRMTokenManager:
+    """
+    Access token único por processo, partilhado por todas as sessões.
+    - Renovação single-flight: um threading.Lock no processo e um lock de ficheiro
+      ({ORANGEHRM_REFRESH_TOKEN_FILE}.lock) entre processos/réplicas.
+    - Dentro do lock relê o ficheiro partilhado: se outro processo já renovou, reutiliza
+      o token dele em vez de gastar (e invalidar) o refresh token rotativo.
+    - Renovação proativa quando faltam menos de `margin` segundos: uma só thread renova,
+      as restantes continuam com o token atual (ainda válido).
+    """
+    def __init__(self, client_id: str, token_url: str, shared_path: str, refresh_token: str, margin: float):
+        self.client_id = client_id
+        self.token_url = token_url
+        self.shared_path = shared_path
+        self.margin = max(margin, 0.0)
+        self.refresh_token = _read_shared_refresh_token(shared_path, refresh_token)
+        self.access_token = ""
+        self.expires_at = 0.0
+        self.refresh_count = 0
+        self.last_error = ""
+        self._lock = threading.Lock()
+        self._adopt_shared(_read_shared_token_state(shared_path))
+
+    def _adopt_shared(self, data: Dict[str, Any]) -> bool:
+        """Usa o access token do ficheiro partilhado se ainda estiver fora da margem de renovação."""
+        rt = data.get("refresh_token")
+        if rt and isinstance(rt, str):
+            self.refresh_token = rt.strip()
+        at, exp = data.get("access_token"), data.get("expires_at")
+        if at and isinstance(exp, (int, float)) and time.time() < float(exp) - self.margin:
+            self.access_token, self.expires_at = at, float(exp)
+            return True
+        return False
+
+    def _file_lock(self):
+        if not self.shared_path or fcntl is None:
+            return None
+        try:
+            os.makedirs(os.path.dirname(self.shared_path) or ".", exist_ok=True)
+            fh = open(f"{self.shared_path}.lock", "a+")
+        except OSError:
+            return None
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        return fh
+
+    def _refresh_locked(self, seen_token: str) -> bool:
+        # Outra thread já renovou enquanto esperávamos pelo lock
+        if self.access_token and self.access_token != seen_token and time.time() < self.expires_at:
+            return True
+        fh = self._file_lock()
+        try:
+            if self._adopt_shared(_read_shared_token_state(self.shared_path)) and self.access_token != seen_token:
+                _orangehrm_metrics().cache_hit(_endpoint_template(self.token_url), method="POST")
+                return True
+            if not self.refresh_token:
+                self.last_error = "Sem refresh token configurado."
+                return False
+            data = {
+                "grant_type": "refresh_token",
+                "client_id": self.client_id,
+                "refresh_token": self.refresh_token,
+            }
+            started = time.monotonic()
+            try:
+                r = _orangehrm_http().request("POST", self.token_url, data=data, timeout=30)
+            except requests.RequestException as e:
+                _orangehrm_metrics().observe("POST", self.token_url, type(e).__name__, time.monotonic() - started)
+                raise
+            _orangehrm_metrics().observe("POST", self.token_url, r.status_code, time.monotonic() - started, len(r.content))
+            self.refresh_count += 1
+            if not r.ok:
+                self.last_error = f"HTTP {r.status_code}: {r.text[:500]}"
+                return False
+            token_resp = r.json()
+            if token_resp.get("refresh_token"):
+                self.refresh_token = token_resp["refresh_token"]
+            self.access_token = token_resp["access_token"]
+            self.expires_at = time.time() + int(token_resp.get("expires_in", 3600))
+            self.last_error = ""
+            _write_shared_refresh_token(self.shared_path, self.refresh_token, self.access_token, self.expires_at)
+            return True
+        finally:
+            if fh is not None:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
+
+    def refresh(self, seen_token: str = "") -> bool:
+        """Renova (single-flight). `seen_token` é o token que falhou: se já mudou, não renova."""
+        with self._lock:
+            return self._refresh_locked(seen_token)
+
+    def get_access_token(self) -> str:
+        token, remaining = self.access_token, self.expires_at - time.time()
+        if token and remaining > self.margin:
+            return token
+        if token and remaining > 0:
+            # Proativo: só quem apanhar o lock renova; os outros seguem com o token atual
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._refresh_locked(token)
+                except requests.RequestException as e:
+                    self.last_error = str(e)
+                finally:
+                    self._lock.release()
+            return self.access_token
+        if not self.refresh(token):
+            raise RuntimeError(f"Não foi possível obter token de acesso (refresh falhou). {self.last_error}".strip())
+        return self.access_token
+
+@st.cache_resource(show_spinner=False)
+def _orangehrm_token_manager_for(token_url: str, client_id: str, shared_path: str,
+                                 refresh_token: str, margin: float) -> _OrangeHRMTokenManager:
+    return _OrangeHRMTokenManager(client_id, token_url, shared_path, refresh_token, margin)
+
+def _orangehrm_token_manager(client_id: str, token_url: str, refresh_token: str) -> _OrangeHRMTokenManager:
+    """Gestor de tokens do processo; margem de renovação em ORANGEHRM_TOKEN_REFRESH_MARGIN (s, por omissão 120)."""
+    try:
+        margin = float(_get_setting("token_refresh_margin") or 120)
+    except (TypeError, ValueError):
+        margin = 120.0
+    shared_path = os.getenv("ORANGEHRM_REFRESH_TOKEN_FILE", "")
+    # O refresh token das envs só serve de semente: não entra na chave para que todas
+    # as sessões partilhem o mesmo gestor mesmo depois de o token rodar.
+    manager = _orangehrm_token_manager_for(token_url, client_id, shared_path, "", margin)
+    if not manager.refresh_token and refresh_token:
+        manager.refresh_token = refresh_token.strip()
+    return manager
+
+class _OrangeHRMClient:
+    def __init__(self, client_id: str, refresh_token: str, token_url: str, api_base: str):
+        self.client_id = client_id
+        self.token_url = token_url
+        self.api_base = api_base
+        self.http = _orangehrm_http()
+        self.rate_limiter = _orangehrm_rate_limiter()
+        self.resilience = _orangehrm_resilience()
+        self.max_retries = _orangehrm_max_retries()
+        self.metrics = _orangehrm_metrics()
+        # Tokens partilhados pelo processo (refresh_token das envs como semente)
+        self.tokens = _orangehrm_token_manager(client_id, token_url, refresh_token)
+
+    @property
+    def access_token(self) -> str:
+        return self.tokens.access_token
+
+    @property
+    def refresh_token(self) -> str:
+        return self.tokens.refresh_token
+
+    @property
+    def expires_at(self) -> float:
+        return self.tokens.expires_at
+
+    def _refresh(self) -> bool:
+        return self.tokens.refresh(self.tokens.access_token)
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Um pedido com retries: 429 (sempre) e 5xx/erros de rede (só métodos idempotentes)
+        são repetidos com backoff exponencial com jitter, respeitando Retry-After.
+        Passa pelo disjuntor, pelo limite adaptativo de concorrência e pelo rate limit do host.
+        """
+        host = urlsplit(url).netloc
+        limiter, breaker = self.resilience.for_host(host)
+        retryable = method.upper() in _IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            breaker.check(host)
+            limiter.acquire()
+            self.rate_limiter.acquire(host)
+            started = time.monotonic()
+            resp = None
+            try:
+                resp = self.http.request(method, url, timeout=60, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.metrics.observe(method, url, type(e).__name__, time.monotonic() - started, retry=attempt > 0)
+                limiter.release(started)
+                breaker.record(False)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+            else:
+                self.metrics.observe(method, url, resp.status_code, time.monotonic() - started,
+                                     len(resp.content), retry=attempt > 0)
+                limiter.release(started, throttled=resp.status_code == 429)
+                breaker.record(resp.status_code < 500)
+                if resp.status_code not in _RETRY_STATUSES or attempt >= self.max_retries:
+                    return resp
+                if resp.status_code != 429 and not retryable:
+                    return resp
+            delay = _retry_after_seconds(resp) if resp is not None else None
+            time.sleep(min(delay, 60.0) if delay is not None else _backoff_delay(attempt))
+            attempt += 1
+
+    def request(self, method: str, path: str, retry_on_401: bool = True, **kwargs):
+        token = self.tokens.get_access_token()
+        url = path if path.startswith("http") else self.api_base + path.lstrip("/")
         headers = kwargs.pop("headers", {})
-        headers = {"Authorization": f"Bearer {self.access_token}", **headers}
-        resp = requests.request(method, url, headers=headers, timeout=60, **kwargs)
+        headers = {"Authorization": f"Bearer {token}", **headers}
+        resp = self._send(method, url, headers=headers, **kwargs)
         if resp.status_code == 401 and retry_on_401:
-            if self._refresh():
-                headers["Authorization"] = f"Bearer {self.access_token}"
-                resp = requests.request(method, url, headers=headers, timeout=60, **kwargs)
+            # Só renova se ninguém o fez entretanto com o token que falhou
+            if self.tokens.refresh(token):
+                headers["Authorization"] = f"Bearer {self.tokens.access_token}"
+                resp = self._send(method, url, headers=headers, **kwargs)
         resp.raise_for_status()
         ctype = resp.headers.get("Content-Type", "")
         return resp.json() if "application/json" in ctype else resp.text
@@ -917,24 +2379,56 @@ class _OrangeHRMClient:
 _PATH_LIST_EMPLOYEE_TIMESHEETS = "time/employees/{empNumber}/timesheets"
 _PATH_GET_TIMESHEET_ENTRIES    = "time/employees/timesheets/{timesheetId}/entries"
 
+def _response_rows(data: Any) -> List[Dict[str, Any]]:
+    if isinstance(data, dict) and isinstance(data.get("data"), list):
+        return data["data"]
+    if isinstance(data, list):
+        return data
+    return []
+
+def _paginate(
+    client: _OrangeHRMClient,
+    path: str,
+    params: Optional[Dict[str, Any]] = None,
+    limit: int = 200,
+    max_rows: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Todas as linhas de um endpoint de listagem (limit/offset).
+    Com meta.total na primeira página, as restantes são pedidas em paralelo de uma vez
+    (com o tamanho da primeira página, caso o servidor imponha um máximo abaixo de `limit`);
+    sem total, segue página a página até vir uma incompleta.
+    """
+    def _page(offset: int, size: int) -> List[Dict[str, Any]]:
+        return _response_rows(client.request("GET", path, params={**(params or {}), "limit": size, "offset": offset}))
+
+    first = client.request("GET", path, params={**(params or {}), "limit": limit, "offset": 0})
+    rows = list(_response_rows(first))
+    meta = first.get("meta") if isinstance(first, dict) else None
+    total = meta.get("total") if isinstance(meta, dict) else None
+    if isinstance(total, str) and total.isdigit():
+        total = int(total)
+
+    if isinstance(total, int):
+        end = min(total, max_rows) if max_rows else total
+        if rows and end > len(rows):
+            page_size = len(rows)
+            offsets = list(range(page_size, end, page_size))
+            for page in _fetch_concurrently(lambda off: _page(off, page_size), offsets):
+                rows.extend(page)
+    elif len(rows) >= limit:
+        offset = limit
+        while max_rows is None or len(rows) < max_rows:
+            page = _page(offset, limit)
+            rows.extend(page)
+            if len(page) < limit:
+                break
+            offset += limit
+    return rows[:max_rows] if max_rows else rows
+
 # Employees helpers
 def _list_all_employees(client: _OrangeHRMClient, limit: int = 200) -> List[Dict[str, Any]]:
-    results, offset = [], 0
-    while True:
-        params = {"limit": limit, "offset": offset}
-        data = client.request("GET", "pim/employees?includeEmployees=currentAndPast", params=params)
-        rows = []
-        if isinstance(data, dict) and "data" in data and isinstance(data["data"], list):
-            rows = data["data"]
-        elif isinstance(data, list):
-            rows = data
-        else:
-            break
-        results.extend(rows)
-        if len(rows) < limit:
-            break
-        offset += limit
-    return results
+    return _paginate(client, "pim/employees", {"includeEmployees": "currentAndPast"}, limit=limit)
 
 def _full_name_from_employee_row(e: Dict[str, Any]) -> str:
     first  = (e.get("firstName")  or "").strip()
@@ -955,16 +2449,6 @@ def _build_empnumber_to_name_map(employees: List[Dict[str, Any]]) -> Dict[str, s
             mapping[str(emp_no)] = _full_name_from_employee_row(e)
     return mapping
 
-def _list_employee_timesheets(client: _OrangeHRMClient, emp_number: str, from_date: str = None, to_date: str = None, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
-    path = _PATH_LIST_EMPLOYEE_TIMESHEETS.format(empNumber=emp_number)
-    params = {"limit": limit, "offset": offset}
-    if from_date: params["fromDate"] = from_date
-    if to_date:   params["toDate"]   = to_date
-    data = client.request("GET", path, params=params)
-    if isinstance(data, dict) and "data" in data: return data["data"]
-    if isinstance(data, list): return data
-    return []
-
 def _get_timesheet_entries(client: _OrangeHRMClient, timesheet_id: str) -> List[Dict[str, Any]]:
     path = _PATH_GET_TIMESHEET_ENTRIES.format(timesheetId=timesheet_id)
     data = client.request("GET", path)
@@ -972,58 +2456,39 @@ def _get_timesheet_entries(client: _OrangeHRMClient, timesheet_id: str) -> List[
     if isinstance(data, list): return data
     return []
 
-def _sum_timesheet_hours(entries: List[Dict[str, Any]]) -> float:
-    total_hours = 0.0
-    for e in entries:
-        t = e.get("total", {})
-        h = t.get("hours"); m = t.get("minutes")
-        if isinstance(h, (int, float)):
-            add = float(h)
-            if isinstance(m, (int, float)) and m:
-                add += float(m) / 60.0
-            total_hours += add
-            continue
-        dates = e.get("dates", {})
-        for _, d in dates.items():
-            dur = d.get("duration")
-            if isinstance(dur, str) and ":" in dur:
-                hh, mm = dur.split(":", 1)
-                try:
-                    total_hours += int(hh) + int(mm) / 60.0
-                except Exception:
-                    pass
-            elif isinstance(dur, (int, float)):
-                total_hours += float(dur)
-    return round(total_hours, 2)
+def _list_all_employee_timesheets(client: _OrangeHRMClient, emp_number: str, from_date: str = None, to_date: str = None) -> List[Dict[str, Any]]:
+    params = {}
+    if from_date: params["fromDate"] = from_date
+    if to_date:   params["toDate"]   = to_date
+    return _paginate(client, _PATH_LIST_EMPLOYEE_TIMESHEETS.format(empNumber=emp_number), params, limit=50)
+
+def _fetch_timesheets_with_entries(
+    client: _OrangeHRMClient,
+    emp_numbers: List[str],
+    from_date: str = None,
+    to_date: str = None,
+) -> List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]]:
+    """
+    Recolha concorrente: lista as folhas de horas de todos os colaboradores em paralelo e
+    depois descarrega as entradas de todas as folhas em paralelo. Devolve
+    (empNumber, timesheet, entries) pela ordem colaborador → folha, como o ciclo sequencial.
+    """
+    sheets_per_emp = _fetch_concurrently(
+        lambda emp: _list_all_employee_timesheets(client, emp, from_date=from_date, to_date=to_date),
+        emp_numbers,
+    )
+    jobs: List[Tuple[str, Dict[str, Any], str]] = []
+    for emp, sheets in zip(emp_numbers, sheets_per_emp):
+        for ts in sheets:
+            ts_id = str(ts.get("id") or ts.get("timesheetId") or "")
+            if ts_id:
+                jobs.append((emp, ts, ts_id))
+    entries_per_sheet = _fetch_concurrently(lambda job: _get_timesheet_entries(client, job[2]), jobs)
+    return [(emp, ts, entries) for (emp, ts, _id), entries in zip(jobs, entries_per_sheet)]
 
 def _get_totals_by_employee_and_timesheet(client: _OrangeHRMClient, emp_numbers: List[str], empname_map: Dict[str, str], from_date: str = None, to_date: str = None) -> List[Dict[str, Any]]:
-    rows: List[Dict[str, Any]] = []
-    for emp in emp_numbers:
-        offset = 0
-        while True:
-            sheets = _list_employee_timesheets(client, emp, from_date=from_date, to_date=to_date, limit=50, offset=offset)
-            if not sheets:
-                break
-            for ts in sheets:
-                ts_id = str(ts.get("id") or ts.get("timesheetId"))
-                period_start = ts.get("startDate") or ts.get("fromDate")
-                period_end = ts.get("endDate") or ts.get("toDate")
-                if not ts_id:
-                    continue
-                entries = _get_timesheet_entries(client, ts_id)
-                total_hours = _sum_timesheet_hours(entries)
-                rows.append({
-                    "empNumber": emp,
-                    "empName": empname_map.get(str(emp), str(emp)),
-                    "timesheetId": ts_id,
-                    "periodStart": period_start,
-                    "periodEnd": period_end,
-                    "totalHours": total_hours,
-                })
-            if len(sheets) < 50:
-                break
-            offset += 50
-    return rows
+    dataset = _collect_timesheet_dataset(client, emp_numbers, from_date=from_date, to_date=to_date)
+    return _timesheet_totals_rows(dataset, empname_map)
 
 def _pivot_hours_by_employee_and_start(rows: List[Dict[str, Any]]) -> pd.DataFrame:
     if not rows:
@@ -1038,50 +2503,177 @@ def _pivot_hours_by_employee_and_start(rows: List[Dict[str, Any]]) -> pd.DataFra
         pass
     return pivot.sort_index()
 
-@st.cache_data(ttl=600, show_spinner=False)
+# A partir deste tamanho o diretório é renovado de forma incremental (só colaboradores novos)
+_DIRECTORY_INCREMENTAL_MIN = 1000
+
+class _EmployeeDirectory:
+    """
+    Diretório de colaboradores (pim/employees) partilhado pelas sessões do processo e gravado
+    em disco, por host + client_id (não muda quando o refresh token roda). Serve sempre o que
+    tem: quando passa de `ttl` segundos é renovado em segundo plano. Diretórios grandes são
+    renovados de forma incremental (ordem decrescente de empNumber até aparecer um conhecido),
+    com reconstrução completa a cada `full_ttl` segundos ou se o meta.total não bater certo.
+    """
+    def __init__(self, path: str, ttl: float, full_ttl: float = 86400.0):
+        self.path = path
+        self.ttl, self.full_ttl = ttl, full_ttl
+        self.built_at = 0.0  # última renovação (completa ou incremental)
+        self.full_built_at = 0.0
+        self.last_error = ""
+        self._employees: List[Dict[str, Any]] = []
+        self._snapshot: Tuple[List[Dict[str, Any]], Dict[str, str], List[str]] = ([], {}, [])
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()  # primeira construção: uma só recolha, as outras sessões esperam
+        self._refreshing = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f) or {}
+            self._set(list(data.get("employees") or []))
+            self.built_at = float(data.get("builtAt") or 0.0)
+            self.full_built_at = float(data.get("fullBuiltAt") or 0.0)
+        except Exception:
+            pass
+
+    def _save(self):
+        try:
+            tmp = f"{self.path}.tmp-{int(time.time()*1000)}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"builtAt": self.built_at, "fullBuiltAt": self.full_built_at, "employees": self._employees}, f)
+            os.replace(tmp, self.path)
+        except Exception:
+            pass
+
+    def _set(self, employees: List[Dict[str, Any]]):
+        emp_map = _build_empnumber_to_name_map(employees)
+        self._employees = employees
+        self._snapshot = (employees, emp_map, list(emp_map.keys()))
+
+    def snapshot(self) -> Tuple[List[Dict[str, Any]], Dict[str, str], List[str]]:
+        """(employees, empNumber -> nome, empNumbers); partilhado entre sessões, não alterar."""
+        return self._snapshot
+
+    def rebuild(self, client: _OrangeHRMClient):
+        employees = _list_all_employees(client, limit=200)
+        now = time.time()
+        with self._lock:
+            self._set(employees)
+            self.built_at = self.full_built_at = now
+            self._save()
+
+    def refresh_incremental(self, client: _OrangeHRMClient) -> bool:
+        """Acrescenta só os colaboradores novos; False se a instância não permitir (-> rebuild)."""
+        known = {str(e.get("empNumber")) for e in self._employees}
+        new: List[Dict[str, Any]] = []
+        total = None
+        offset, limit, last = 0, 50, None
+        while True:
+            data = client.request("GET", "pim/employees", params={
+                "includeEmployees": "currentAndPast", "sortField": "employee.empNumber", "sortOrder": "DESC",
+                "limit": limit, "offset": offset,
+            })
+            if total is None and isinstance(data, dict):
+                total = (data.get("meta") or {}).get("total")
+            rows = _response_rows(data)
+            numbers = [int(r["empNumber"]) for r in rows if str(r.get("empNumber", "")).isdigit()]
+            if numbers != sorted(numbers, reverse=True) or (last is not None and numbers and numbers[0] > last):
+                return False  # ordenação ignorada pelo servidor
+            last = numbers[-1] if numbers else last
+            fresh = [r for r in rows if str(r.get("empNumber")) not in known]
+            new.extend(fresh)
+            if len(fresh) < len(rows) or len(rows) < limit:
+                break
+            offset += limit
+        if total is None or int(total) != len(known) + len(new):
+            return False  # houve remoções (ou meta.total em falta): só a reconstrução é fiável
+        with self._lock:
+            self._set(self._employees + sorted(new, key=lambda r: int(r["empNumber"])))
+            self.built_at = time.time()
+            self._save()
+        return True
+
+    def refresh(self, client: _OrangeHRMClient):
+        incremental = (
+            len(self._employees) >= _DIRECTORY_INCREMENTAL_MIN
+            and time.time() - self.full_built_at < self.full_ttl
+        )
+        if not (incremental and self.refresh_incremental(client)):
+            self.rebuild(client)
+        self.last_error = ""
+
+    def ensure_fresh(self, client: _OrangeHRMClient):
+        """Vazio: constrói já (os erros propagam). Antigo: renova em segundo plano e serve o atual."""
+        if not self.built_at:
+            with self._build_lock:
+                if not self.built_at:
+                    self.rebuild(client)
+            return
+        if time.time() - self.built_at < self.ttl:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self.refresh(client)
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                self.built_at = time.time() - self.ttl + 60  # tenta de novo daqui a 1 minuto
+            finally:
+                self._refreshing = False
+
+        _start_daemon_thread(_run, "orangehrm-employee-directory")
+
+@st.cache_resource(show_spinner=False)
+def _employee_directory_for(path: str, ttl: float) -> _EmployeeDirectory:
+    return _EmployeeDirectory(path, ttl)
+
+def _employee_directory(domain: str, client_id: str) -> _EmployeeDirectory:
+    """Diretório do host + client_id (ORANGEHRM_EMPLOYEE_DIRECTORY_TTL, por omissão 600 s)."""
+    try:
+        ttl = float(_get_setting("employee_directory_ttl") or 600)
+    except (TypeError, ValueError):
+        ttl = 600.0
+    key = hashlib.sha1(f"{domain.rstrip('/')}|{client_id}".encode("utf-8")).hexdigest()[:12]
+    return _employee_directory_for(os.path.join(_orangehrm_cache_dir(), f"employees-{key}.json"), ttl)
+
 def _cached_employees_and_map(domain: str, client_id: str, refresh_token: str):
+    directory = _employee_directory(domain, client_id)
     api_base = domain.rstrip("/") + "/api/v2/"
     token_url = domain.rstrip("/") + "/oauth2/token"
-    client = _OrangeHRMClient(client_id, refresh_token, token_url, api_base)
-    emps = _list_all_employees(client, limit=200)
-    emp_map = _build_empnumber_to_name_map(emps)
-    emp_numbers = list(emp_map.keys())
-    return emps, emp_map, emp_numbers
-
-# Sum a single entry hours
-def _sum_entry_hours(entry: Dict[str, Any]) -> float:
-    t = entry.get("total", {})
-    h = t.get("hours"); m = t.get("minutes")
-    if isinstance(h, (int, float)):
-        add = float(h)
-        if isinstance(m, (int, float)) and m:
-            add += float(m) / 60.0
-        return add
-    total = 0.0
-    dates = entry.get("dates", {})
-    for _day, d in dates.items():
-        dur = d.get("duration")
-        if isinstance(dur, str) and ":" in dur:
-            try:
-                hh, mm = dur.split(":", 1)
-                total += int(hh) + int(mm) / 60.0
-            except Exception:
-                pass
-        elif isinstance(dur, (int, float)):
-            total += float(dur)
-    return total
+    directory.ensure_fresh(_OrangeHRMClient(client_id, refresh_token, token_url, api_base))
+    return directory.snapshot()
+
+# Durações "HH:MM" (ou numéricas, em horas) -> horas decimais, vetorizado.
+# Os valores repetem-se muito ("08:00", "04:00", ...): só os distintos são interpretados.
+def _duration_hours(durations: pd.Series, decimal_text: bool = False) -> pd.Series:
+    """
+    Durações -> horas (float). Números contam como horas; texto "H:MM" (o sinal aplica-se ao
+    total: "-1:30" = -1,5). Texto decimal ("7.50") só conta com decimal_text=True (relatórios);
+    nas entradas das folhas de horas, como antes, vale 0. Vazio, None ou inválido = 0.
+    """
+    codes, uniques = pd.factorize(durations)
+    uniq = pd.Series(uniques, dtype="object")
+    is_text = uniq.map(lambda v: isinstance(v, str))
+    numeric = pd.to_numeric(uniq.where(~is_text), errors="coerce")
+    hhmm = uniq.where(is_text).astype("string").str.extract(r"^\s*(-?)(\d+)\s*:\s*(\d+)\s*$")
+    sign = np.where(hhmm[0].eq("-").fillna(False).to_numpy(dtype=bool), -1.0, 1.0)
+    from_text = sign * (pd.to_numeric(hhmm[1], errors="coerce") + pd.to_numeric(hhmm[2], errors="coerce") / 60.0)
+    if decimal_text:
+        from_text = from_text.fillna(pd.to_numeric(uniq.where(is_text), errors="coerce"))  # "7.50"
+    hours = numeric.fillna(from_text).fillna(0.0).to_numpy(dtype="float64")
+    out = np.zeros(len(codes), dtype="float64")
+    out[codes >= 0] = hours[codes[codes >= 0]]
+    return pd.Series(out, index=durations.index)
 
 # Resolve project and customer by project id with cache
-def _resolve_project_names_and_customer(
-    client: _OrangeHRMClient,
-    project_id: Any,
-    cache: Dict[str, Dict[str, str]],
-) -> Tuple[str, str]:
+def _resolve_project_names_and_customer(client: _OrangeHRMClient, project_id: Any) -> Optional[Dict[str, str]]:
+    """Nomes de um projeto pedido individualmente; None se nenhum endpoint respondeu (não guardar em cache)."""
     pid = str(project_id)
-    if pid in cache:
-        d = cache[pid]
-        return d.get("projectName") or "Sem Projeto", d.get("customerName") or "Sem Cliente"
-    project_name, customer_name = "Sem Projeto", "Sem Cliente"
     endpoints = [f"time/projects/{pid}", f"projects/{pid}"]
     for ep in endpoints:
         try:
@@ -1089,17 +2681,854 @@ def _resolve_project_names_and_customer(
             if isinstance(data, dict):
                 proj = data.get("data") or data
                 if isinstance(proj, dict):
-                    project_name = proj.get("name") or proj.get("projectName") or project_name
-                    cust = proj.get("customer")
-                    if isinstance(cust, dict):
-                        customer_name = cust.get("name") or customer_name
-                    else:
-                        customer_name = proj.get("customerName") or customer_name
-                    break
+                    return _ProjectCatalogue._names(proj)
         except Exception:
             pass
-    cache[pid] = {"projectName": project_name, "customerName": customer_name}
-    return project_name, customer_name
+    return None
+
+class _ProjectCatalogue:
+    """
+    Catálogo projeto -> (nome, cliente) partilhado por todas as sessões do processo.
+    Carregado em bloco (paginado) a partir de time/projects e renovado ao fim de `ttl`
+    segundos; ids em falta são pedidos individualmente e acrescentados ao catálogo.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._projects: Dict[str, Dict[str, str]] = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()  # uma renovação de cada vez
+        self._update_lock = threading.Lock()  # troca do dict e acrescentos (curtos, sem pedidos HTTP)
+
+    def __contains__(self, project_id: Any) -> bool:
+        return str(project_id) in self._projects
+
+    @staticmethod
+    def _names(proj: Dict[str, Any]) -> Dict[str, str]:
+        cust = proj.get("customer")
+        customer_name = cust.get("name") if isinstance(cust, dict) else proj.get("customerName")
+        return {
+            "projectName": proj.get("name") or proj.get("projectName") or "Sem Projeto",
+            "customerName": customer_name or "Sem Cliente",
+        }
+
+    def refresh(self, client: _OrangeHRMClient, limit: int = 200):
+        projects: Dict[str, Dict[str, str]] = {}
+        for proj in _paginate(client, "time/projects", limit=limit):
+            if isinstance(proj, dict) and proj.get("id") is not None:
+                projects[str(proj["id"])] = self._names(proj)
+        with self._update_lock:
+            self._projects = projects
+        self._loaded_at = time.time()
+
+    def ensure_fresh(self, client: _OrangeHRMClient):
+        if time.time() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if time.time() - self._loaded_at < self.ttl:
+                return
+            try:
+                self.refresh(client)
+            except Exception:
+                # Sem listagem (permissões/erro): mantém o que há e tenta de novo daqui a 1 minuto
+                self._loaded_at = time.time() - self.ttl + 60
+
+    def lookup(self, client: _OrangeHRMClient, project_id: Any) -> Tuple[str, str]:
+        """Consulta em dict; pedido individual (time/projects/{id}) só para ids desconhecidos."""
+        pid = str(project_id)
+        names = self._projects.get(pid)
+        if names is None:
+            names = _resolve_project_names_and_customer(client, pid)
+            if names is None:
+                # Falha (timeout, 401, ...): não fica no catálogo partilhado, volta a ser pedido
+                return "Sem Projeto", "Sem Cliente"
+            self._remember(pid, names)
+        return names["projectName"], names["customerName"]
+
+    def _remember(self, pid: str, names: Dict[str, str]):
+        with self._update_lock:
+            self._projects[pid] = names
+
+    def customers_by_project_name(self) -> Dict[str, str]:
+        """Nome do projeto -> cliente, só para nomes que identificam um único projeto."""
+        out: Dict[str, str] = {}
+        ambiguous = set()
+        for names in list(self._projects.values()):
+            name = names["projectName"]
+            if name in out and out[name] != names["customerName"]:
+                ambiguous.add(name)
+            out[name] = names["customerName"]
+        for name in ambiguous:
+            del out[name]
+        return out
+
+@st.cache_resource(show_spinner=False)
+def _project_catalogue_for(api_base: str, ttl: float) -> _ProjectCatalogue:
+    return _ProjectCatalogue(ttl)
+
+def _project_catalogue(client: _OrangeHRMClient) -> _ProjectCatalogue:
+    """Catálogo do host do cliente (TTL em ORANGEHRM_PROJECT_CATALOGUE_TTL, por omissão 3600 s)."""
+    try:
+        ttl = float(_get_setting("project_catalogue_ttl") or 3600)
+    except (TypeError, ValueError):
+        ttl = 3600.0
+    return _project_catalogue_for(client.api_base, ttl)
+
+# =============================
+# Timesheet store (SQLite, sincronização incremental)
+# =============================
+
+# Estados em que as entradas já não mudam sem que o estado da folha mude também
+_IMMUTABLE_TIMESHEET_STATUSES = {"SUBMITTED", "APPROVED"}
+
+def _timesheet_status_id(ts: Dict[str, Any]) -> str:
+    status = ts.get("status")
+    if isinstance(status, dict):
+        status = status.get("id") or status.get("name")
+    return str(status or "").strip().upper()
+
+def _week_starts(from_date: str, to_date: str) -> List[str]:
+    """Segundas-feiras (ISO) das semanas que intersetam [from_date, to_date]."""
+    first = datetime.fromisoformat(from_date).date()
+    last = datetime.fromisoformat(to_date).date()
+    monday = first.toordinal() - first.weekday()
+    return [datetime.fromordinal(o).date().isoformat() for o in range(monday, last.toordinal() + 1, 7)]
+
+def _week_runs(weeks: List[str]) -> List[Tuple[str, str]]:
+    """Semanas (segundas, ordenadas) -> intervalos contíguos (segunda, domingo) para listar de uma vez."""
+    runs: List[Tuple[str, str]] = []
+    for w in weeks:
+        o = datetime.fromisoformat(w).toordinal()
+        if runs and datetime.fromisoformat(runs[-1][1]).toordinal() + 1 == o:
+            runs[-1] = (runs[-1][0], datetime.fromordinal(o + 6).date().isoformat())
+        else:
+            runs.append((w, datetime.fromordinal(o + 6).date().isoformat()))
+    return runs
+
+def _orangehrm_week_cache_ttl() -> float:
+    """Validade (s) das semanas já sincronizadas e fechadas (ORANGEHRM_WEEK_CACHE_TTL, por omissão 6 h; 0 desliga)."""
+    try:
+        return max(float(_get_setting("week_cache_ttl") or 21600), 0.0)
+    except (TypeError, ValueError):
+        return 21600.0
+
+class _TimesheetStore:
+    """
+    Cache local (SQLite) de folhas de horas e respetivas entradas (JSON tal como vem da API),
+    indexada por timesheetId. Guarda o estado e uma impressão digital do registo da listagem
+    para decidir se as entradas têm de ser descarregadas de novo.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS timesheets (
+                    timesheet_id TEXT PRIMARY KEY,
+                    emp_number TEXT NOT NULL,
+                    period_start TEXT,
+                    period_end TEXT,
+                    status TEXT,
+                    fingerprint TEXT,
+                    sheet_json TEXT,
+                    entries_json TEXT,
+                    entries_synced_at REAL,
+                    last_seen_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_timesheets_emp_period ON timesheets(emp_number, period_start)")
+            # Semanas (por colaborador) cuja listagem e entradas foram sincronizadas por completo
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS week_coverage (
+                    emp_number TEXT NOT NULL,
+                    week_start TEXT NOT NULL,
+                    synced_at REAL NOT NULL,
+                    PRIMARY KEY (emp_number, week_start)
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_states(self, ids: List[str]) -> Dict[str, Tuple[str, str]]:
+        """timesheetId -> (status, fingerprint) para as folhas já guardadas com entradas."""
+        out: Dict[str, Tuple[str, str]] = {}
+        with self._connect() as conn:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                q = ("SELECT timesheet_id, status, fingerprint FROM timesheets "
+                     f"WHERE entries_synced_at IS NOT NULL AND timesheet_id IN ({','.join('?' * len(chunk))})")
+                for ts_id, status, fp in conn.execute(q, chunk):
+                    out[ts_id] = (status or "", fp or "")
+        return out
+
+    def upsert(self, rows: List[Tuple[str, Dict[str, Any], Optional[List[Dict[str, Any]]], str]]):
+        """rows: (empNumber, timesheet, entries ou None se não mudaram, fingerprint)."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            for emp, ts, entries, fp in rows:
+                ts_id = str(ts.get("id") or ts.get("timesheetId"))
+                if entries is None:
+                    conn.execute("UPDATE timesheets SET last_seen_at=? WHERE timesheet_id=?", (now, ts_id))
+                    continue
+                params = (
+                    ts_id, str(emp),
+                    ts.get("startDate") or ts.get("fromDate"),
+                    ts.get("endDate") or ts.get("toDate"),
+                    _timesheet_status_id(ts), fp, json.dumps(ts), now,
+                )
+                conn.execute("""
+                    INSERT INTO timesheets (timesheet_id, emp_number, period_start, period_end, status,
+                                            fingerprint, sheet_json, last_seen_at, entries_json, entries_synced_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(timesheet_id) DO UPDATE SET
+                        emp_number=excluded.emp_number, period_start=excluded.period_start,
+                        period_end=excluded.period_end, status=excluded.status,
+                        fingerprint=excluded.fingerprint, sheet_json=excluded.sheet_json,
+                        last_seen_at=excluded.last_seen_at, entries_json=excluded.entries_json,
+                        entries_synced_at=excluded.entries_synced_at
+                """, params + (json.dumps(entries), now))
+
+    def delete_missing(self, emp_number: str, keep_ids: List[str], from_date: str = None, to_date: str = None):
+        """Remove folhas guardadas no intervalo que deixaram de aparecer na listagem (ex.: apagadas)."""
+        q = "DELETE FROM timesheets WHERE emp_number=?"
+        params: List[Any] = [str(emp_number)]
+        if from_date:
+            q += " AND period_end >= ?"; params.append(from_date)
+        if to_date:
+            q += " AND period_start <= ?"; params.append(to_date)
+        if keep_ids:
+            q += f" AND timesheet_id NOT IN ({','.join('?' * len(keep_ids))})"; params.extend(keep_ids)
+        with self._lock, self._connect() as conn:
+            conn.execute(q, params)
+
+    def delete_range(self, emp_numbers: List[str], from_date: str = None, to_date: str = None):
+        for emp in emp_numbers:
+            self.delete_missing(emp, [], from_date, to_date)
+        q = "DELETE FROM week_coverage WHERE emp_number=?"
+        bounds: List[Any] = []
+        if from_date:
+            q += " AND week_start >= ?"; bounds.append(_week_starts(from_date, from_date)[0])
+        if to_date:
+            q += " AND week_start <= ?"; bounds.append(to_date)
+        with self._lock, self._connect() as conn:
+            conn.executemany(q, [[str(emp)] + bounds for emp in emp_numbers])
+
+    def missing_weeks(self, emp_number: str, from_date: str, to_date: str, ttl: float) -> Tuple[List[str], int]:
+        """
+        Semanas do intervalo que têm de ser listadas de novo e nº de semanas servidas do store.
+        Uma semana só é reutilizada se já terminou, foi sincronizada há menos de `ttl` segundos
+        e todas as folhas guardadas que a intersetam estão submetidas/aprovadas.
+        """
+        weeks = _week_starts(from_date, to_date)
+        if ttl <= 0:
+            return weeks, 0
+        this_week = _week_starts(datetime.now().date().isoformat(), datetime.now().date().isoformat())[0]
+        with self._connect() as conn:
+            synced = {w for (w,) in conn.execute(
+                "SELECT week_start FROM week_coverage WHERE emp_number=? AND week_start >= ? AND week_start <= ? "
+                "AND synced_at >= ?", (str(emp_number), weeks[0], weeks[-1], time.time() - ttl))}
+            sheets = conn.execute(
+                "SELECT period_start, period_end, status FROM timesheets WHERE emp_number=? "
+                "AND period_end >= ? AND period_start <= ?",
+                (str(emp_number), weeks[0], datetime.fromordinal(
+                    datetime.fromisoformat(weeks[-1]).toordinal() + 6).date().isoformat())).fetchall()
+        open_weeks = set()
+        for start, end, status in sheets:
+            if (status or "") not in _IMMUTABLE_TIMESHEET_STATUSES and start and end:
+                open_weeks.update(_week_starts(start, end))
+        missing = [w for w in weeks if w >= this_week or w not in synced or w in open_weeks]
+        return missing, len(weeks) - len(missing)
+
+    def mark_covered(self, emp_number: str, ranges: List[Tuple[str, str]]):
+        """Regista as semanas dos intervalos (segunda, domingo) como sincronizadas agora."""
+        now = time.time()
+        rows = [(str(emp_number), w, now) for a, b in ranges for w in _week_starts(a, b)]
+        with self._lock, self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO week_coverage (emp_number, week_start, synced_at) VALUES (?, ?, ?)", rows)
+
+    def load(self, emp_numbers: List[str], from_date: str = None, to_date: str = None
+             ) -> List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]]:
+        """(empNumber, timesheet, entries) guardados, pela ordem colaborador → início do período."""
+        order = {str(e): i for i, e in enumerate(emp_numbers)}
+        out: List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]] = []
+        with self._connect() as conn:
+            emps = list(order.keys())
+            for i in range(0, len(emps), 500):
+                chunk = emps[i:i + 500]
+                q = ("SELECT emp_number, sheet_json, entries_json FROM timesheets "
+                     f"WHERE entries_synced_at IS NOT NULL AND emp_number IN ({','.join('?' * len(chunk))})")
+                params: List[Any] = list(chunk)
+                if from_date:
+                    q += " AND period_end >= ?"; params.append(from_date)
+                if to_date:
+                    q += " AND period_start <= ?"; params.append(to_date)
+                q += " ORDER BY period_start, CAST(timesheet_id AS INTEGER)"
+                for emp, sheet_json, entries_json in conn.execute(q, params):
+                    out.append((emp, json.loads(sheet_json), json.loads(entries_json or "[]")))
+        out.sort(key=lambda r: order.get(r[0], len(order)))  # sort estável mantém a ordem por período
+        return out
+
+@st.cache_resource(show_spinner=False)
+def _timesheet_store_at(path: str) -> _TimesheetStore:
+    return _TimesheetStore(path)
+
+def _timesheet_store() -> _TimesheetStore:
+    return _timesheet_store_at(os.path.join(_orangehrm_cache_dir(), "timesheets.sqlite3"))
+
+def _sync_timesheet_store(
+    client: _OrangeHRMClient,
+    store: _TimesheetStore,
+    emp_numbers: List[str],
+    from_date: str = None,
+    to_date: str = None,
+) -> Tuple[List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]], Dict[str, int]]:
+    """
+    Sincronização incremental: lista as folhas (barato) e só descarrega entradas das folhas
+    novas, ainda abertas ou cujo registo mudou desde a última sincronização. Devolve os dados
+    do store para o intervalo e estatísticas (listed/fetched/cached).
+    """
+    listed, to_fetch, ranges, weeks_cached = _plan_timesheet_sync(client, store, emp_numbers, from_date, to_date)
+    fetched_entries = _fetch_concurrently(lambda job: _get_timesheet_entries(client, job[2]), to_fetch)
+    store.upsert([(emp, ts, entries, fp) for (emp, ts, _id, fp), entries in zip(to_fetch, fetched_entries)])
+    for emp, emp_ranges in ranges.items():
+        store.mark_covered(emp, emp_ranges)
+    loaded = store.load(emp_numbers, from_date, to_date)
+    fetch_ids = {job[2] for job in to_fetch}
+    # listed: folhas no período; as listagens podem ter alargado a semanas inteiras
+    fetched_in_range = sum(1 for _e, ts, _en in loaded if str(ts.get("id") or ts.get("timesheetId")) in fetch_ids)
+    stats = {"listed": len(loaded), "fetched": len(to_fetch), "cached": len(loaded) - fetched_in_range,
+             "weeks_cached": weeks_cached}
+    client.metrics.cache_hit(_endpoint_template(_PATH_GET_TIMESHEET_ENTRIES.format(timesheetId=0)), stats["cached"])
+    return loaded, stats
+
+def _plan_timesheet_sync(
+    client: _OrangeHRMClient,
+    store: _TimesheetStore,
+    emp_numbers: List[str],
+    from_date: str = None,
+    to_date: str = None,
+) -> Tuple[List[Tuple[str, Dict[str, Any], str, str]], List[Tuple[str, Dict[str, Any], str, str]],
+           Dict[str, List[Tuple[str, str]]], int]:
+    """
+    Primeira fase da sincronização: lista as folhas, apaga do store as que desapareceram,
+    marca como vistas as que não mudaram e devolve (listadas, a descarregar, intervalos
+    listados por colaborador, semanas servidas do store). Listadas e a descarregar são
+    tuplos (empNumber, timesheet, timesheetId, fingerprint).
+
+    Com período fechado, só são listadas as semanas que o store ainda não cobre (ver
+    _TimesheetStore.missing_weeks), agrupadas em intervalos contíguos; os intervalos devem
+    ser marcados com mark_covered depois de descarregadas as entradas.
+    """
+    jobs, weeks_cached = _timesheet_listing_jobs(store, emp_numbers, from_date, to_date)
+    sheets_per_job = _fetch_concurrently(
+        lambda job: _list_all_employee_timesheets(client, job[0], from_date=job[1], to_date=job[2]),
+        jobs,
+    )
+    listed, to_fetch, ranges = _apply_timesheet_listings(store, list(zip(jobs, sheets_per_job)))
+    return listed, to_fetch, ranges, weeks_cached
+
+def _timesheet_listing_jobs(
+    store: _TimesheetStore, emp_numbers: List[str], from_date: Optional[str], to_date: Optional[str],
+) -> Tuple[List[Tuple[str, Optional[str], Optional[str]]], int]:
+    """Listagens a pedir (empNumber, de, até) e semanas servidas do store; só consulta o store."""
+    ttl = _orangehrm_week_cache_ttl()
+    jobs: List[Tuple[str, Optional[str], Optional[str]]] = []
+    weeks_cached = 0
+    for emp in emp_numbers:
+        if not (from_date and to_date):
+            jobs.append((emp, from_date, to_date))
+            continue
+        missing, cached = store.missing_weeks(emp, from_date, to_date, ttl)
+        weeks_cached += cached
+        jobs.extend((emp, a, b) for a, b in _week_runs(missing))
+    return jobs, weeks_cached
+
+def _apply_timesheet_listings(
+    store: _TimesheetStore,
+    listings: List[Tuple[Tuple[str, Optional[str], Optional[str]], List[Dict[str, Any]]]],
+) -> Tuple[List[Tuple[str, Dict[str, Any], str, str]], List[Tuple[str, Dict[str, Any], str, str]],
+           Dict[str, List[Tuple[str, str]]]]:
+    """Listagens recebidas -> store atualizado e (listadas, a descarregar, intervalos listados)."""
+    listed: List[Tuple[str, Dict[str, Any], str, str]] = []
+    ranges: Dict[str, List[Tuple[str, str]]] = {}
+    seen = set()
+    for (emp, a, b), sheets in listings:
+        ids: List[str] = []
+        for ts in sheets:
+            ts_id = str(ts.get("id") or ts.get("timesheetId") or "")
+            if not ts_id:
+                continue
+            ids.append(ts_id)
+            if ts_id in seen:  # folha que atravessa dois intervalos listados
+                continue
+            seen.add(ts_id)
+            fp = hashlib.sha1(json.dumps(ts, sort_keys=True).encode("utf-8")).hexdigest()
+            listed.append((emp, ts, ts_id, fp))
+        store.delete_missing(emp, ids, a, b)
+        if a and b:
+            ranges.setdefault(emp, []).append((a, b))
+
+    known = store.get_states([ts_id for _e, _t, ts_id, _fp in listed])
+    to_fetch = [
+        (emp, ts, ts_id, fp) for emp, ts, ts_id, fp in listed
+        if ts_id not in known
+        or known[ts_id][1] != fp
+        or _timesheet_status_id(ts) not in _IMMUTABLE_TIMESHEET_STATUSES
+    ]
+    fetch_ids = {job[2] for job in to_fetch}
+    store.upsert([(emp, ts, None, fp) for emp, ts, ts_id, fp in listed if ts_id not in fetch_ids])
+    return listed, to_fetch, ranges
+
+# =============================
+# Timesheet dataset (recolha única, várias vistas)
+# =============================
+
+def _timesheet_overlaps(ts: Dict[str, Any], from_date: Optional[str], to_date: Optional[str]) -> bool:
+    """A folha interseta [from_date, to_date] (limites opcionais), como o filtro da API e do store."""
+    start = str(ts.get("startDate") or ts.get("fromDate") or "")
+    end = str(ts.get("endDate") or ts.get("toDate") or "")
+    return not ((from_date and end and end < from_date) or (to_date and start and start > to_date))
+
+def _first_present(df: pd.DataFrame, columns: List[str]) -> pd.Series:
+    """Primeiro valor não vazio entre várias colunas alternativas (as que existirem)."""
+    out = pd.Series(None, index=df.index, dtype="object")
+    for col in columns:
+        if col in df.columns:
+            vals = df[col]
+            out = out.where(out.notna(), vals.where(vals.notna() & (vals != "")))
+    return out
+
+def _nested(values: pd.Series, *keys: str) -> pd.Series:
+    """values[k1][k2]... para uma coluna de dicts aninhados (NaN onde faltar)."""
+    s = values
+    for k in keys:
+        is_dict = s.map(lambda v: isinstance(v, dict))
+        if not is_dict.any():
+            return pd.Series(np.nan, index=values.index, dtype="object")
+        s = s.where(is_dict).str.get(k)
+    return s
+
+def _id_str(v: Any) -> str:
+    # ids inteiros passam a float quando a coluna tem linhas sem o campo
+    return str(int(v)) if isinstance(v, float) and v.is_integer() else str(v)
+
+def _normalise_timesheets(
+    fetched: List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]],
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    JSON da API -> três tabelas colunares:
+    - timesheets: empNumber, timesheetId, periodStart, periodEnd, status
+    - entries (uma linha por entrada): empNumber, timesheetId, periodStart, clientName,
+      projectName, projectId, hours
+    - entry_days (uma linha por entrada × dia): entryRow, empNumber, timesheetId, date, hours
+    Os campos aninhados são lidos coluna a coluna, as durações convertidas de uma vez
+    (_duration_hours) e as horas por entrada vêm de total.hours/minutes ou, na falta
+    destes, da soma dos dias (groupby).
+    """
+    ts_raw = pd.DataFrame.from_records(
+        [ts for _emp, ts, _entries in fetched],
+        columns=["id", "timesheetId", "startDate", "fromDate", "endDate", "toDate", "status"],
+    )
+    status = ts_raw["status"]
+    ts_df = pd.DataFrame({
+        "empNumber": pd.Series([str(emp) for emp, _ts, _entries in fetched], dtype="object"),
+        "timesheetId": _first_present(ts_raw, ["id", "timesheetId"]).map(_id_str),
+        "periodStart": _first_present(ts_raw, ["startDate", "fromDate"]),
+        "periodEnd": _first_present(ts_raw, ["endDate", "toDate"]),
+        "status": _first_present(pd.DataFrame({
+            "id": _nested(status, "id"),
+            "name": _nested(status, "name"),
+            "value": status.where(status.map(lambda v: not isinstance(v, dict))),
+        }), ["id", "name", "value"]),
+    })
+
+    counts = [len(entries) for _emp, _ts, entries in fetched]
+    ent = pd.DataFrame.from_records(
+        [e for _emp, _ts, entries in fetched for e in entries],
+        columns=["project", "customer", "customerName", "customer_name", "projectName", "project_name",
+                 "projectId", "project_id", "total", "dates"],
+    )
+    proj = pd.DataFrame.from_records(
+        [p if isinstance(p, dict) else {} for p in ent["project"]],
+        columns=["id", "name", "customerName", "customer"], index=ent.index,
+    )
+    ent["project.customer.name"] = _nested(proj["customer"], "name")
+    ent["project.customerName"] = proj["customerName"]
+    ent["customer.name"] = _nested(ent["customer"], "name")
+    ent["project.name"] = proj["name"]
+    ent["project.id"] = proj["id"]
+    ent_df = pd.DataFrame({
+        "empNumber": np.repeat(ts_df["empNumber"].to_numpy(), counts),
+        "timesheetId": np.repeat(ts_df["timesheetId"].to_numpy(), counts),
+        "periodStart": np.repeat(ts_df["periodStart"].to_numpy(), counts),
+        "clientName": _first_present(ent, ["project.customer.name", "project.customerName", "customer.name", "customerName", "customer_name"]),
+        "projectName": _first_present(ent, ["project.name", "projectName", "project_name"]),
+        "projectId": _first_present(ent, ["project.id", "projectId", "project_id"]).map(_id_str, na_action="ignore"),
+    })
+
+    # Dias: os dicts {data: {"duration": ...}} de todas as entradas achatados numa só coluna
+    dates = ent["dates"].map(lambda d: d if isinstance(d, dict) else {})
+    entry_row = np.repeat(np.arange(len(ent)), dates.map(len).to_numpy(dtype="int64"))
+    durations = pd.Series([
+        v.get("duration") if isinstance(v, dict) else v
+        for v in itertools.chain.from_iterable(d.values() for d in dates)
+    ], dtype="object")
+    days = pd.DataFrame({
+        "entryRow": entry_row,
+        "empNumber": ent_df["empNumber"].to_numpy()[entry_row],
+        "timesheetId": ent_df["timesheetId"].to_numpy()[entry_row],
+        "date": pd.Series(list(itertools.chain.from_iterable(dates)), dtype="object"),
+        "hours": _duration_hours(durations),
+    })
+
+    total_h = pd.to_numeric(_nested(ent["total"], "hours"), errors="coerce")
+    total_m = pd.to_numeric(_nested(ent["total"], "minutes"), errors="coerce")
+    day_sum = days.groupby("entryRow")["hours"].sum().reindex(ent_df.index, fill_value=0.0)
+    ent_df["hours"] = (total_h + total_m.fillna(0.0) / 60.0).fillna(day_sum).astype("float64")
+    return ts_df, ent_df, days
+
+def _collect_timesheet_dataset(
+    client: _OrangeHRMClient,
+    emp_numbers: List[str],
+    from_date: str = None,
+    to_date: str = None,
+    store: Optional[_TimesheetStore] = None,
+    store_only: bool = False,
+) -> Dict[str, Any]:
+    """
+    Recolhe cada folha de horas e as suas entradas uma única vez e normaliza-as em
+    DataFrames (ver _normalise_timesheets): timesheets, entries e entry_days.
+    Com `store`, a recolha é incremental (ver _sync_timesheet_store) e lê do cache local;
+    com `store_only` lê só do store (já sincronizado em segundo plano), sem pedidos à API.
+    Todas as vistas (pivot semanal, cliente/projeto, ...) são calculadas a partir daqui.
+    """
+    sync_stats: Dict[str, int] = {}
+    if store is not None and store_only:
+        fetched = store.load(emp_numbers, from_date, to_date)
+        sync_stats = {"listed": len(fetched), "fetched": 0, "cached": len(fetched)}
+        client.metrics.cache_hit(_endpoint_template(_PATH_LIST_EMPLOYEE_TIMESHEETS.format(empNumber=0)), len(emp_numbers))
+        client.metrics.cache_hit(_endpoint_template(_PATH_GET_TIMESHEET_ENTRIES.format(timesheetId=0)), len(fetched))
+    elif store is not None:
+        fetched, sync_stats = _sync_timesheet_store(client, store, emp_numbers, from_date, to_date)
+    else:
+        fetched = _fetch_timesheets_with_entries(client, emp_numbers, from_date, to_date)
+    return _dataset_from_fetched(client, fetched, from_date, to_date, sync_stats)
+
+def _dataset_from_fetched(
+    client: _OrangeHRMClient,
+    fetched: List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]],
+    from_date: str = None,
+    to_date: str = None,
+    sync_stats: Optional[Dict[str, int]] = None,
+) -> Dict[str, Any]:
+    """Normaliza (empNumber, timesheet, entries) e resolve nomes de projeto/cliente em falta."""
+    timesheets, entries, entry_days = _normalise_timesheets(fetched)
+    _resolve_entry_names(client, entries)
+    return {
+        "timesheets": timesheets,
+        "entries": entries,
+        "entry_days": entry_days,
+        "fromDate": from_date,
+        "toDate": to_date,
+        "fetchedAt": time.time(),
+        "sync": sync_stats or {},
+    }
+
+def _resolve_entry_names(client: _OrangeHRMClient, entries: pd.DataFrame):
+    """Preenche clientName/projectName em falta (no próprio DataFrame) a partir do catálogo de projetos."""
+    # Projetos sem nome/cliente na entrada: resolvidos pelo catálogo partilhado (dict);
+    # só ids que o catálogo não conhece geram pedidos, uma vez cada e em paralelo
+    unresolved = (entries["clientName"].isna() | entries["projectName"].isna()) & entries["projectId"].notna()
+    missing = sorted(entries.loc[unresolved, "projectId"].unique())
+    if missing:
+        catalogue = _project_catalogue(client)
+        catalogue.ensure_fresh(client)
+        unknown = [p for p in missing if p not in catalogue]
+        fetched = dict(zip(unknown, _fetch_concurrently(lambda pid: catalogue.lookup(client, pid), unknown)))
+        client.metrics.cache_hit("time/projects/{n}", len(missing) - len(unknown))
+        names = {pid: fetched[pid] if pid in fetched else catalogue.lookup(client, pid) for pid in missing}
+        pids = entries.loc[unresolved, "projectId"]
+        entries.loc[unresolved, "projectName"] = entries.loc[unresolved, "projectName"].fillna(pids.map(lambda p: names[p][0]))
+        entries.loc[unresolved, "clientName"] = entries.loc[unresolved, "clientName"].fillna(pids.map(lambda p: names[p][1]))
+    # Sem id (ex.: linhas de relatório): cliente pelo nome do projeto, se for inequívoco
+    by_name = entries["clientName"].isna() & entries["projectName"].notna() & entries["projectId"].isna()
+    if by_name.any():
+        catalogue = _project_catalogue(client)
+        catalogue.ensure_fresh(client)
+        customers = catalogue.customers_by_project_name()
+        entries.loc[by_name, "clientName"] = entries.loc[by_name, "projectName"].map(customers)
+    entries["clientName"] = entries["clientName"].fillna("Sem Cliente").astype(str)
+    entries["projectName"] = entries["projectName"].fillna("Sem Projeto").astype(str)
+
+# =============================
+# Relatórios agregados (time/reports/data): totais por cliente/projeto sem N+1 pedidos
+# =============================
+
+_PATH_TIME_REPORT_DATA = "time/reports/data"
+# Nome do relatório de horas por colaborador. "employee_time" é o de Time > Reports > Employee
+# Reports no OrangeHRM 5.x (filtros empNumber, obrigatório, projectId, activityId, fromDate e
+# toDate); "employee" é o do simulador (tools/orangehrm_sim.py). Nenhum dos dois foi validado
+# contra uma instância OrangeHRM real: só o simulador os confirma. Daí a deteção abaixo e o
+# regresso ao caminho por folha de horas sempre que a instância os recusar.
+_EMPLOYEE_REPORT_NAMES = ("employee_time", "employee")
+# Estatutos que querem dizer "relatório não suportado / sem permissão", não falha temporária
+_REPORT_UNSUPPORTED = (400, 403, 404, 405, 422)
+
+def _report_unsupported(e: requests.HTTPError) -> bool:
+    return e.response is not None and e.response.status_code in _REPORT_UNSUPPORTED
+
+def _report_row_emp(row: Dict[str, Any]) -> Optional[str]:
+    """empNumber de uma linha do relatório (campo direto ou employee.empNumber); None se não vier."""
+    emp = row.get("empNumber")
+    if emp is None and isinstance(row.get("employee"), dict):
+        emp = row["employee"].get("empNumber")
+    return None if emp is None else _id_str(emp)
+
+class _ReportSupport:
+    """
+    Deteção, uma vez por host, do relatório de horas por colaborador: um pedido com limit=1
+    por variante do nome. 400/403/404/405/422 = não suportado (ou sem permissão) e fica
+    memorizado; outros erros (rede, 5xx) não, para se tentar de novo mais tarde.
+    Depois, um segundo pedido sem empNumber diz se a instância aceita o relatório de vários
+    colaboradores de uma vez (batched): só conta se as linhas trouxerem o empNumber, para as
+    repartir por colaborador; senão fica um pedido (paginado) por colaborador.
+    """
+    def __init__(self):
+        self.report_name: Optional[str] = None
+        self.batched = False
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def detect(self, client: _OrangeHRMClient, emp_number: str) -> Optional[str]:
+        if self.checked_at:
+            return self.report_name
+        with self._lock:
+            if self.checked_at:
+                return self.report_name
+            for name in _EMPLOYEE_REPORT_NAMES:
+                try:
+                    data = client.request("GET", _PATH_TIME_REPORT_DATA,
+                                          params={"name": name, "empNumber": emp_number, "limit": 1})
+                except requests.HTTPError as e:
+                    if _report_unsupported(e):
+                        continue
+                    raise
+                if isinstance(data, dict) and isinstance(data.get("data"), list):
+                    self.report_name = name
+                    break
+            if self.report_name:
+                self.batched = self._detect_batched(client)
+            self.checked_at = time.time()
+            return self.report_name
+
+    def _detect_batched(self, client: _OrangeHRMClient) -> bool:
+        try:
+            data = client.request("GET", _PATH_TIME_REPORT_DATA, params={"name": self.report_name, "limit": 1})
+        except requests.HTTPError as e:
+            if _report_unsupported(e):
+                return False
+            raise
+        rows = data.get("data") if isinstance(data, dict) else None
+        return bool(rows) and isinstance(rows[0], dict) and _report_row_emp(rows[0]) is not None
+
+@st.cache_resource(show_spinner=False)
+def _report_support_for(api_base: str) -> _ReportSupport:
+    return _ReportSupport()
+
+def _orangehrm_report_name(client: _OrangeHRMClient, emp_numbers: List[str]) -> Optional[str]:
+    """Nome do relatório agregado por colaborador se a instância o suportar; None -> via folhas/entradas."""
+    if not emp_numbers or str(_get_setting("use_reports") or "1").lower() in ("0", "false", "no", "off"):
+        return None
+    try:
+        return _report_support_for(client.api_base).detect(client, str(emp_numbers[0]))
+    except Exception:
+        return None
+
+def _employee_report_rows(client: _OrangeHRMClient, report_name: str, emp_number: Optional[str],
+                          from_date: str = None, to_date: str = None) -> List[Dict[str, Any]]:
+    """Linhas do relatório de um colaborador; emp_number=None -> de todos (relatório batched)."""
+    params = {"name": report_name}
+    if emp_number is not None: params["empNumber"] = emp_number
+    if from_date: params["fromDate"] = from_date
+    if to_date:   params["toDate"]   = to_date
+    return _paginate(client, _PATH_TIME_REPORT_DATA, params)
+
+def _batched_report_rows(client: _OrangeHRMClient, report_name: str, emp_numbers: List[str],
+                         from_date: str = None, to_date: str = None) -> Optional[List[List[Dict[str, Any]]]]:
+    """
+    Um só relatório (paginado) para todos os colaboradores, repartido por empNumber pela ordem
+    de emp_numbers (os restantes colaboradores da instância são descartados). None se alguma
+    linha vier sem empNumber ou a instância recusar o pedido: o chamador faz um por colaborador.
+    """
+    try:
+        rows = _employee_report_rows(client, report_name, None, from_date, to_date)
+    except requests.HTTPError as e:
+        if _report_unsupported(e):
+            return None
+        raise
+    by_emp: Dict[str, List[Dict[str, Any]]] = {str(emp): [] for emp in emp_numbers}
+    for row in rows:
+        emp = _report_row_emp(row) if isinstance(row, dict) else None
+        if emp is None:
+            return None
+        if emp in by_emp:
+            by_emp[emp].append(row)
+    return [by_emp[str(emp)] for emp in emp_numbers]
+
+def _report_rows_by_employee(client: _OrangeHRMClient, report_name: str, emp_numbers: List[str],
+                             from_date: str = None, to_date: str = None) -> List[List[Dict[str, Any]]]:
+    """Linhas do relatório por colaborador: um pedido batched se a instância o aceitar, senão um por colaborador."""
+    if len(emp_numbers) > 1 and _report_support_for(client.api_base).batched:
+        rows = _batched_report_rows(client, report_name, emp_numbers, from_date, to_date)
+        if rows is not None:
+            return rows
+    return _fetch_concurrently(
+        lambda emp: _employee_report_rows(client, report_name, emp, from_date, to_date), emp_numbers)
+
+def _dataset_from_report(
+    client: _OrangeHRMClient,
+    report_rows: List[Tuple[str, List[Dict[str, Any]]]],
+    from_date: str = None,
+    to_date: str = None,
+    sync_stats: Optional[Dict[str, int]] = None,
+) -> Dict[str, Any]:
+    """
+    (empNumber, linhas do relatório) -> dataset com a mesma forma do de _dataset_from_fetched,
+    mas só com totais por projeto: sem folhas de horas nem dias (a tabela dinâmica fica vazia).
+    As horas do relatório contam só os dias dentro do período.
+    """
+    counts = [len(rows) for _emp, rows in report_rows]
+    raw = pd.DataFrame.from_records(
+        [r for _emp, rows in report_rows for r in rows],
+        columns=["project", "projectName", "projectId", "customer", "customerName",
+                 "totalDuration", "duration", "time", "hours"],
+    )
+    raw["project.name"] = _nested(raw["project"], "name")
+    raw["project.id"] = _nested(raw["project"], "id")
+    raw["customer.name"] = _nested(raw["customer"], "name")
+    entries = pd.DataFrame({
+        "empNumber": pd.Series(np.repeat([str(emp) for emp, _rows in report_rows], counts), dtype="object"),
+        "timesheetId": None,
+        "periodStart": None,
+        "clientName": _first_present(raw, ["customer.name", "customerName"]),
+        "projectName": _first_present(raw, ["project.name", "projectName"]),
+        "projectId": _first_present(raw, ["project.id", "projectId"]).map(_id_str, na_action="ignore"),
+        "hours": _duration_hours(_first_present(raw, ["totalDuration", "duration", "time", "hours"]), decimal_text=True),
+    })
+    _resolve_entry_names(client, entries)
+    return {
+        "timesheets": pd.DataFrame(columns=["empNumber", "timesheetId", "periodStart", "periodEnd", "status"]),
+        "entries": entries,
+        "entry_days": pd.DataFrame(columns=["entryRow", "empNumber", "timesheetId", "date", "hours"]),
+        "fromDate": from_date,
+        "toDate": to_date,
+        "fetchedAt": time.time(),
+        "sync": sync_stats or {},
+        "source": "report",
+    }
+
+def _timesheet_totals_rows(dataset: Dict[str, Any], empname_map: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Vista: total de horas por colaborador × folha de horas."""
+    ts_df = dataset["timesheets"]
+    hours_by_ts = dataset["entries"].groupby("timesheetId")["hours"].sum()
+    out = pd.DataFrame({
+        "empNumber": ts_df["empNumber"],
+        "empName": ts_df["empNumber"].map(lambda emp: empname_map.get(emp, emp)),
+        "timesheetId": ts_df["timesheetId"],
+        "periodStart": ts_df["periodStart"],
+        "periodEnd": ts_df["periodEnd"],
+        "totalHours": ts_df["timesheetId"].map(hours_by_ts).fillna(0.0).round(2),
+    })
+    return out.to_dict("records")
+
+def _client_project_rows(dataset: Dict[str, Any], empname_map: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Vista: total de horas por colaborador × cliente × projeto."""
+    out = (
+        dataset["entries"]
+        .groupby(["empNumber", "clientName", "projectName"], sort=False)["hours"].sum()
+        .round(2)
+        .rename("totalHours")
+        .reset_index()
+    )
+    out.insert(1, "empName", out["empNumber"].map(lambda emp: empname_map.get(emp, emp)))
+    return out.to_dict("records")
+
+def _filter_dataset_employees(dataset: Dict[str, Any], emp_numbers: List[str]) -> Dict[str, Any]:
+    """Dataset restrito a alguns colaboradores (sem pedidos); entryRow reindexado para as entradas que ficam."""
+    keep = set(map(str, emp_numbers))
+    entries = dataset["entries"]
+    mask = entries["empNumber"].isin(keep)
+    days = dataset["entry_days"]
+    days = days[days["empNumber"].isin(keep)].copy()
+    new_pos = np.full(len(entries), -1, dtype="int64")
+    new_pos[mask.to_numpy()] = np.arange(int(mask.sum()))
+    days["entryRow"] = new_pos[days["entryRow"].to_numpy(dtype="int64")]
+    timesheets = dataset["timesheets"]
+    return {
+        **dataset,
+        "timesheets": timesheets[timesheets["empNumber"].isin(keep)].reset_index(drop=True),
+        "entries": entries[mask].reset_index(drop=True),
+        "entry_days": days.reset_index(drop=True),
+    }
+
+class _HoursCube:
+    """
+    Cubo de horas em memória (colaborador × semana × dia × cliente × projeto), uma linha por
+    entrada × dia, com dimensões categóricas (códigos inteiros) para filtrar e agregar em
+    milissegundos sem voltar à API. Entradas sem detalhe diário (ou relatórios agregados)
+    ficam com dia/semana vazios, para os totais baterem certo com as entradas.
+    """
+    # rótulo na UI -> coluna do cubo
+    DIMENSIONS = {"Colaborador": "emp", "Semana": "week", "Dia": "day", "Cliente": "client", "Projeto": "project"}
+
+    def __init__(self, dataset: Dict[str, Any]):
+        ent, days = dataset["entries"], dataset["entry_days"]
+        rows = days["entryRow"].to_numpy(dtype="int64")
+        day_hours = days.groupby("entryRow")["hours"].sum().reindex(ent.index, fill_value=0.0)
+        rest = (ent["hours"] - day_hours).to_numpy()
+        extra = np.flatnonzero(np.abs(rest) > 1e-9)
+        pick = np.concatenate([rows, extra])
+        self.frame = pd.DataFrame({
+            "emp": ent["empNumber"].to_numpy()[pick],
+            "week": ent["periodStart"].to_numpy()[pick],
+            "day": np.concatenate([days["date"].to_numpy(dtype="object"), np.full(len(extra), None, dtype="object")]),
+            "client": ent["clientName"].to_numpy()[pick],
+            "project": ent["projectName"].to_numpy()[pick],
+            "hours": np.concatenate([days["hours"].to_numpy(dtype="float64"), rest[extra]]),
+        })
+        for col in ("emp", "week", "day", "client", "project"):
+            self.frame[col] = self.frame[col].astype("category")
+        self.frame["day"] = self.frame["day"].cat.reorder_categories(sorted(self.frame["day"].cat.categories))
+        self.frame["week"] = self.frame["week"].cat.reorder_categories(sorted(self.frame["week"].cat.categories))
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def members(self, dim: str) -> List[str]:
+        """Valores presentes numa dimensão (ordenados como as categorias)."""
+        return [str(v) for v in self.frame[dim].cat.categories]
+
+    def dimensions(self) -> Dict[str, str]:
+        """Dimensões com dados (um relatório agregado não tem semana nem dia)."""
+        return {label: col for label, col in self.DIMENSIONS.items() if len(self.frame[col].cat.categories)}
+
+    def pivot(self, rows: str, cols: Optional[str] = None, filters: Optional[Dict[str, List[str]]] = None,
+              emp_names: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+        """Soma de horas por `rows` (× `cols`), depois de filtrar por {dimensão: valores}."""
+        df = self.frame
+        for dim, values in (filters or {}).items():
+            if values:
+                df = df[df[dim].isin(values)]
+        keys = [rows] + ([cols] if cols and cols != rows else [])
+        out = df.groupby(keys, observed=True)["hours"].sum().round(2)
+        out = out.unstack(cols, fill_value=0.0) if len(keys) > 1 else out.to_frame("Total de Horas")
+        if emp_names:
+            if rows == "emp":
+                out = out.rename(index=lambda e: emp_names.get(e, e))
+            if cols == "emp":
+                out = out.rename(columns=lambda e: emp_names.get(e, e))
+        return out
 
 # Aggregate hours by employee x client x project
 def _get_hours_by_employee_client_project(
@@ -1109,59 +3538,297 @@ def _get_hours_by_employee_client_project(
     from_date: str = None,
     to_date: str = None,
 ) -> List[Dict[str, Any]]:
-    acc: Dict[tuple, float] = {}
-    proj_cust_cache: Dict[str, Dict[str, str]] = {}
-    for emp in emp_numbers:
-        offset = 0
-        while True:
-            sheets = _list_employee_timesheets(client, emp, from_date=from_date, to_date=to_date, limit=50, offset=offset)
-            if not sheets:
-                break
-            for ts in sheets:
-                ts_id = str(ts.get("id") or ts.get("timesheetId") or "")
-                if not ts_id:
-                    continue
-                entries = _get_timesheet_entries(client, ts_id)
-                for e in entries:
-                    hours = _sum_entry_hours(e)
-                    proj = e.get("project") if isinstance(e.get("project"), dict) else {}
-                    customer = proj.get("customer") if isinstance(proj.get("customer"), dict) else {}
-                    client_name = (
-                        customer.get("name")
-                        or (proj.get("customer").get("name") if isinstance(proj.get("customer"), dict) else None)
-                        or proj.get("customerName")
-                        or (e.get("customer").get("name") if isinstance(e.get("customer"), dict) else None)
-                        or e.get("customerName")
-                        or e.get("customer_name")
-                    )
-                    project_name = (
-                        proj.get("name")
-                        or (e.get("project").get("name") if isinstance(e.get("project"), dict) else None)
-                        or e.get("projectName")
-                        or e.get("project_name")
-                    )
-                    project_id = proj.get("id") or e.get("projectId") or e.get("project_id")
-                    if (not client_name or not project_name) and project_id is not None:
-                        p_name, c_name = _resolve_project_names_and_customer(client, project_id, proj_cust_cache)
-                        project_name = project_name or p_name
-                        client_name = client_name or c_name
-                    client_name = client_name or "Sem Cliente"
-                    project_name = project_name or "Sem Projeto"
-                    key = (str(emp), str(client_name), str(project_name))
-                    acc[key] = acc.get(key, 0.0) + hours
-            if len(sheets) < 50:
-                break
-            offset += 50
-    rows: List[Dict[str, Any]] = []
-    for (emp_key, client_name, project_name), total in acc.items():
-        rows.append({
-            "empNumber": emp_key,
-            "empName": empname_map.get(emp_key, emp_key),
-            "clientName": client_name,
-            "projectName": project_name,
-            "totalHours": round(total, 2),
-        })
-    return rows
+    report_name = _orangehrm_report_name(client, emp_numbers)
+    if report_name:
+        try:
+            rows = _report_rows_by_employee(client, report_name, emp_numbers, from_date, to_date)
+            dataset = _dataset_from_report(client, list(zip(map(str, emp_numbers), rows)), from_date, to_date)
+            return _client_project_rows(dataset, empname_map)
+        except requests.HTTPError as e:
+            if not _report_unsupported(e):
+                raise
+            # Relatório recusado (404/422, permissões de algum colaborador): caminho por folha de horas
+    dataset = _collect_timesheet_dataset(client, emp_numbers, from_date=from_date, to_date=to_date)
+    return _client_project_rows(dataset, empname_map)
+
+# =============================
+# Recolha progressiva (progresso em tempo real, resultados parciais e cancelamento)
+# =============================
+
+class _TimesheetCrawl:
+    """
+    Sincronização do store numa thread própria, para a UI mostrar progresso e resultados
+    parciais enquanto os pedidos correm. As listagens e as descargas de entradas partilham
+    um único pool (só pedidos HTTP); o planeamento e o store ficam na thread da recolha:
+    assim que um colaborador fica listado, as entradas das suas folhas entram na fila.
+    cancel() deixa de submeter trabalho, descarta o que está na fila e constrói o dataset
+    só com o que já chegou.
+    """
+    def __init__(self, key: Tuple[Any, ...], client: _OrangeHRMClient, store: _TimesheetStore,
+                 emp_numbers: List[str], from_date: Optional[str], to_date: Optional[str],
+                 warm_at: Optional[float] = None, report_name: Optional[str] = None):
+        self.key = key
+        self.report_name = report_name  # relatório agregado: só totais por cliente/projeto
+        self.client, self.store = client, store
+        self.emp_numbers = [str(e) for e in emp_numbers]
+        self.from_date, self.to_date = from_date, to_date
+        self.warm_at = warm_at
+        self.emp_total = len(self.emp_numbers)
+        self.emp_done = 0
+        self.ts_total = 0
+        self.ts_done = 0
+        self.ts_fetched = 0
+        self.started_at = time.time()
+        self.finished_at = 0.0
+        self.error = ""
+        self.dataset: Optional[Dict[str, Any]] = None
+        self._cancel = threading.Event()
+        # timesheetId -> (empNumber, timesheet, entries), à medida que ficam completos
+        self._results: Dict[str, Tuple[str, Dict[str, Any], List[Dict[str, Any]]]] = {}
+        self._arrivals: List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]] = []  # por ordem de chegada
+        self._report_rows: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        # Vista parcial: cada lote de chegadas é normalizado uma vez e concatenado ao anterior
+        self._partial_lock = threading.Lock()
+        self._partial_count = 0
+        self._partial: Optional[Dict[str, Any]] = None
+        self._cube: Optional[_HoursCube] = None
+        self._thread = threading.Thread(target=self._run, name="orangehrm-crawl", daemon=True)
+        self._thread.start()
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at > 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _add(self, emp: str, ts: Dict[str, Any], entries: List[Dict[str, Any]]):
+        if not _timesheet_overlaps(ts, self.from_date, self.to_date):
+            return  # veio de uma semana alargada; fica no store mas fora do resultado
+        ts_id = str(ts.get("id") or ts.get("timesheetId") or "")
+        with self._lock:
+            if ts_id not in self._results:
+                self._arrivals.append((emp, ts, entries))
+            self._results[ts_id] = (emp, ts, entries)
+            self.ts_done += 1
+
+    def _list(self, job: Tuple[str, Optional[str], Optional[str]]):
+        emp, a, b = job
+        return _list_all_employee_timesheets(self.client, emp, from_date=a, to_date=b)
+
+    def _plan(self, emp: str, listings) -> Tuple[List[Tuple[str, Dict[str, Any], str, str]], List[Any],
+                                                 List[Tuple[str, str]]]:
+        """Na thread da recolha: aplica as listagens ao store e separa o que descarregar do que já lá está."""
+        _listed, to_fetch, ranges = _apply_timesheet_listings(self.store, listings)
+        fetch_ids = {job[2] for job in to_fetch}
+        # Folhas já completas no store (inclui as das semanas que nem foram listadas)
+        cached = [r for r in self.store.load([emp], self.from_date, self.to_date)
+                  if str(r[1].get("id") or r[1].get("timesheetId") or "") not in fetch_ids]
+        return to_fetch, cached, ranges.get(emp, [])
+
+    def _fetch(self, job: Tuple[str, Dict[str, Any], str, str]):
+        emp, ts, ts_id, fp = job
+        entries = _get_timesheet_entries(self.client, ts_id)
+        self.store.upsert([(emp, ts, entries, fp)])
+        return emp, ts, entries
+
+    def _crawl_report(self) -> Dict[str, int]:
+        """
+        Um só relatório para todos se a instância aceitar o pedido batched; senão um relatório
+        (paginado) por colaborador, em paralelo, com progresso por colaborador.
+        """
+        if len(self.emp_numbers) > 1 and _report_support_for(self.client.api_base).batched:
+            rows = _batched_report_rows(self.client, self.report_name, self.emp_numbers, self.from_date, self.to_date)
+            if rows is not None:
+                with self._lock:
+                    self._report_rows.update(zip(self.emp_numbers, rows))
+                    self.emp_done = len(self.emp_numbers)
+                return {"employees": len(self._report_rows), "rows": sum(map(len, rows))}
+        ex = ThreadPoolExecutor(max_workers=_orangehrm_fetch_concurrency(), thread_name_prefix="orangehrm-crawl")
+        try:
+            pending = {ex.submit(_employee_report_rows, self.client, self.report_name, emp,
+                                 self.from_date, self.to_date): emp for emp in self.emp_numbers}
+            while pending and not self._cancel.is_set():
+                done, _ = wait(list(pending), timeout=0.25, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    emp = pending.pop(fut)
+                    rows = fut.result()
+                    with self._lock:
+                        self._report_rows[emp] = rows
+                        self.emp_done += 1
+        finally:
+            ex.shutdown(wait=False, cancel_futures=True)
+        return {"employees": len(self._report_rows), "rows": sum(map(len, self._report_rows.values()))}
+
+    def _crawl(self) -> Dict[str, int]:
+        if self.report_name:
+            try:
+                return self._crawl_report()
+            except requests.HTTPError as e:
+                if not _report_unsupported(e):
+                    raise
+            # Relatório recusado (404/422, permissões): recolha pelas folhas de horas
+            with self._lock:
+                self.report_name = None
+                self._report_rows.clear()
+                self.emp_done = 0
+        stats = {"listed": 0, "fetched": 0, "cached": 0, "weeks_cached": 0}
+        if self.warm_at is not None:
+            # Pré-aquecido e recente: tudo vem do store, sem pedidos à API
+            for emp, ts, entries in self.store.load(self.emp_numbers, self.from_date, self.to_date):
+                self._add(emp, ts, entries)
+            self.emp_done, self.ts_total = self.emp_total, self.ts_done
+            stats["listed"] = stats["cached"] = self.ts_done
+            return stats
+
+        ex = ThreadPoolExecutor(max_workers=_orangehrm_fetch_concurrency(), thread_name_prefix="orangehrm-crawl")
+        # empNumber -> (entradas por descarregar, intervalos listados): a cobertura semanal
+        # só é registada quando todas as entradas do colaborador chegaram
+        remaining: Dict[str, Tuple[int, List[Tuple[str, str]]]] = {}
+        # empNumber -> (listagens por chegar, listagens recebidas)
+        listing: Dict[str, Tuple[int, List[Any]]] = {}
+        pending: Dict[Any, Tuple[str, Any]] = {}
+
+        def _planned(emp: str):
+            to_fetch, cached, ranges = self._plan(emp, listing.pop(emp)[1])
+            in_range = sum(1 for job in to_fetch if _timesheet_overlaps(job[1], self.from_date, self.to_date))
+            with self._lock:
+                self.ts_total += in_range + len(cached)
+                self.emp_done += 1
+            stats["listed"] += in_range + len(cached)
+            stats["cached"] += len(cached)
+            for row in cached:
+                self._add(*row)
+            if not to_fetch:
+                self.store.mark_covered(emp, ranges)
+            remaining[emp] = (len(to_fetch), ranges)
+            for job in to_fetch:
+                pending[ex.submit(self._fetch, job)] = ("fetch", job)
+
+        try:
+            jobs, stats["weeks_cached"] = _timesheet_listing_jobs(self.store, self.emp_numbers, self.from_date, self.to_date)
+            for emp in self.emp_numbers:
+                listing[emp] = (0, [])
+            for job in jobs:
+                left, got = listing[job[0]]
+                listing[job[0]] = (left + 1, got)
+                pending[ex.submit(self._list, job)] = ("list", job)
+            for emp in [e for e, (left, _got) in listing.items() if not left]:
+                _planned(emp)  # todas as semanas servidas do store: nada a listar
+            while pending and not self._cancel.is_set():
+                done, _ = wait(list(pending), timeout=0.25, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    kind, job = pending.pop(fut)
+                    if kind == "fetch":
+                        emp, ts, entries = fut.result()
+                        self._add(emp, ts, entries)
+                        self.ts_fetched += 1
+                        left, ranges = remaining[emp]
+                        remaining[emp] = (left - 1, ranges)
+                        if left == 1:
+                            self.store.mark_covered(emp, ranges)
+                        continue
+                    emp = job[0]
+                    left, got = listing[emp]
+                    got.append((job, fut.result()))
+                    listing[emp] = (left - 1, got)
+                    if left == 1:
+                        _planned(emp)
+            stats["fetched"] = self.ts_fetched
+        finally:
+            # Cancelado (ou erro): o que está na fila não chega a sair; pedidos em curso terminam sozinhos
+            ex.shutdown(wait=False, cancel_futures=True)
+        self.client.metrics.cache_hit(_endpoint_template(_PATH_GET_TIMESHEET_ENTRIES.format(timesheetId=0)), stats["cached"])
+        return stats
+
+    def _run(self):
+        stats: Dict[str, int] = {}
+        try:
+            stats = self._crawl()
+        except Exception as e:  # a UI mostra o erro e o que já tiver chegado
+            self.error = f"{type(e).__name__}: {e}"
+        try:
+            if self.report_name:
+                with self._lock:
+                    rows = [(emp, self._report_rows[emp]) for emp in self.emp_numbers if emp in self._report_rows]
+                self.dataset = _dataset_from_report(self.client, rows, self.from_date, self.to_date, stats)
+            else:
+                self.dataset = _dataset_from_fetched(self.client, self._ordered(), self.from_date, self.to_date, stats)
+        except Exception as e:
+            self.error = self.error or f"{type(e).__name__}: {e}"
+        self.finished_at = time.time()
+
+    def _ordered(self) -> List[Tuple[str, Dict[str, Any], List[Dict[str, Any]]]]:
+        """Resultados pela ordem colaborador → início do período (a mesma do store)."""
+        order = {e: i for i, e in enumerate(self.emp_numbers)}
+        with self._lock:
+            rows = list(self._results.values())
+        rows.sort(key=lambda r: (order.get(r[0], len(order)), str(r[1].get("startDate") or r[1].get("fromDate") or "")))
+        return rows
+
+    def cube(self) -> Optional[_HoursCube]:
+        """Cubo de horas do resultado final, construído uma vez (partilhado pelos reruns da sessão)."""
+        if self._cube is None and self.finished and self.dataset is not None:
+            self._cube = _HoursCube(self.dataset)
+        return self._cube
+
+    def partial_dataset(self) -> Dict[str, Any]:
+        """
+        Timesheets e entradas que já chegaram (sem resolver nomes de projeto, por ordem de
+        chegada). Só as chegadas desde a última chamada são normalizadas.
+        """
+        with self._partial_lock:
+            with self._lock:
+                new = self._arrivals[self._partial_count:]
+            if new or self._partial is None:
+                timesheets, entries, _days = _normalise_timesheets(new)
+                if self._partial is not None:
+                    timesheets = pd.concat([self._partial["timesheets"], timesheets], ignore_index=True)
+                    entries = pd.concat([self._partial["entries"], entries], ignore_index=True)
+                self._partial = {"timesheets": timesheets, "entries": entries}
+                self._partial_count += len(new)
+            return self._partial
+
+class _TimesheetCrawls:
+    """Recolhas em curso por utilizador (uma de cada vez), para sobreviverem a reruns e recarregamentos."""
+    def __init__(self, keep_finished: float = 1800.0):
+        self.keep_finished = keep_finished
+        self._jobs: Dict[str, _TimesheetCrawl] = {}
+        self._lock = threading.Lock()
+
+    def start(self, user: str, client: _OrangeHRMClient, store: _TimesheetStore, emp_numbers: List[str],
+              from_date: Optional[str], to_date: Optional[str], full_reload: bool = False,
+              warm_at: Optional[float] = None, report_name: Optional[str] = None) -> _TimesheetCrawl:
+        key = (tuple(map(str, emp_numbers)), from_date, to_date, full_reload, warm_at is not None, report_name)
+        with self._lock:
+            job = self._jobs.get(user)
+            if job is not None and not job.finished and not job.cancelled and job.key == key:
+                return job  # duplo clique / rerun: continua a mesma recolha
+            if job is not None and not job.finished:
+                job.cancel()
+            if full_reload and not report_name:
+                # Força nova descarga: a sincronização grava tudo de novo no store
+                store.delete_range(emp_numbers, from_date, to_date)
+            job = _TimesheetCrawl(key, client, store, emp_numbers, from_date, to_date, warm_at, report_name)
+            self._jobs[user] = job
+            return job
+
+    def latest(self, user: str) -> Optional[_TimesheetCrawl]:
+        with self._lock:
+            now = time.time()
+            for u, job in list(self._jobs.items()):
+                if job.finished and now - job.finished_at > self.keep_finished:
+                    del self._jobs[u]
+            return self._jobs.get(user)
+
+@st.cache_resource(show_spinner=False)
+def _timesheet_crawls() -> _TimesheetCrawls:
+    return _TimesheetCrawls()
 
 # Map O365 email -> OrangeHRM employee number
 def _email_to_username(email: str) -> str:
@@ -1208,33 +3875,191 @@ def _try_map_by_admin_users(client: _OrangeHRMClient, username: str) -> Optional
     # 3) Paginar admin/users sem filtro e procurar username localmente
     #    (só se o token tiver permissão, e pode ser pesado; limitamos a algumas páginas)
     try:
-        limit, offset, scanned = 100, 0, 0
         max_scan = 1000  # salvaguarda
-        while scanned < max_scan:
-            data = client.request("GET", f"admin/users?limit={limit}&offset={offset}")
-            arr = data.get("data") if isinstance(data, dict) else (data if isinstance(data, list) else [])
-            if not arr:
-                break
-            for u in arr:
-                scanned += 1
-                u_name = (u.get("userName") or u.get("username") or "").strip().lower()
-                if u_name == username:
-                    emp_no = _extract_emp_no(u)
-                    if emp_no:
-                        return emp_no
-            if len(arr) < limit:
-                break
-            offset += limit
+        for u in _paginate(client, "admin/users", limit=100, max_rows=max_scan):
+            u_name = (u.get("userName") or u.get("username") or "").strip().lower()
+            if u_name == username:
+                emp_no = _extract_emp_no(u)
+                if emp_no:
+                    return emp_no
     except Exception:
         pass
 
     return None
 
+class _IdentityIndex:
+    """
+    Índice partilhado workEmail / username (minúsculas) -> empNumber.
+    Construído a partir de pim/employees (+ contact-details para quem não traz e-mail) e
+    admin/users, gravado em disco para sobreviver a reinícios e renovado em segundo plano
+    quando tem mais de `ttl` segundos. Consultas são O(1) e não fazem pedidos à API.
+    """
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._emails: Dict[str, str] = {}
+        self._usernames: Dict[str, str] = {}
+        self._built_at = 0.0
+        self.last_error = ""
+        self._retry_at = 0.0  # depois de uma falha, nova tentativa só a partir daqui
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()  # primeira construção: uma só recolha, as outras sessões esperam
+        self._refreshing = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f) or {}
+            self._emails = dict(data.get("emails") or {})
+            self._usernames = dict(data.get("usernames") or {})
+            self._built_at = float(data.get("builtAt") or 0.0)
+        except Exception:
+            pass
+
+    def _save(self):
+        try:
+            tmp = f"{self.path}.tmp-{int(time.time()*1000)}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"builtAt": self._built_at, "emails": self._emails, "usernames": self._usernames}, f)
+            os.replace(tmp, self.path)
+        except Exception:
+            pass
+
+    @property
+    def built_at(self) -> float:
+        return self._built_at
+
+    def lookup(self, email: str) -> Optional[str]:
+        email_l = (email or "").strip().lower()
+        if not email_l:
+            return None
+        return self._emails.get(email_l) or self._usernames.get(_email_to_username(email_l))
+
+    def remember(self, email: str, emp_number: str):
+        """Guarda um mapeamento obtido pelo caminho lento, para o próximo acesso ser O(1)."""
+        email_l = (email or "").strip().lower()
+        if email_l and emp_number:
+            with self._lock:
+                self._emails[email_l] = str(emp_number)
+                self._save()
+
+    def rebuild(self, client: _OrangeHRMClient):
+        employees = _list_all_employees(client, limit=200)
+        emails: Dict[str, str] = {}
+        known_by_emp = {v: k for k, v in self._emails.items()}
+        without_email: List[str] = []
+        for e in employees:
+            emp_no = e.get("empNumber")
+            if emp_no is None:
+                continue
+            work = (e.get("workEmail") or e.get("email") or "").strip().lower()
+            if work:
+                emails[work] = str(emp_no)
+            elif str(emp_no) in known_by_emp:
+                emails[known_by_emp[str(emp_no)]] = str(emp_no)
+            else:
+                without_email.append(str(emp_no))
+
+        def _contact_email(emp_no: str) -> Optional[str]:
+            try:
+                data = client.request("GET", f"pim/employees/{emp_no}/contact-details")
+                d = data.get("data") if isinstance(data, dict) else None
+                return (d or {}).get("workEmail")
+            except Exception:
+                return None
+
+        # A listagem de colaboradores pode não trazer workEmail: só se pedem os detalhes
+        # de contacto de quem ainda não estava no índice
+        for emp_no, work in zip(without_email, _fetch_concurrently(_contact_email, without_email)):
+            if work and work.strip():
+                emails[work.strip().lower()] = emp_no
+
+        usernames: Dict[str, str] = {}
+        try:
+            for u in _paginate(client, "admin/users", limit=100):
+                u_name = (u.get("userName") or u.get("username") or "").strip().lower()
+                emp = u.get("employee") if isinstance(u.get("employee"), dict) else {}
+                emp_no = emp.get("empNumber") or u.get("empNumber")
+                if u_name and emp_no:
+                    usernames[u_name] = str(emp_no)
+        except Exception:
+            usernames = dict(self._usernames)  # sem permissões para admin/users: mantém o anterior
+
+        with self._lock:
+            self._emails = emails
+            self._usernames = usernames
+            self._built_at = time.time()
+            self._save()
+
+    def _refresh(self, client: _OrangeHRMClient):
+        try:
+            self.rebuild(client)
+            self.last_error = ""
+        except Exception as e:
+            # Permissões/rede: fica visível no diagnóstico e só se tenta de novo daqui a 1 minuto
+            self.last_error = f"{type(e).__name__}: {e}"
+            self._retry_at = time.time() + 60
+
+    def ensure_fresh(self, client: _OrangeHRMClient):
+        """
+        Índice vazio: constrói já (uma recolha para todas as sessões; numa falha, as consultas
+        seguem pelo caminho lento). Índice antigo: renova em segundo plano e serve o atual.
+        """
+        if time.time() < self._retry_at:
+            return
+        if not self._built_at:
+            with self._build_lock:
+                if not self._built_at and time.time() >= self._retry_at:
+                    self._refresh(client)
+            return
+        if time.time() - self._built_at < self.ttl:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self._refresh(client)
+            finally:
+                self._refreshing = False
+
+        _start_daemon_thread(_run, "orangehrm-identity-index")
+
+@st.cache_resource(show_spinner=False)
+def _identity_index_for(path: str, ttl: float) -> _IdentityIndex:
+    return _IdentityIndex(path, ttl)
+
+def _identity_index(client: _OrangeHRMClient) -> _IdentityIndex:
+    """Índice do host do cliente (TTL em ORANGEHRM_IDENTITY_INDEX_TTL, por omissão 6 h)."""
+    try:
+        ttl = float(_get_setting("identity_index_ttl") or 6 * 3600)
+    except (TypeError, ValueError):
+        ttl = 6 * 3600.0
+    host_key = hashlib.sha1(client.api_base.encode("utf-8")).hexdigest()[:12]
+    return _identity_index_for(os.path.join(_orangehrm_cache_dir(), f"identity-{host_key}.json"), ttl)
+
 def _map_email_to_empnumber(client: _OrangeHRMClient, email: str) -> Optional[str]:
     if not email:
         return None
     email_l = email.strip().lower()
 
+    # 0) Índice partilhado (sem pedidos à API no caminho normal)
+    index = _identity_index(client)
+    index.ensure_fresh(client)
+    emp_no = index.lookup(email_l)
+    if emp_no:
+        client.metrics.cache_hit("pim/employees")
+        return emp_no
+    emp_no = _map_email_to_empnumber_remote(client, email_l)
+    if emp_no:
+        index.remember(email_l, emp_no)
+    return emp_no
+
+def _map_email_to_empnumber_remote(client: _OrangeHRMClient, email_l: str) -> Optional[str]:
+    """Caminho lento (colaborador ainda não indexado): pesquisa PIM, admin/users e listagem completa."""
     # 1) Tentativa por e-mail (workEmail) via PIM
     try:
         data = client.request("GET", f"pim/employees?limit=50&includeEmployees=currentAndPast&email={email_l}")
@@ -1255,9 +4080,8 @@ def _map_email_to_empnumber(client: _OrangeHRMClient, email: str) -> Optional[st
 
     # 3) Fallback: listar todos via PIM e comparar pelo workEmail (caso 1 não resulte)
     try:
-        employees, _emp_map, _all = _cached_employees_and_map(
-            _get_setting("domain") or "", _get_setting("client_id") or "", _get_setting("refresh_token") or ""
-        )
+        domain, client_id, refresh_token, _api_base, _token_url = _orangehrm_service_settings()
+        employees, _emp_map, _all = _cached_employees_and_map(domain, client_id, refresh_token)
         for emp in employees:
             work = (emp.get("workEmail") or emp.get("email") or "").strip().lower()
             if work == email_l and emp.get("empNumber"):
@@ -1267,6 +4091,139 @@ def _map_email_to_empnumber(client: _OrangeHRMClient, email: str) -> Optional[st
 
     return None
 
+# =============================
+# Pré-aquecimento em segundo plano (colaboradores, projetos, folhas de horas recentes)
+# =============================
+
+def _orangehrm_service_settings() -> Tuple[str, str, str, str, str]:
+    """(domain, client_id, refresh_token, api_base, token_url) da conta de serviço."""
+    domain = _get_setting("domain") or "https://rh.inobest.com/web/index.php/"
+    client_id = _get_setting("client_id") or ""
+    refresh_token = _get_setting("refresh_token") or ""
+    return domain, client_id, refresh_token, domain.rstrip("/") + "/api/v2/", domain.rstrip("/") + "/oauth2/token"
+
+def _parse_hour_window(spec: str, default: Tuple[int, int]) -> Tuple[int, int]:
+    """"20-7" -> (20, 7): das 20h às 7h (pode atravessar a meia-noite)."""
+    try:
+        start, end = (int(p) % 24 for p in (spec or "").split("-", 1))
+        return start, end
+    except ValueError:
+        return default
+
+class _OrangeHRMPrewarmer:
+    """
+    Thread daemon (uma por processo) que mantém quentes os dados do OrangeHRM:
+    lista de colaboradores, catálogo de projetos e folhas de horas dos últimos dias
+    (no store local). De noite corre mais vezes e recua mais dias; de dia faz uma
+    sincronização leve das semanas recentes.
+    """
+    def __init__(self, settings: Tuple[str, str, str, str, str], day_interval: float, night_interval: float,
+                 night_hours: Tuple[int, int], day_days: int, night_days: int):
+        self.settings = settings
+        self.day_interval, self.night_interval = day_interval, night_interval
+        self.night_hours = night_hours
+        self.day_days, self.night_days = day_days, night_days
+        self.runs = 0
+        self.last_run_at = 0.0
+        self.next_run_at = time.time()
+        self.last_error = ""
+        self.last_stats: Dict[str, Any] = {}
+        # dias recuados -> (de, até, empNumbers, início da sincronização)
+        self._synced: Dict[int, Tuple[str, str, frozenset, float]] = {}
+        self._lock = threading.Lock()
+        # Thread própria (sem contexto de sessão): vive enquanto o processo viver
+        self._thread = threading.Thread(target=self._loop, name="orangehrm-prewarm", daemon=True)
+        self._thread.start()
+
+    def is_night(self, now: Optional[datetime] = None) -> bool:
+        start, end = self.night_hours
+        h = (now or datetime.now()).hour
+        return (h >= start or h < end) if start > end else (start <= h < end)
+
+    def _loop(self):
+        while True:
+            time.sleep(max(self.next_run_at - time.time(), 0.0))
+            night = self.is_night()
+            try:
+                self.run_once(self.night_days if night else self.day_days)
+            except Exception as e:  # nunca deixar a thread morrer
+                self.last_error = f"{type(e).__name__}: {e}"
+            self.next_run_at = time.time() + (self.night_interval if night else self.day_interval)
+
+    def run_once(self, days: int):
+        domain, client_id, refresh_token, api_base, token_url = self.settings
+        started = time.time()
+        self.last_run_at = started
+        client = _OrangeHRMClient(client_id, refresh_token, token_url, api_base)
+        _employees, _emp_map, emp_numbers = _cached_employees_and_map(domain, client_id, refresh_token)
+        _project_catalogue(client).ensure_fresh(client)
+        today = datetime.now().date().toordinal()
+        # Até ~2 meses à frente: consultas "este mês"/"próximo mês" ficam cobertas pelo pré-aquecimento
+        from_date = datetime.fromordinal(today - days).date()
+        to_date = datetime.fromordinal(today + 62).date()
+        _fetched, stats = _sync_timesheet_store(
+            client, _timesheet_store(), emp_numbers, from_date.isoformat(), to_date.isoformat()
+        )
+        with self._lock:
+            self._synced[days] = (from_date.isoformat(), to_date.isoformat(), frozenset(emp_numbers), started)
+        self.runs += 1
+        self.last_error = ""
+        self.last_stats = {**stats, "employees": len(emp_numbers), "days": days, "seconds": round(time.time() - started, 1)}
+
+    def warm_as_of(self, emp_numbers: List[str], from_date: Optional[str], to_date: Optional[str],
+                   max_age: float) -> Optional[float]:
+        """
+        Início da sincronização mais recente que cobre o pedido (colaboradores e período),
+        se tiver menos de `max_age` segundos; None se o pedido tiver de ir à API.
+        """
+        if not from_date or not to_date:
+            return None
+        best: Optional[float] = None
+        with self._lock:
+            synced = list(self._synced.values())
+        for s_from, s_to, emps, at in synced:
+            if time.time() - at > max_age or from_date < s_from or to_date > s_to:
+                continue
+            if not set(map(str, emp_numbers)) <= emps:
+                continue
+            best = at if best is None else max(best, at)
+        return best
+
+@st.cache_resource(show_spinner=False)
+def _orangehrm_prewarmer_for(settings: Tuple[str, str, str, str, str], day_interval: float, night_interval: float,
+                             night_hours: Tuple[int, int], day_days: int, night_days: int) -> _OrangeHRMPrewarmer:
+    return _OrangeHRMPrewarmer(settings, day_interval, night_interval, night_hours, day_days, night_days)
+
+def _orangehrm_prewarm_max_age() -> float:
+    """Idade máxima (s) dos dados pré-aquecidos servidos sem ir à API (ORANGEHRM_PREWARM_MAX_AGE, por omissão 2 h)."""
+    try:
+        return float(_get_setting("prewarm_max_age") or 7200)
+    except (TypeError, ValueError):
+        return 7200.0
+
+def _orangehrm_prewarmer() -> Optional[_OrangeHRMPrewarmer]:
+    """
+    Arranca (uma vez por processo) o pré-aquecimento se ORANGEHRM_PREWARM estiver ativo.
+    Agenda: ORANGEHRM_PREWARM_DAY_INTERVAL / _NIGHT_INTERVAL (s, por omissão 3600 / 900),
+    ORANGEHRM_PREWARM_NIGHT_HOURS (por omissão "20-7") e ORANGEHRM_PREWARM_DAY_DAYS /
+    _NIGHT_DAYS (dias recuados, por omissão 14 / 120).
+    """
+    if str(_get_setting("prewarm") or "").lower() not in ("1", "true", "yes", "on"):
+        return None
+    settings = _orangehrm_service_settings()
+    if not (settings[1] and settings[2]):
+        return None
+    try:
+        day_interval = float(_get_setting("prewarm_day_interval") or 3600)
+        night_interval = float(_get_setting("prewarm_night_interval") or 900)
+        day_days = int(_get_setting("prewarm_day_days") or 14)
+        night_days = int(_get_setting("prewarm_night_days") or 120)
+    except (TypeError, ValueError):
+        day_interval, night_interval, day_days, night_days = 3600.0, 900.0, 14, 120
+    night_hours = _parse_hour_window(_get_setting("prewarm_night_hours") or "20-7", (20, 7))
+    return _orangehrm_prewarmer_for(settings, max(day_interval, 60.0), max(night_interval, 60.0),
+                                    night_hours, day_days, night_days)
+
 # =============================
 # OrangeHRM OAuth Bootstrap Tab
 # =============================
@@ -1365,11 +4322,8 @@ def render_orangehrm_oauth_bootstrap_tab():
 # =============================
 
 def render_orangehrm_pivot_tab():
-    domain = _get_setting("domain") or "https://rh.inobest.com/web/index.php/"
-    client_id = _get_setting("client_id") or ""
-    refresh_token = _get_setting("refresh_token") or ""
-    api_base = domain.rstrip("/") + "/api/v2/"
-    token_url = domain.rstrip("/") + "/oauth2/token"
+    domain, client_id, refresh_token, api_base, token_url = _orangehrm_service_settings()
+    prewarmer = _orangehrm_prewarmer()
 
     st.header("Folhas de Horas — Tabela Dinâmica por Colaborador")
 
@@ -1380,6 +4334,8 @@ def render_orangehrm_pivot_tab():
         to_date = st.date_input("Até (fim do período)", None, format="YYYY-MM-DD", key="ts_to_date")
     with c3:
         run_btn = st.button("Gerar Tabela Dinâmica", key="run_pivot_btn")
+        full_reload = st.checkbox("Ignorar cache local", value=False, key="ts_full_reload",
+                                  help="Descarrega de novo todas as folhas de horas do período.")
     from_date_str = from_date.isoformat() if from_date else None
     to_date_str = to_date.isoformat() if to_date else None
 
@@ -1415,87 +4371,364 @@ def render_orangehrm_pivot_tab():
         emp_map = {str(emp_number): st.session_state.get("o365_auth", {}).get("name") or "Eu"}
         client_for_calls = service_client
 
+    if _is_admin_o365():
+        with st.expander("Ligações HTTP ao OrangeHRM (diagnóstico)"):
+            http_stats = _orangehrm_http().stats()
+            if http_stats:
+                st.dataframe(pd.DataFrame(http_stats), use_container_width=True)
+            else:
+                st.caption("Ainda não foram feitos pedidos neste processo.")
+            resilience_stats = _orangehrm_resilience().stats()
+            if resilience_stats:
+                st.dataframe(pd.DataFrame(resilience_stats), use_container_width=True)
+            metrics = _orangehrm_metrics()
+            endpoint_stats = metrics.snapshot()
+            if endpoint_stats:
+                st.markdown("**Pedidos por endpoint** (latências na janela dos últimos 2048 pedidos)")
+                st.dataframe(pd.DataFrame(endpoint_stats), use_container_width=True)
+            if metrics.path:
+                gravado = datetime.fromtimestamp(metrics.last_flush_at).strftime("%H:%M:%S") if metrics.last_flush_at else "—"
+                st.caption(f"Métricas exportadas para {metrics.path} a cada {metrics.flush_interval:.0f}s (última: {gravado}).")
+                if metrics.last_flush_error:
+                    st.warning(f"Falha ao gravar métricas: {metrics.last_flush_error}")
+            directory = _employee_directory(domain, client_id)
+            if directory.built_at:
+                st.caption(
+                    f"Diretório de colaboradores: {len(directory.snapshot()[0])}, atualizado às "
+                    f"{datetime.fromtimestamp(directory.built_at).strftime('%H:%M:%S')} "
+                    f"(completo às {datetime.fromtimestamp(directory.full_built_at).strftime('%d/%m %H:%M')})."
+                )
+            if directory.last_error:
+                st.warning(f"Última renovação do diretório de colaboradores falhou: {directory.last_error}")
+            identity = _identity_index(service_client)
+            if identity.last_error:
+                st.warning(f"Última construção do índice e-mail → colaborador falhou: {identity.last_error}")
+            tokens = service_client.tokens
+            validade = datetime.fromtimestamp(tokens.expires_at).strftime("%H:%M:%S") if tokens.access_token else "—"
+            st.caption(f"Token de acesso partilhado: {tokens.refresh_count} renovação(ões) neste processo; válido até {validade}.")
+            if prewarmer is None:
+                st.caption("Pré-aquecimento em segundo plano desligado (ORANGEHRM_PREWARM).")
+            else:
+                ultima = datetime.fromtimestamp(prewarmer.last_run_at).strftime("%d/%m %H:%M") if prewarmer.last_run_at else "—"
+                proxima = datetime.fromtimestamp(prewarmer.next_run_at).strftime("%d/%m %H:%M")
+                st.caption(
+                    f"Pré-aquecimento ({'noite' if prewarmer.is_night() else 'dia'}): {prewarmer.runs} execução(ões), "
+                    f"última às {ultima}, próxima às {proxima}. {prewarmer.last_stats or ''}"
+                )
+                if prewarmer.last_error:
+                    st.warning(f"Última execução do pré-aquecimento falhou: {prewarmer.last_error}")
+
+    # Estratégia: relatório agregado (um pedido paginado por colaborador) quando a instância o
+    # suporta e só se querem totais por cliente/projeto; senão folhas de horas + entradas
+    report_name = _orangehrm_report_name(client_for_calls, emp_choices)
+    use_report = bool(report_name) and st.checkbox(
+        "Só totais por cliente/projeto (relatório agregado, muito mais rápido)", value=False, key="ts_use_report",
+        help="Usa o relatório de horas do OrangeHRM: sem tabela dinâmica por folha de horas; "
+             "conta só as horas dos dias dentro do período.",
+    )
+
+    user = st.session_state.get("o365_auth", {}).get("email", "") or "service"
+    crawls = _timesheet_crawls()
     if run_btn:
-        with st.spinner("A obter folhas de horas e a calcular totais..."):
-            rows = _get_totals_by_employee_and_timesheet(
-                client_for_calls, emp_choices, emp_map, from_date=from_date_str, to_date=to_date_str
-            )
-            pivot_df = _pivot_hours_by_employee_and_start(rows)
+        warm_at = None
+        if prewarmer is not None and not full_reload and not use_report:
+            warm_at = prewarmer.warm_as_of(emp_choices, from_date_str, to_date_str, _orangehrm_prewarm_max_age())
+        job = crawls.start(user, client_for_calls, _timesheet_store(), emp_choices, from_date_str, to_date_str,
+                           full_reload=full_reload, warm_at=warm_at, report_name=report_name if use_report else None)
+    else:
+        job = crawls.latest(user)  # recolha em curso (ou recente) sobrevive a reruns e recarregamentos
+    if job is None:
+        return
+
+    if not job.finished:
+        _render_timesheet_progress(job, emp_map)
+        return
+
+    if job.error:
+        st.error(f"A recolha falhou: {job.error}. A mostrar os dados que chegaram.")
+    elif job.cancelled:
+        st.warning(
+            f"Recolha cancelada: dados parciais de {job.emp_done}/{job.emp_total} colaboradores"
+            + ("." if job.report_name else f" e {job.ts_done}/{job.ts_total} folhas de horas.")
+        )
+    if job.dataset is None:
+        return
+    dataset = job.dataset
+    # Subconjunto dos colaboradores já obtidos, mesmo período: filtra em memória, sem pedidos
+    shown = [e for e in map(str, emp_choices) if e in set(job.emp_numbers)]
+    same_period = (job.from_date, job.to_date) == (from_date_str, to_date_str)
+    if not same_period or len(shown) < len(emp_choices):
+        st.info("Os filtros mudaram desde a última recolha: carregue em «Gerar Tabela Dinâmica» para obter os dados em falta.")
+    if same_period and shown and len(shown) < len(job.emp_numbers):
+        dataset = _filter_dataset_employees(dataset, shown)
+        st.caption(f"A mostrar {len(shown)} dos {len(job.emp_numbers)} colaboradores já obtidos (filtrado em memória).")
+    else:
+        shown = list(job.emp_numbers)
+    sync = dataset.get("sync") or {}
+    as_of = datetime.fromtimestamp(job.warm_at or dataset["fetchedAt"]).strftime("%d/%m/%Y %H:%M")
+    periodo = f"{job.from_date or '…'} a {job.to_date or '…'}"
+    if job.report_name:
+        st.caption(
+            f"Dados de {as_of}, período {periodo}: relatório agregado de {sync.get('employees', 0)} colaboradores "
+            f"({sync.get('rows', 0)} linhas, {job.finished_at - job.started_at:.1f}s)."
+        )
+    elif job.warm_at is not None:
+        st.caption(
+            f"Dados de {as_of} (pré-aquecidos em segundo plano), período {periodo}: {sync.get('cached', 0)} folhas de horas. "
+            "Marque «Ignorar cache local» para obter os dados atuais."
+        )
+    elif sync:
+        st.caption(
+            f"Dados de {as_of}, período {periodo}. Folhas de horas: {sync.get('listed', 0)} no período — "
+            f"{sync.get('fetched', 0)} descarregadas, {sync.get('cached', 0)} servidas do cache local"
+            + (f"; {sync['weeks_cached']} semanas × colaborador já sincronizadas nem foram listadas"
+               if sync.get("weeks_cached") else "")
+            + f" ({job.finished_at - job.started_at:.1f}s)."
+        )
+    _render_timesheet_results(dataset, emp_map)
+    cube = job.cube()
+    if cube is not None and len(cube):
+        _render_hours_explorer(cube, emp_map, shown)
+
+def _render_hours_explorer(cube: _HoursCube, emp_map: Dict[str, str], emp_numbers: List[str]):
+    """Vistas livres sobre o cubo (linhas × colunas × filtros); só este bloco é redesenhado ao mudar as opções."""
+    @st.fragment
+    def _explorer():
+        dims = cube.dimensions()
+        labels = list(dims)
+        c1, c2 = st.columns(2)
+        with c1:
+            rows_label = st.selectbox("Linhas", labels, index=labels.index("Cliente") if "Cliente" in labels else 0,
+                                      key="cube_rows")
+        with c2:
+            col_options = ["(nenhuma)"] + labels
+            cols_label = st.selectbox("Colunas", col_options,
+                                      index=col_options.index("Semana") if "Semana" in labels else 0, key="cube_cols")
+        f1, f2 = st.columns(2)
+        with f1:
+            clients = st.multiselect("Clientes", cube.members("client"), key="cube_clients")
+        with f2:
+            projects = st.multiselect("Projetos", cube.members("project"), key="cube_projects")
+        started = time.perf_counter()
+        view = cube.pivot(dims[rows_label], dims.get(cols_label),
+                          {"emp": emp_numbers, "client": clients, "project": projects}, emp_map)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if view.empty:
+            st.info("Sem horas para esta combinação de filtros.")
+        else:
+            st.dataframe(view, use_container_width=True)
+        st.caption(f"{len(cube)} linhas no cubo; vista calculada em {elapsed_ms:.0f} ms, sem pedidos à API.")
+
+    with st.expander("Explorar horas (ex.: cliente × semana, projeto × colaborador) sem novos pedidos"):
+        _explorer()
+
+def _render_timesheet_progress(job: _TimesheetCrawl, emp_map: Dict[str, str]):
+    """Progresso da recolha (atualizado a cada segundo) com tabela dinâmica parcial e botão de cancelar."""
+    @st.fragment(run_every=1.0)
+    def _progress():
+        if job.finished:
+            st.rerun()  # resultado completo: redesenha a página inteira
+        elapsed = f"{time.time() - job.started_at:.0f}s"
+        if job.report_name:
+            frac = job.emp_done / job.emp_total if job.emp_total else 0.0
+            st.progress(min(frac, 1.0), text=f"Relatório agregado — colaboradores: {job.emp_done}/{job.emp_total} · {elapsed}")
+        else:
+            listing = "" if job.emp_done == job.emp_total else " (a listar…)"
+            frac = job.ts_done / job.ts_total if job.ts_total and job.emp_done == job.emp_total else (
+                0.5 * job.emp_done / job.emp_total if job.emp_total else 0.0)
+            st.progress(min(frac, 1.0), text=(
+                f"Colaboradores: {job.emp_done}/{job.emp_total} · "
+                f"folhas de horas: {job.ts_done}/{job.ts_total}{listing} · {elapsed}"
+            ))
+        if job.cancelled:
+            st.caption("A cancelar…")
+        elif st.button("Cancelar", key="cancel_pivot_btn"):
+            job.cancel()
+            st.caption("A cancelar…")
+        if job.report_name:
+            return
+        pivot_df = _pivot_hours_by_employee_and_start(_timesheet_totals_rows(job.partial_dataset(), emp_map))
+        st.subheader("Horas por Colaborador × Data de Início da Folha de Horas (parcial)")
+        if pivot_df.empty:
+            st.info("À espera das primeiras folhas de horas…")
+        else:
+            st.dataframe(pivot_df, use_container_width=True)
+
+    _progress()
+
+_XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+_XLSX_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+def _xlsx_rows(df: pd.DataFrame, index: bool = False) -> Iterator[List[Any]]:
+    """Cabeçalho + linhas de um DataFrame, uma de cada vez (NaN -> célula vazia)."""
+    header = list(map(str, df.columns))
+    yield ([str(df.index.name or "")] + header) if index else header
+    for row in df.itertuples(index=index, name=None):
+        yield [None if isinstance(v, float) and v != v else v for v in row]
+
+def _xlsx_sheet_title(name: Any, used: set) -> str:
+    """Nome de folha válido no Excel (≤31 caracteres, sem []:*?/\\) e único no livro."""
+    base = re.sub(r"[\[\]:*?/\\]", "_", str(name or "")).strip("'")[:28] or "Sem_Nome"
+    title, n = base, 1
+    while title.lower() in used:
+        n += 1
+        title = f"{base[:28 - len(str(n))]}_{n}"
+    used.add(title.lower())
+    return title
+
+def _write_xlsx_stream(sheets: Iterable[Tuple[str, Iterable[List[Any]]]]):
+    """
+    Livro openpyxl em modo write_only: as linhas de cada folha são escritas à medida que
+    o iterador as produz (memória constante) e as folhas só são geradas quando chega a vez
+    delas. O resultado fica num SpooledTemporaryFile (memória até 8 MB, depois disco).
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    used: set = set()
+    for name, rows in sheets:
+        ws = wb.create_sheet(_xlsx_sheet_title(name, used))
+        for row in rows:
+            ws.append(row)
+    out = tempfile.SpooledTemporaryFile(max_size=_XLSX_SPOOL_MAX_BYTES)
+    try:
+        wb.save(out)
+    except BaseException:
+        out.close()
+        raise
+    return out
+
+class _DownloadFile(io.BufferedReader):
+    """
+    Ficheiro devolvido ao `data` (callable) de st.download_button. O Streamlit lê-o de uma vez
+    (seek(0) + read()) e não o fecha; fecha-se sozinho quando é lido até ao fim.
+    """
+    def read(self, size: Optional[int] = -1) -> bytes:
+        data = super().read(size)
+        if size is None or size < 0:
+            self.close()
+        return data
+
+def _xlsx_file(sheets: Iterable[Tuple[str, Iterable[List[Any]]]]) -> _DownloadFile:
+    """Gera o livro num temporário em disco e devolve-o para leitura (sem cópia em bytes do nosso lado)."""
+    out = _write_xlsx_stream(sheets)
+    try:
+        out.rollover()  # SpooledTemporaryFile: passa para disco para poder ser reaberto pelo descritor
+        return _DownloadFile(io.FileIO(os.dup(out.fileno()), "rb"))
+    finally:
+        out.close()
+
+def _pivot_xlsx_sheets(pivot_df: pd.DataFrame, rows: List[Dict[str, Any]]) -> Iterator[Tuple[str, Iterable[List[Any]]]]:
+    yield "Pivot", _xlsx_rows(pivot_df, index=True)
+    yield "Dados", _xlsx_rows(pd.DataFrame(rows))
+
+def _client_project_xlsx_sheets(ecp_df: pd.DataFrame) -> Iterator[Tuple[str, Iterable[List[Any]]]]:
+    """Folha resumo + uma folha por colaborador, geradas uma a uma."""
+    renamed = ecp_df.rename(columns={
+        "empName": "Colaborador",
+        "clientName": "Cliente",
+        "projectName": "Projeto",
+        "totalHours": "TotalHoras",
+    })
+    yield "Cliente_Projeto_por_Colab", _xlsx_rows(renamed[["Colaborador", "Cliente", "Projeto", "TotalHoras"]])
+    for emp, g in renamed.groupby("Colaborador", sort=False):
+        yield emp, _xlsx_rows(g[["Cliente", "Projeto", "TotalHoras"]])
+
+def _render_timesheet_results(dataset: Dict[str, Any], emp_map: Dict[str, str]):
+    """Tabela dinâmica, totais por cliente/projeto e exportações Excel de um dataset completo."""
+    # Relatório agregado: não há horas por folha de horas, só a secção cliente/projeto
+    if dataset.get("source") != "report":
+        rows = _timesheet_totals_rows(dataset, emp_map)
+        pivot_df = _pivot_hours_by_employee_and_start(rows)
         st.subheader("Horas por Colaborador × Data de Início da Folha de Horas")
         if pivot_df.empty:
             st.info("Não foram encontrados dados para os filtros selecionados.")
         else:
             st.dataframe(pivot_df, use_container_width=True)
-            xlsx_buffer = BytesIO()
-            with pd.ExcelWriter(xlsx_buffer, engine="openpyxl") as writer:
-                pivot_df.to_excel(writer, sheet_name="Pivot", index=True)
-                pd.DataFrame(rows).to_excel(writer, sheet_name="Dados", index=False)
+            # O livro só é gerado quando o utilizador clica (thread à parte), não a cada rerun
             st.download_button(
                 "Descarregar Excel",
-                data=xlsx_buffer.getvalue(),
+                data=lambda: _xlsx_file(_pivot_xlsx_sheets(pivot_df, rows)),
                 file_name="folhas_horas_pivot.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                mime=_XLSX_MIME,
                 key="dl_xlsx_button",
             )
 
-        st.subheader("Cliente/Projeto por Colaborador — Totais de Horas")
-        with st.spinner("A obter entradas e a agregar por cliente e projeto..."):
-            ecp_rows = _get_hours_by_employee_client_project(
-                client_for_calls,
-                emp_choices,
-                emp_map,
-                from_date=from_date_str,
-                to_date=to_date_str,
-            )
-            ecp_df = pd.DataFrame(ecp_rows)
-        if ecp_df.empty:
-            st.info("Não foram encontrados dados por cliente/projeto para os filtros selecionados.")
-        else:
-            ecp_df = ecp_df.sort_values(by=["empName", "clientName", "totalHours"], ascending=[True, True, False])
-            for emp, g in ecp_df.groupby("empName", sort=False):
-                st.markdown(f"### {emp}")
-                show = g[["clientName", "projectName", "totalHours"]].rename(columns={
-                    "clientName": "Cliente",
-                    "projectName": "Projeto",
-                    "totalHours": "Total de Horas",
-                })
-                st.dataframe(show.reset_index(drop=True), use_container_width=True)
-            ecp_xlsx_buffer = BytesIO()
-            with pd.ExcelWriter(ecp_xlsx_buffer, engine="openpyxl") as writer:
-                ecp_df.rename(columns={
-                    "empName": "Colaborador",
-                    "clientName": "Cliente",
-                    "projectName": "Projeto",
-                    "totalHours": "TotalHoras",
-                })[["Colaborador", "Cliente", "Projeto", "TotalHoras"]].to_excel(writer, sheet_name="Cliente_Projeto_por_Colab", index=False)
-                for emp, g in ecp_df.groupby("empName", sort=False):
-                    g.rename(columns={
-                        "clientName": "Cliente",
-                        "projectName": "Projeto",
-                        "totalHours": "TotalHoras",
-                    })[["Cliente", "Projeto", "TotalHoras"]].to_excel(
-                        writer, sheet_name=(str(emp)[:28] or "Sem_Nome"), index=False
-                    )
-            st.download_button(
-                "Descarregar Excel (Cliente/Projeto por Colaborador)",
-                data=ecp_xlsx_buffer.getvalue(),
-                file_name="folhas_horas_cliente_projeto_por_colaborador.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key="dl_xlsx_cliente_projeto_por_colab",
-            )
+    st.subheader("Cliente/Projeto por Colaborador — Totais de Horas")
+    ecp_df = pd.DataFrame(_client_project_rows(dataset, emp_map))
+    if ecp_df.empty:
+        st.info("Não foram encontrados dados por cliente/projeto para os filtros selecionados.")
+    else:
+        ecp_df = ecp_df.sort_values(by=["empName", "clientName", "totalHours"], ascending=[True, True, False])
+        for emp, g in ecp_df.groupby("empName", sort=False):
+            st.markdown(f"### {emp}")
+            show = g[["clientName", "projectName", "totalHours"]].rename(columns={
+                "clientName": "Cliente",
+                "projectName": "Projeto",
+                "totalHours": "Total de Horas",
+            })
+            st.dataframe(show.reset_index(drop=True), use_container_width=True)
+        st.download_button(
+            "Descarregar Excel (Cliente/Projeto por Colaborador)",
+            data=lambda: _xlsx_file(_client_project_xlsx_sheets(ecp_df)),
+            file_name="folhas_horas_cliente_projeto_por_colaborador.xlsx",
+            mime=_XLSX_MIME,
+            key="dl_xlsx_cliente_projeto_por_colab",
+        )
 
 # =============================
 # Tabs
 # =============================
 
-tab1, tab2, tab3, tab4, tab5 = st.tabs(["Agregador de Excel", "SAF-T Faturação → CSV", "Extrator QR Code", "Configuração OAuth (Admin)", "Timesheets Pivot"])
-with tab1:
-    excel_aggregator_app()
-with tab2:
-    saf_t_tab()
-with tab3:
-    tab_extrator_qr()
-with tab4:
-    render_orangehrm_oauth_bootstrap_tab()
-with tab5:
-    render_orangehrm_pivot_tab()
+def main():
+    # Configuração da página
+    st.set_page_config(layout="wide", page_title="Ferramentas Inobest — O365 + OrangeHRM")
+
+    # Enforce global login
+    if not ensure_o365_login():
+        st.stop()
+
+    # Header with logout
+    o365_logout_button()
+
+    _orangehrm_prewarmer()  # arranca o pré-aquecimento uma vez por processo (se ativo)
+
+    _run_active_tool()
+
+# Ferramentas da aplicação: (título, função que a desenha, caminho no URL)
+_TOOLS = [
+    ("Agregador de Excel", excel_aggregator_app, "excel"),
+    ("SAF-T Faturação → CSV", saf_t_tab, "saft"),
+    ("Extrator QR Code", tab_extrator_qr, "qr"),
+    ("Configuração OAuth (Admin)", render_orangehrm_oauth_bootstrap_tab, "oauth"),
+    ("Timesheets Pivot", render_orangehrm_pivot_tab, "timesheets"),
+    ("Minhas tarefas", render_jobs_page, "tarefas"),
+]
+# st.Page criadas em _run_active_tool, por caminho (st.switch_page precisa das mesmas páginas)
+_PAGES: Dict[str, Any] = {}
+
+def _run_active_tool():
+    """
+    Corre só a ferramenta selecionada. Com st.tabs todas as abas corriam em cada rerun
+    (incluindo pedidos ao OrangeHRM na aba de timesheets); com páginas, as restantes não
+    executam nada até serem abertas.
+    """
+    if hasattr(st, "navigation"):
+        _PAGES.clear()
+        _PAGES.update((path, st.Page(fn, title=title, url_path=path, default=(i == 0)))
+                      for i, (title, fn, path) in enumerate(_TOOLS))
+        pages = list(_PAGES.values())
+        try:
+            nav = st.navigation(pages, position="top")
+        except TypeError:  # Streamlit < 1.46: sem navegação no topo
+            nav = st.navigation(pages)
+        nav.run()
+        return
+    # Streamlit antigo (sem páginas): seletor na barra lateral
+    titles = [title for title, _, _ in _TOOLS]
+    choice = st.sidebar.radio("Ferramenta", titles, key="active_tool")
+    dict((title, fn) for title, fn, _ in _TOOLS)[choice]()
+
+# `streamlit run` executa o script como __main__; importar o módulo (benchmarks, scripts) não desenha a UI
+if __name__ == "__main__":
+    main()
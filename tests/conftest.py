@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _saft_invoice(no, customer, lines, status="N", extra_gross=0.0):
+    body, net, tax = [], 0.0, 0.0
+    for i, (product, qty, price) in enumerate(lines, 1):
+        amount = round(qty * price, 2)
+        tax_amount = round(amount * 0.23, 2)
+        net, tax = net + amount, tax + tax_amount
+        body.append(
+            f"<Line><LineNumber>{i}</LineNumber><ProductCode>{product}</ProductCode>"
+            f"<ProductDescription>{product}</ProductDescription><Quantity>{qty}</Quantity>"
+            f"<UnitOfMeasure>UN</UnitOfMeasure><UnitPrice>{price}</UnitPrice><Description>x</Description>"
+            f"<CreditAmount>{amount:.2f}</CreditAmount><Tax><TaxCountryRegion>PT</TaxCountryRegion>"
+            f"<TaxAmount>{tax_amount:.2f}</TaxAmount></Tax></Line>"
+        )
+    xml = (
+        f"<Invoice><InvoiceNo>{no}</InvoiceNo><DocumentStatus><InvoiceStatus>{status}</InvoiceStatus></DocumentStatus>"
+        f"<Period>1</Period><InvoiceDate>2024-01-10</InvoiceDate><InvoiceType>FT</InvoiceType>"
+        f"<CustomerID>{customer}</CustomerID>{''.join(body)}<DocumentTotals><TaxPayable>{tax:.2f}</TaxPayable>"
+        f"<NetTotal>{net:.2f}</NetTotal><GrossTotal>{net + tax + extra_gross:.2f}</GrossTotal></DocumentTotals></Invoice>"
+    )
+    return xml, net
+
+
+@pytest.fixture
+def saft_xml():
+    """SAF-T mínimo: 2 clientes, 2 produtos e 2 faturas (TotalCredit declarado = soma das linhas)."""
+    def build(extra_gross=0.0, declared_credit_delta=0.0):
+        customers = "".join(
+            f"<Customer><CustomerID>C{c}</CustomerID><CustomerTaxID>50000000{c}</CustomerTaxID>"
+            f"<CompanyName>Cliente {c}</CompanyName><BillingAddress><Country>PT</Country></BillingAddress></Customer>"
+            for c in (1, 2)
+        )
+        products = "".join(
+            f"<Product><ProductType>S</ProductType><ProductCode>P{p}</ProductCode>"
+            f"<ProductGroup>G</ProductGroup><ProductNumberCode>N{p}</ProductNumberCode></Product>"
+            for p in (1, 2)
+        )
+        inv1, net1 = _saft_invoice("FT A/1", "C1", [("P1", 2, 10.0), ("P2", 1, 5.5)])
+        inv2, net2 = _saft_invoice("FT A/2", "C2", [("P2", 3, 1.25)], extra_gross=extra_gross)
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<AuditFile xmlns="urn:OECD:StandardAuditFile-Tax:PT_1.04_01"><MasterFiles>'
+            f"{customers}{products}</MasterFiles><SourceDocuments><SalesInvoices>"
+            f"<NumberOfEntries>2</NumberOfEntries><TotalDebit>0.00</TotalDebit>"
+            f"<TotalCredit>{net1 + net2 + declared_credit_delta:.2f}</TotalCredit>"
+            f"{inv1}{inv2}</SalesInvoices></SourceDocuments></AuditFile>"
+        ).encode("utf-8")
+    return build
@@ -0,0 +1,28 @@
+"""Regras de conversão das durações do OrangeHRM em horas (_duration_hours)."""
+import pytest
+
+pd = pytest.importorskip("pandas")
+import streamlit_app as app
+
+
+@pytest.mark.parametrize("value, hours, report_hours", [
+    ("08:00", 8.0, 8.0),
+    ("7:30", 7.5, 7.5),
+    (" 7 : 05 ", 7 + 5 / 60, 7 + 5 / 60),
+    ("-1:30", -1.5, -1.5),
+    ("7.50", 0.0, 7.5),  # texto decimal só conta nos relatórios
+    (6, 6.0, 6.0),
+    (2.25, 2.25, 2.25),
+    (None, 0.0, 0.0),
+    ("", 0.0, 0.0),
+    ("abc", 0.0, 0.0),
+])
+def test_duration_hours(value, hours, report_hours):
+    series = pd.Series([value, value], dtype="object")
+    assert app._duration_hours(series).tolist() == pytest.approx([hours, hours])
+    assert app._duration_hours(series, decimal_text=True).tolist() == pytest.approx([report_hours, report_hours])
+
+
+def test_duration_hours_keeps_index():
+    series = pd.Series(["1:00", None, 3], index=[10, 20, 30], dtype="object")
+    assert app._duration_hours(series).to_dict() == {10: 1.0, 20: 0.0, 30: 3.0}
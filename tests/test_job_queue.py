@@ -0,0 +1,179 @@
+"""Fila de tarefas em disco (_JobQueue): heartbeat e tarefas de outras máquinas."""
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import streamlit_app as app
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+
+    def make(token="test", **kwargs):
+        kwargs.setdefault("heartbeat_timeout", 300.0)
+        queue = app._JobQueue(str(tmp_path / "jobs"), 1, 3600, token=token, **kwargs)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.close(wait=False)
+
+
+def _write_job(root, job_id, **state):
+    workdir = os.path.join(root, job_id)
+    os.makedirs(workdir)
+    state = {"id": job_id, "kind": "qr", "owner": "u@x", "status": "running", "createdAt": time.time(), **state}
+    with open(os.path.join(workdir, "job.json"), "w", encoding="utf-8") as f:
+        json.dump(state, f)
+
+
+def test_heartbeat_while_job_does_not_report(make_queue):
+    queue = make_queue(heartbeat_timeout=0.4)
+    release = threading.Event()
+    job = queue.submit("qr", "u@x", "t", "k", lambda job: release.wait(5) and {}, {})
+    time.sleep(0.1)
+    first = job.heartbeat_at
+    time.sleep(0.3)
+    with open(job.path("job.json"), encoding="utf-8") as f:
+        on_disk = json.load(f)
+    release.set()
+    assert job.status == "running"
+    assert on_disk["heartbeatAt"] > first
+
+
+@pytest.mark.parametrize("age, status", [(10, "running"), (1000, "error")])
+def test_other_host_job_judged_by_heartbeat(make_queue, tmp_path, age, status):
+    root = str(tmp_path / "jobs")
+    os.makedirs(root)
+    _write_job(root, "remote", pid=1, host="outra-maquina", token="t", heartbeatAt=time.time() - age)
+    queue = make_queue(heartbeat_timeout=300.0)
+    assert queue.get("remote").status == status
+
+
+def test_jobs_lists_jobs_created_by_another_queue(make_queue, tmp_path):
+    viewer = make_queue()
+    assert viewer.jobs("u@x") == []
+    other = make_queue()  # outra réplica do mesmo processo a partilhar JOB_DIR
+    job = other.submit("qr", "u@x", "t", "k", lambda job: {"output": None}, {})
+    _write_job(str(tmp_path / "jobs"), "remote", pid=1, host="outra-maquina", token="t", heartbeatAt=time.time())
+    other.close()
+
+    listed = {j.id: j for j in viewer.jobs("u@x")}
+    assert set(listed) == {job.id, "remote"}
+    assert listed[job.id].status == "done"
+
+    other.remove(other.get(job.id))
+    viewer._scanned_at = 0.0  # sem esperar por RESCAN_INTERVAL
+    assert [j.id for j in viewer.jobs("u@x")] == ["remote"]
+
+
+def _wait(job, timeout=5.0):
+    deadline = time.time() + timeout
+    while not job.finished and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_submit_runs_job_and_removes_inputs(make_queue):
+    queue = make_queue()
+    seen = {}
+
+    def fn(job):
+        with open(job.path("input.bin"), "rb") as f:
+            seen["input"] = f.read()
+        job.report(0.5, "a meio")
+        return {"output": {"name": "out.txt"}}
+
+    job = _wait(queue.submit("qr", "u@x", "t", "k", fn, {"input.bin": b"abc"}))
+    assert (job.status, job.progress, job.meta) == ("done", 1.0, {"output": {"name": "out.txt"}})
+    assert seen["input"] == b"abc"
+    assert not os.path.exists(job.path("input.bin"))
+    queue.close()  # espera pela gravação final de job.json
+    with open(job.path("job.json"), encoding="utf-8") as f:
+        assert json.load(f)["status"] == "done"
+
+
+def test_same_conversion_reused_unless_failed(make_queue):
+    queue = make_queue()
+    done = _wait(queue.submit("qr", "u@x", "t", "k", lambda job: {}, {}))
+    assert queue.submit("qr", "u@x", "t", "k", lambda job: {}, {}) is done
+    assert queue.submit("qr", "outro@x", "t", "k", lambda job: {}, {}) is not done
+
+    failed = _wait(queue.submit("qr", "u@x", "t", "k2", lambda job: 1 / 0, {}))
+    assert failed.status == "error" and "division" in failed.error
+    assert queue.submit("qr", "u@x", "t", "k2", lambda job: {}, {}) is not failed
+
+
+def test_cancel_running_and_queued_jobs(make_queue):
+    queue = make_queue()  # 1 worker: a segunda tarefa fica em fila
+
+    def slow(job):
+        for i in range(200):
+            job.report(i / 200)
+            time.sleep(0.01)
+
+    running = queue.submit("qr", "u@x", "a", "a", slow, {})
+    queued = queue.submit("qr", "u@x", "b", "b", slow, {})
+    time.sleep(0.05)
+    queue.cancel(queued)
+    assert queued.status == "cancelled"
+    queue.cancel(running)
+    assert _wait(running).status == "cancelled"
+    assert running.progress < 1.0
+
+
+def test_restart_reaps_jobs_of_dead_owner_and_keeps_results(make_queue, tmp_path):
+    queue = make_queue(token="antes")
+    done = _wait(queue.submit("qr", "u@x", "t", "k", lambda job: {"n": 1}, {}))
+    hanging = queue.submit("qr", "u@x", "t", "k2", lambda job: time.sleep(0.5), {})
+    time.sleep(0.05)
+    _write_job(str(tmp_path / "jobs"), "legacy")  # sem pid: gravada por uma versão anterior
+
+    restarted = make_queue(token="depois")  # mesmo pid, outro token: o processo anterior morreu
+    assert restarted.get(done.id).meta == {"n": 1}
+    assert restarted.get(hanging.id).status == "error"
+    assert "reinício" in restarted.get(hanging.id).error
+    assert restarted.get("legacy").status == "error"
+
+
+def test_same_process_queue_reads_progress_from_disk(make_queue):
+    queue = make_queue()
+    release = threading.Event()
+    job = queue.submit("qr", "u@x", "t", "k", lambda job: release.wait(5) and {"n": 2}, {})
+    time.sleep(0.05)
+    other = make_queue()
+    assert other.get(job.id).status == "running"
+    release.set()
+    _wait(job)
+    assert other.get(job.id).status == "done" and other.get(job.id).meta == {"n": 2}
+
+
+def test_purge_after_ttl_and_incomplete_folders(make_queue, tmp_path):
+    root = tmp_path / "jobs"
+    queue = make_queue()
+    job = _wait(queue.submit("qr", "u@x", "t", "k", lambda job: {}, {}))
+    (root / "recente").mkdir()
+    (root / "antiga").mkdir()
+    os.utime(root / "antiga", (time.time() - 1000,) * 2)
+
+    expired = app._JobQueue(str(root), 1, 0.0, token="test")
+    expired.close()
+    assert expired.jobs("u@x") == []
+    assert sorted(os.listdir(root)) == ["recente"]
+    assert not os.path.exists(job.workdir)
+
+
+def test_remove_only_finished_jobs(make_queue):
+    queue = make_queue()
+    release = threading.Event()
+    running = queue.submit("qr", "u@x", "t", "k", lambda job: release.wait(5) and {}, {})
+    queue.remove(running)
+    assert queue.get(running.id) is running
+    release.set()
+    queue.remove(_wait(running))
+    assert queue.get(running.id) is None and not os.path.exists(running.workdir)
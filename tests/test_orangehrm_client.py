@@ -0,0 +1,184 @@
+"""Cliente OrangeHRM: paginação, disjuntor, limite AIMD e gestor de tokens."""
+import json
+import threading
+import time
+
+import pytest
+
+import streamlit_app as app
+
+
+class FakeClient:
+    """Serve `rows` em páginas de no máximo `cap` linhas; regista os pedidos (limit, offset)."""
+
+    def __init__(self, rows, cap=None, with_total=True):
+        self.rows, self.cap, self.with_total = rows, cap, with_total
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def request(self, method, path, params=None):
+        limit, offset = params["limit"], params["offset"]
+        with self._lock:
+            self.calls.append((limit, offset))
+        size = min(limit, self.cap or limit)
+        out = {"data": self.rows[offset:offset + size]}
+        if self.with_total:
+            out["meta"] = {"total": len(self.rows)}
+        return out
+
+
+ROWS = [{"empNumber": i} for i in range(23)]
+
+
+def test_paginate_with_total_fetches_remaining_pages_with_server_page_size():
+    client = FakeClient(ROWS, cap=5)
+    assert app._paginate(client, "pim/employees", limit=10) == ROWS
+    assert sorted(client.calls) == [(5, 5), (5, 10), (5, 15), (5, 20), (10, 0)]
+
+
+def test_paginate_without_total_stops_at_short_page():
+    client = FakeClient(ROWS, with_total=False)
+    assert app._paginate(client, "pim/employees", limit=10) == ROWS
+    assert client.calls == [(10, 0), (10, 10), (10, 20)]
+
+
+@pytest.mark.parametrize("with_total", [True, False])
+def test_paginate_max_rows(with_total):
+    client = FakeClient(ROWS, with_total=with_total)
+    assert app._paginate(client, "pim/employees", limit=5, max_rows=12) == ROWS[:12]
+
+
+def test_circuit_breaker_opens_probes_and_closes():
+    breaker = app._CircuitBreaker(threshold=2, cooldown=0.05)
+    breaker.record(False)
+    breaker.check("h")  # ainda abaixo do limiar
+    breaker.record(False)
+    assert breaker.state == "aberto"
+    with pytest.raises(app._CircuitOpenError):
+        breaker.check("h")
+
+    time.sleep(0.06)
+    assert breaker.state == "meio-aberto"
+    breaker.check("h")  # pedido de teste
+    with pytest.raises(app._CircuitOpenError):
+        breaker.check("h")  # só um pedido de teste de cada vez
+    breaker.record(True)
+    assert breaker.state == "fechado"
+    breaker.check("h")
+
+
+def test_circuit_breaker_failed_probe_reopens():
+    breaker = app._CircuitBreaker(threshold=1, cooldown=0.05)
+    breaker.record(False)
+    time.sleep(0.06)
+    breaker.check("h")
+    breaker.record(False)
+    assert breaker.state == "aberto"
+
+
+def _request(limiter, latency=0.0, throttled=False):
+    limiter.acquire()
+    started = time.monotonic() - latency
+    return lambda: limiter.release(started, throttled=throttled)
+
+
+def test_aimd_increases_only_when_saturated():
+    limiter = app._AdaptiveConcurrencyLimiter(initial=2, max_limit=4)
+    _request(limiter)()  # 1 de 2 em voo: não satura
+    assert limiter.limit == 2.0
+    done = [_request(limiter), _request(limiter)]
+    done[0]()  # saturado no momento da resposta: +1/limite
+    assert limiter.limit == pytest.approx(2.5)
+    done[1]()
+
+
+def test_aimd_halves_once_per_burst_of_429():
+    limiter = app._AdaptiveConcurrencyLimiter(initial=8, max_limit=8)
+    burst = [_request(limiter, throttled=True) for _ in range(4)]
+    for release in burst:
+        release()
+    assert limiter.limit == 4.0  # os 429 enviados antes do corte não cortam de novo
+    _request(limiter, throttled=True)()
+    assert limiter.limit == 2.0
+
+
+def test_aimd_slow_response_cuts_ten_percent_and_never_below_one():
+    limiter = app._AdaptiveConcurrencyLimiter(initial=4, max_limit=4, latency_tolerance=3.0)
+    limiter.base_latency = 0.02
+    _request(limiter, latency=0.5)()
+    assert limiter.limit == pytest.approx(3.6)
+    for _ in range(10):
+        _request(limiter, throttled=True)()
+    assert limiter.limit == 1.0
+
+
+class FakeResponse:
+    def __init__(self, payload, status=200):
+        self.status_code, self._payload = status, payload
+        self.ok = status < 400
+        self.text = json.dumps(payload)
+        self.content = self.text.encode()
+
+    def json(self):
+        return self._payload
+
+
+class FakeTokenServer:
+    def __init__(self, delay=0.05):
+        self.delay, self.posts = delay, []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, data=None, timeout=None):
+        time.sleep(self.delay)
+        with self._lock:
+            self.posts.append(data["refresh_token"])
+            n = len(self.posts)
+        return FakeResponse({"access_token": f"at{n}", "refresh_token": f"rt{n}", "expires_in": 3600})
+
+
+@pytest.fixture
+def token_server(monkeypatch):
+    server = FakeTokenServer()
+    monkeypatch.setattr(app, "_orangehrm_http", lambda: server)
+    return server
+
+
+def test_token_refresh_is_single_flight_and_shared(token_server, tmp_path):
+    shared = str(tmp_path / "tokens.json")
+    manager = app._OrangeHRMTokenManager("cid", "https://x/oauth2/token", shared, "rt0", margin=120)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(manager.get_access_token())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert token_server.posts == ["rt0"]
+    assert set(tokens) == {"at1"}
+    with open(shared, encoding="utf-8") as f:
+        assert json.load(f)["refresh_token"] == "rt1"  # refresh token rotativo guardado
+
+    # Outro processo (outro gestor, mesmo ficheiro) reutiliza o access token sem renovar
+    other = app._OrangeHRMTokenManager("cid", "https://x/oauth2/token", shared, "rt0", margin=120)
+    assert other.get_access_token() == "at1"
+    assert token_server.posts == ["rt0"]
+
+
+def test_token_refresh_skipped_when_failed_token_already_replaced(token_server, tmp_path):
+    manager = app._OrangeHRMTokenManager("cid", "https://x/oauth2/token", "", "rt0", margin=120)
+    first = manager.get_access_token()
+    assert manager.refresh(first) is True
+    assert manager.refresh(first) is True  # o token que falhou já foi trocado
+    assert token_server.posts == ["rt0", "rt1"]
+
+
+def test_token_refresh_failure_is_reported(monkeypatch):
+    class Refused:
+        def request(self, *a, **k):
+            return FakeResponse({"error": "invalid_grant"}, status=400)
+
+    monkeypatch.setattr(app, "_orangehrm_http", lambda: Refused())
+    manager = app._OrangeHRMTokenManager("cid", "https://x/oauth2/token", "", "rt0", margin=120)
+    with pytest.raises(RuntimeError, match="invalid_grant"):
+        manager.get_access_token()
+    assert manager.last_error.startswith("HTTP 400")
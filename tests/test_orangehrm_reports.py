@@ -0,0 +1,109 @@
+"""Relatório agregado time/reports/data: deteção, pedido batched e regresso às folhas de horas."""
+import itertools
+
+import pytest
+import requests
+
+import streamlit_app as app
+
+_hosts = itertools.count()
+
+REPORT = {
+    "1": [{"projectName": "P1", "customerName": "C1", "totalDuration": "2.50"}],
+    "2": [{"projectName": "P1", "customerName": "C1", "totalDuration": "1.00"},
+          {"projectName": "P2", "customerName": "C2", "totalDuration": "4.00"}],
+    "3": [{"projectName": "P2", "customerName": "C2", "totalDuration": "8.00"}],
+}
+
+
+def _http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status}", response=response)
+
+
+class FakeReportClient:
+    """
+    Simula time/reports/data com o nome `name`. batched: sem empNumber devolve todos os
+    colaboradores, com empNumber em cada linha (emp_field=False tira-o); senão 422.
+    refuse: empNumber cujo relatório dá 403.
+    """
+
+    def __init__(self, name="employee_time", batched=False, emp_field=True, refuse=()):
+        self.api_base = f"http://report-{next(_hosts)}/api/v2/"
+        self.name, self.batched, self.emp_field, self.refuse = name, batched, emp_field, set(refuse)
+        self.calls = []
+
+    def request(self, method, path, params=None):
+        params = dict(params or {})
+        assert path == app._PATH_TIME_REPORT_DATA
+        self.calls.append(params)
+        if params["name"] != self.name:
+            raise _http_error(422)
+        if "empNumber" in params:
+            emp = str(params["empNumber"])
+            if emp in self.refuse:
+                raise _http_error(403)
+            rows = REPORT.get(emp, [])
+        elif self.batched:
+            rows = [dict(r, empNumber=int(emp)) if self.emp_field else dict(r)
+                    for emp, emp_rows in REPORT.items() for r in emp_rows]
+        else:
+            raise _http_error(422)
+        offset, limit = params.get("offset", 0), params["limit"]
+        return {"data": rows[offset:offset + limit], "meta": {"total": len(rows)}}
+
+    def report_calls(self):
+        return [c for c in self.calls if c["limit"] != 1]
+
+
+def _totals(rows):
+    return {(r["empNumber"], r["projectName"]): r["totalHours"] for r in rows}
+
+
+EXPECTED = {("1", "P1"): 2.5, ("2", "P1"): 1.0, ("2", "P2"): 4.0, ("3", "P2"): 8.0}
+
+
+def test_detects_report_name_and_batch_support():
+    client = FakeReportClient(name="employee", batched=True)
+    assert app._orangehrm_report_name(client, ["1"]) == "employee"
+    support = app._report_support_for(client.api_base)
+    assert support.batched
+    assert [c["name"] for c in client.calls] == ["employee_time", "employee", "employee"]
+    assert "empNumber" not in client.calls[-1]
+
+
+def test_batched_report_is_one_query_split_by_employee():
+    client = FakeReportClient(batched=True)
+    rows = app._get_hours_by_employee_client_project(client, ["1", "2"], {})
+    assert _totals(rows) == {k: v for k, v in EXPECTED.items() if k[0] != "3"}
+    assert len(client.report_calls()) == 1
+    assert "empNumber" not in client.report_calls()[0]
+
+
+@pytest.mark.parametrize("batched, emp_field", [(False, True), (True, False)])
+def test_one_report_per_employee_without_batch_support(batched, emp_field):
+    client = FakeReportClient(batched=batched, emp_field=emp_field)
+    rows = app._get_hours_by_employee_client_project(client, ["1", "2", "3"], {})
+    assert _totals(rows) == EXPECTED
+    assert sorted(c["empNumber"] for c in client.report_calls()) == ["1", "2", "3"]
+
+
+def test_refused_report_falls_back_to_timesheets(monkeypatch):
+    client = FakeReportClient(refuse={"2"})
+    fallback = []
+
+    def _collect(client, emp_numbers, from_date=None, to_date=None):
+        fallback.append(list(emp_numbers))
+        return app._dataset_from_report(client, [(emp, REPORT[emp]) for emp in emp_numbers])
+
+    monkeypatch.setattr(app, "_collect_timesheet_dataset", _collect)
+    rows = app._get_hours_by_employee_client_project(client, ["1", "2", "3"], {})
+    assert fallback == [["1", "2", "3"]]
+    assert _totals(rows) == EXPECTED
+
+
+def test_unsupported_instance_uses_timesheets():
+    client = FakeReportClient(name="something_else")
+    assert app._orangehrm_report_name(client, ["1"]) is None
+    assert not app._report_support_for(client.api_base).batched
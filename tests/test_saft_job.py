@@ -0,0 +1,33 @@
+"""Conversão SAF-T como tarefa (_saft_job) e nomes dos ficheiros gerados."""
+import functools
+import zipfile
+
+import pytest
+
+import streamlit_app as app
+
+
+@pytest.mark.parametrize("xml_name, base", [
+    ("faturas.xml", "faturas"),
+    ("2024/janeiro/faturas.xml", "faturas"),
+    ("..\\..\\faturas.v2.xml", "faturas.v2"),
+    ("../", "saft_export"),
+])
+def test_saft_base_name(xml_name, base):
+    assert app._saft_base_name(xml_name) == base
+
+
+@pytest.mark.parametrize("base_name", ["2024/faturas", "../../faturas"])
+def test_saft_job_from_subfolder_stays_in_workdir(tmp_path, saft_xml, base_name):
+    queue = app._JobQueue(str(tmp_path / "jobs"), 1, 3600, token="test")
+    job = queue.submit("saft", "u@x", "t", base_name, functools.partial(
+        app._saft_job, base_name=base_name, encoding="utf-8-sig", denormalised=False,
+    ), {"input.xml": saft_xml()})
+    queue.close()
+
+    assert job.status == "done", job.error
+    assert job.meta["output"]["name"] == "saft-CSVs.zip"
+    assert job.meta["output"]["file_name"] == "faturas-CSVs.zip"
+    assert sorted(p.name for p in tmp_path.rglob("*CSVs.zip")) == ["saft-CSVs.zip"]
+    with zipfile.ZipFile(job.path("saft-CSVs.zip")) as z:
+        assert all(name.startswith("faturas-") and "/" not in name for name in z.namelist())
@@ -0,0 +1,90 @@
+"""Leitura em streaming do SAF-T (parse_saft_xml_bytes): DataFrames e CSV gerados."""
+import csv
+import io
+import zipfile
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+import streamlit_app as app
+
+
+def _parse(xml):
+    result = app.parse_saft_xml_bytes(xml, base_name="t", encoding="utf-8")
+    result["zip_file"].close()
+    return result
+
+
+def test_invoice_lines_converted_in_chunks_match_single_frame(saft_xml, monkeypatch):
+    whole = _parse(saft_xml())["invoice_lines"]
+    monkeypatch.setattr(app, "_SAFT_FRAME_CHUNK_ROWS", 1)
+    chunked = _parse(saft_xml())["invoice_lines"]
+
+    pd.testing.assert_frame_equal(chunked, whole)
+    assert len(whole) == 3
+    assert whole["Amount"].tolist() == [20.0, 5.5, 3.75]
+    assert str(whole["ProductCode"].dtype) == "category"
+    assert list(whole["ProductCode"].cat.categories) == ["P1", "P2"]
+
+
+def test_customers_csv_includes_first_customer(saft_xml):
+    result = app.parse_saft_xml_bytes(saft_xml(), base_name="t", encoding="utf-8")
+    with zipfile.ZipFile(result["zip_file"]) as z:
+        rows = list(csv.reader(io.TextIOWrapper(z.open("t-Customers.csv"), encoding="utf-8")))
+    result["zip_file"].close()
+
+    assert rows == [
+        ["CustomerID", "CustomerTaxID", "CompanyName", "Country"],
+        ["C1", "500000001", "Cliente 1", "PT"],
+        ["C2", "500000002", "Cliente 2", "PT"],
+    ]
+    assert result["customers"]["CustomerID"].tolist() == ["C1", "C2"]
+
+
+def _checks(result):
+    return result["reconciliation"]["checks"].set_index("Controlo")
+
+
+def test_reconciliation_ok_when_totals_match(saft_xml):
+    result = _parse(saft_xml())
+    recon = result["reconciliation"]
+    checks = _checks(result)
+
+    assert recon["ok"] is True
+    assert recon["mismatched_invoices"].empty
+    assert checks.loc["NumberOfEntries", ["Declarado", "Calculado"]].tolist() == [2.0, 2.0]
+    assert checks.loc["TotalCredit", "Calculado"] == pytest.approx(29.25)
+    assert checks.loc["TotalCredit", "OK"] == True  # noqa: E712 (coluna object)
+    assert checks.loc["TaxPayable (soma das linhas)", "Calculado"] == pytest.approx(6.73)
+
+
+def test_reconciliation_flags_declared_total_difference(saft_xml):
+    result = _parse(saft_xml(declared_credit_delta=1.0))
+    checks = _checks(result)
+
+    assert result["reconciliation"]["ok"] is False
+    assert checks.loc["TotalCredit", "Diferenca"] == pytest.approx(-1.0)
+    assert checks.loc["TotalCredit", "OK"] == False  # noqa: E712
+    assert result["reconciliation"]["mismatched_invoices"].empty
+
+
+def test_reconciliation_lists_invoice_whose_lines_do_not_match_totals(saft_xml):
+    result = _parse(saft_xml(extra_gross=0.5))
+    mismatched = result["reconciliation"]["mismatched_invoices"]
+
+    assert result["reconciliation"]["ok"] is False
+    assert mismatched["InvoiceNo"].tolist() == ["FT A/2"]
+    row = mismatched.iloc[0]
+    assert (row["Linhas"], row["GrossLinhas"]) == (1, pytest.approx(4.61))
+    assert row["GrossTotal"] == pytest.approx(5.11)
+
+
+def test_reconciliation_json_round_trip(saft_xml, tmp_path):
+    recon = _parse(saft_xml(extra_gross=0.5))["reconciliation"]
+    path = str(tmp_path / "reconciliation.json")
+    app._write_saft_reconciliation(recon, path)
+    loaded = app._read_saft_reconciliation(path)
+
+    assert loaded["ok"] is False
+    pd.testing.assert_frame_equal(loaded["mismatched_invoices"], recon["mismatched_invoices"], check_dtype=False)
+    assert loaded["checks"]["Calculado"].tolist() == recon["checks"]["Calculado"].tolist()
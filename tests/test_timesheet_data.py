@@ -0,0 +1,100 @@
+"""Store local de folhas de horas (cobertura por semana) e cubo de horas em memória."""
+import time
+from datetime import date, timedelta
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+import streamlit_app as app
+
+
+def _monday(weeks_ago):
+    today = date.today()
+    return (today - timedelta(days=today.weekday(), weeks=weeks_ago)).isoformat()
+
+
+def _sunday(monday):
+    return (date.fromisoformat(monday) + timedelta(days=6)).isoformat()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return app._TimesheetStore(str(tmp_path / "ts.sqlite3"))
+
+
+def test_week_helpers():
+    assert app._week_starts("2024-01-03", "2024-01-15") == ["2024-01-01", "2024-01-08", "2024-01-15"]
+    assert app._week_runs(["2024-01-01", "2024-01-08", "2024-01-22"]) == [
+        ("2024-01-01", "2024-01-14"), ("2024-01-22", "2024-01-28"),
+    ]
+
+
+def test_covered_closed_weeks_are_served_from_store(store):
+    w3, w2, w1, this_week = _monday(3), _monday(2), _monday(1), _monday(0)
+    store.mark_covered("7", [(w3, _sunday(w1))])
+
+    missing, cached = store.missing_weeks("7", w3, _sunday(this_week), ttl=3600)
+    assert (missing, cached) == ([this_week], 3)  # a semana atual é sempre listada de novo
+    assert store.missing_weeks("8", w3, _sunday(w1), ttl=3600) == ([w3, w2, w1], 0)
+
+
+def test_weeks_with_open_timesheets_or_expired_coverage_are_listed_again(store):
+    w2, w1 = _monday(2), _monday(1)
+    store.mark_covered("7", [(w2, _sunday(w1))])
+    store.upsert([
+        ("7", {"id": 1, "startDate": w2, "endDate": _sunday(w2), "status": {"id": "APPROVED"}}, [], "a"),
+        ("7", {"id": 2, "startDate": w1, "endDate": _sunday(w1), "status": {"id": "NOT SUBMITTED"}}, [], "b"),
+    ])
+
+    assert store.missing_weeks("7", w2, _sunday(w1), ttl=3600) == ([w1], 1)
+    assert store.missing_weeks("7", w2, _sunday(w1), ttl=0) == ([w2, w1], 0)
+    time.sleep(0.02)
+    assert store.missing_weeks("7", w2, _sunday(w1), ttl=0.01) == ([w2, w1], 0)
+
+
+def test_delete_range_forgets_timesheets_and_coverage(store):
+    w1 = _monday(1)
+    store.mark_covered("7", [(w1, _sunday(w1))])
+    store.upsert([("7", {"id": 1, "startDate": w1, "endDate": _sunday(w1), "status": "APPROVED"},
+                   [{"id": 10}], "a")])
+    assert [ts["id"] for _emp, ts, _e in store.load(["7"], w1, _sunday(w1))] == [1]
+
+    store.delete_range(["7"], w1, _sunday(w1))
+    assert store.load(["7"], w1, _sunday(w1)) == []
+    assert store.missing_weeks("7", w1, _sunday(w1), ttl=3600) == ([w1], 0)
+
+
+def _cube():
+    fetched = [
+        ("1", {"id": 1, "startDate": "2024-01-01", "endDate": "2024-01-07", "status": "APPROVED"}, [
+            {"project": {"id": 5, "name": "Portal", "customer": {"name": "ACME"}},
+             "dates": {"2024-01-01": {"duration": "08:00"}, "2024-01-02": {"duration": "04:30"}}},
+            # total sem detalhe diário: conta na semana da folha, sem dia
+            {"project": {"id": 6, "name": "Suporte", "customer": {"name": "Beta"}},
+             "total": {"hours": 2, "minutes": 0}},
+        ]),
+        ("2", {"id": 2, "startDate": "2024-01-08", "endDate": "2024-01-14", "status": "APPROVED"}, [
+            {"project": {"id": 5, "name": "Portal", "customer": {"name": "ACME"}},
+             "dates": {"2024-01-08": {"duration": "07:15"}}},
+        ]),
+    ]
+    _ts, entries, days = app._normalise_timesheets(fetched)
+    return app._HoursCube({"entries": entries, "entry_days": days})
+
+
+def test_hours_cube_pivots_and_filters():
+    cube = _cube()
+    assert len(cube) == 4
+    assert cube.members("week") == ["2024-01-01", "2024-01-08"]
+    assert cube.members("client") == ["ACME", "Beta"]
+
+    by_emp = cube.pivot("emp", emp_names={"1": "Ana", "2": "Rui"})
+    assert by_emp["Total de Horas"].to_dict() == {"Ana": 14.5, "Rui": 7.25}
+
+    by_client_week = cube.pivot("client", "week")
+    assert by_client_week.loc["ACME"].tolist() == [12.5, 7.25]
+    assert by_client_week.loc["Beta"].tolist() == [2.0, 0.0]  # sem dias, mas com a semana da folha
+
+    only_acme = cube.pivot("day", filters={"client": ["ACME"], "emp": ["1"]})
+    assert only_acme["Total de Horas"].to_dict() == {"2024-01-01": 8.0, "2024-01-02": 4.5}
+    assert cube.pivot("day", filters={"client": ["Beta"]}).empty
@@ -0,0 +1,20 @@
+"""Exportação Excel em streaming (_xlsx_file) entregue ao st.download_button."""
+import io
+
+import pytest
+
+openpyxl = pytest.importorskip("openpyxl")
+import streamlit_app as app
+
+
+def test_xlsx_file_is_read_once_by_streamlit_and_closed():
+    from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+    sheets = [("Resumo", [["Colaborador", "Horas"], ["Ana", 7.5]]), ("Resumo", [["x"]])]
+    f = app._xlsx_file(sheets)
+    data, _mime = convert_data_to_bytes_and_infer_mime(f, unsupported_error=AssertionError())
+
+    assert f.closed
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+    assert wb.sheetnames == ["Resumo", "Resumo_2"]
+    assert list(wb["Resumo"].values) == [("Colaborador", "Horas"), ("Ana", 7.5)]
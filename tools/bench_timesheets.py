@@ -0,0 +1,118 @@
+"""
+Benchmark ponta a ponta das folhas de horas contra o simulador local (tools/orangehrm_sim.py).
+
+Arranca o simulador com um conjunto de dados sintético, importa streamlit_app (sem desenhar
+a UI) e corre _get_totals_by_employee_and_timesheet e _get_hours_by_employee_client_project,
+reportando tempo, pedidos por endpoint e pedidos/segundo. Exemplo:
+
+    python tools/bench_timesheets.py --employees 100 --weeks 26 --latency 0.05 --p429 0.02
+    python tools/bench_timesheets.py --employees 100 --store --repeat 2 --json resultado.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from orangehrm_sim import OrangeHRMSimulator, SimData  # noqa: E402
+
+
+def _measure(sim: OrangeHRMSimulator, name: str, fn: Callable[[], Any]) -> Dict[str, Any]:
+    sim.reset_counts()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    requests_total = sim.total_requests()
+    return {
+        "phase": name,
+        "seconds": round(elapsed, 3),
+        "requests": requests_total,
+        "requests_per_sec": round(requests_total / elapsed, 1) if elapsed else 0.0,
+        "rows": len(result) if hasattr(result, "__len__") else None,
+        "by_endpoint": dict(sorted(sim.counts.items())),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark das folhas de horas OrangeHRM contra o simulador local")
+    parser.add_argument("--employees", type=int, default=50)
+    parser.add_argument("--weeks", type=int, default=12)
+    parser.add_argument("--projects", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.02, help="segundos por pedido no simulador")
+    parser.add_argument("--p429", type=float, default=0.0)
+    parser.add_argument("--p5xx", type=float, default=0.0)
+    parser.add_argument("--max-in-flight", type=int, default=0)
+    parser.add_argument("--no-reports", action="store_true",
+                        help="simulador sem time/reports/data: totais por cliente/projeto via folhas e entradas")
+    parser.add_argument("--report-batch", action="store_true",
+                        help="simulador com relatório de vários colaboradores num só pedido (sem empNumber)")
+    parser.add_argument("--concurrency", type=int, default=None, help="ORANGEHRM_FETCH_CONCURRENCY")
+    parser.add_argument("--rate-limit", type=float, default=None, help="ORANGEHRM_RATE_LIMIT_RPS (0 desliga)")
+    parser.add_argument("--from-date", default="2024-01-01")
+    parser.add_argument("--to-date", default="2024-12-31")
+    parser.add_argument("--store", action="store_true", help="mede também a recolha incremental com o store SQLite")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", default="", help="grava os resultados neste ficheiro")
+    args = parser.parse_args()
+
+    # Caches do processo num diretório temporário; nada de ficheiros partilhados de produção
+    os.environ["ORANGEHRM_CACHE_DIR"] = tempfile.mkdtemp(prefix="orangehrm-bench-")
+    os.environ.pop("ORANGEHRM_REFRESH_TOKEN_FILE", None)
+    if args.concurrency:
+        os.environ["ORANGEHRM_FETCH_CONCURRENCY"] = str(args.concurrency)
+    if args.rate_limit is not None:
+        os.environ["ORANGEHRM_RATE_LIMIT_RPS"] = str(args.rate_limit)
+
+    sim = OrangeHRMSimulator(
+        SimData(args.employees, args.weeks, args.projects), latency=args.latency,
+        p429=args.p429, p5xx=args.p5xx, max_in_flight=args.max_in_flight, reports=not args.no_reports,
+        report_batch=args.report_batch,
+    ).start()
+
+    import streamlit_app as app
+
+    client = app._OrangeHRMClient("bench", "rt0", sim.url + "oauth2/token", sim.url + "api/v2/")
+    results: List[Dict[str, Any]] = []
+    employees: List[Dict[str, Any]] = []
+
+    def _employees():
+        employees[:] = app._list_all_employees(client)
+        return employees
+
+    results.append(_measure(sim, "employees", _employees))
+    emp_map = app._build_empnumber_to_name_map(employees)
+    emp_numbers = list(emp_map)
+    span = dict(from_date=args.from_date, to_date=args.to_date)
+
+    for run in range(1, args.repeat + 1):
+        suffix = f" #{run}" if args.repeat > 1 else ""
+        results.append(_measure(sim, "totals_by_timesheet" + suffix, lambda: app._get_totals_by_employee_and_timesheet(
+            client, emp_numbers, emp_map, **span)))
+        results.append(_measure(sim, "hours_by_client_project" + suffix, lambda: app._get_hours_by_employee_client_project(
+            client, emp_numbers, emp_map, **span)))
+        if args.store:
+            store = app._timesheet_store()
+            results.append(_measure(sim, "dataset_with_store" + suffix, lambda: app._collect_timesheet_dataset(
+                client, emp_numbers, store=store, **span)["entries"]))
+    sim.stop()
+
+    print(f"Simulador: {args.employees} colaboradores × {args.weeks} semanas, latência {args.latency * 1000:.0f} ms, "
+          f"429 {args.p429:.0%}, 5xx {args.p5xx:.0%}; ligações TCP abertas: {sim.connections}")
+    print(f"{'fase':<28}{'tempo (s)':>10}{'pedidos':>10}{'pedidos/s':>11}{'linhas':>9}")
+    for r in results:
+        print(f"{r['phase']:<28}{r['seconds']:>10.2f}{r['requests']:>10}{r['requests_per_sec']:>11.1f}{str(r['rows']):>9}")
+    for r in results:
+        print(f"  {r['phase']}: {r['by_endpoint']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "connections": sim.connections, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
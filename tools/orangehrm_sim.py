@@ -0,0 +1,309 @@
+"""
+Simulador local da API OrangeHRM (só stdlib) para medir o desempenho das folhas de horas
+sem tocar no RH de produção.
+
+Serve os endpoints usados pela aplicação:
+  POST oauth2/token                                  (refresh token rotativo)
+  GET  api/v2/pim/employees                          (limit/offset, meta.total, filtro email, sortField)
+  GET  api/v2/pim/employees/{n}/contact-details
+  GET  api/v2/admin/users                            (limit/offset, filtro userName)
+  GET  api/v2/time/projects  e  time/projects/{id}
+  GET  api/v2/time/employees/{n}/timesheets          (fromDate/toDate, limit/offset)
+  GET  api/v2/time/employees/timesheets/{id}/entries
+  GET  api/v2/time/reports/data?name=employee        (horas por projeto/atividade; --no-reports desliga;
+                                                    sem empNumber só com --report-batch)
+
+Os dados são sintéticos e determinísticos (semente). Latência, 429 (com Retry-After) e 5xx
+podem ser injetados. Uso autónomo:
+
+    python tools/orangehrm_sim.py --employees 200 --weeks 26 --latency 0.05 --port 8099
+
+e apontar ORANGEHRM_DOMAIN para http://127.0.0.1:8099/web/index.php/ (refresh token "rt0").
+"""
+import argparse
+import datetime as dt
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+class SimData:
+    """Colaboradores, utilizadores, projetos, folhas de horas semanais e entradas sintéticas."""
+
+    def __init__(self, employees: int = 20, weeks: int = 12, projects: int = 10,
+                 start: str = "2024-01-01", unnamed_ratio: float = 0.3, seed: int = 1):
+        rnd = random.Random(seed)
+        self.employees = [{
+            "empNumber": i, "employeeId": f"{i:04d}", "firstName": f"Colaborador{i}", "middleName": "",
+            "lastName": "Teste", "workEmail": f"colab{i}@inobest.com" if i % 5 else None,
+        } for i in range(1, employees + 1)]
+        self.contacts = {e["empNumber"]: {"workEmail": f"colab{e['empNumber']}@inobest.com"} for e in self.employees}
+        self.users = [{"id": i, "userName": f"colab{i}", "employee": {"empNumber": i}} for i in range(1, employees + 1)]
+        self.projects = {p: {
+            "id": p, "name": f"Projeto {p}", "customer": {"id": p % 4 + 1, "name": f"Cliente {p % 4 + 1}"},
+        } for p in range(1, projects + 1)}
+        self.timesheets: Dict[int, Dict[str, Any]] = {}
+        self.entries: Dict[int, List[Dict[str, Any]]] = {}
+        first_day = dt.date.fromisoformat(start)
+        sid = 0
+        for e in self.employees:
+            for w in range(weeks):
+                sid += 1
+                begin = first_day + dt.timedelta(weeks=w)
+                status = "APPROVED" if w < weeks - 2 else ("SUBMITTED" if w == weeks - 2 else "NOT SUBMITTED")
+                self.timesheets[sid] = {
+                    "id": sid, "empNumber": e["empNumber"], "startDate": begin.isoformat(),
+                    "endDate": (begin + dt.timedelta(days=6)).isoformat(),
+                    "status": {"id": status, "name": status.title()},
+                }
+                self.entries[sid] = [self._entry(rnd, sid * 10 + k, begin, projects, unnamed_ratio)
+                                     for k in range(rnd.randint(1, 3))]
+
+    def _entry(self, rnd: random.Random, entry_id: int, begin: dt.date, projects: int, unnamed_ratio: float):
+        pid = rnd.randint(1, projects)
+        dates, minutes = {}, 0
+        for d in range(5):
+            day = (begin + dt.timedelta(days=d)).isoformat()
+            h, m = rnd.randint(0, 4), rnd.choice([0, 30])
+            dates[day] = {"date": day, "duration": f"{h:02d}:{m:02d}"}
+            minutes += h * 60 + m
+        if rnd.random() < unnamed_ratio:
+            # Algumas instâncias só devolvem o id do projeto: obriga a resolver nomes
+            return {"id": entry_id, "projectId": pid, "dates": dates, "total": {}}
+        project = self.projects[pid]
+        return {
+            "id": entry_id, "project": {"id": pid, "name": project["name"]}, "customer": dict(project["customer"]),
+            "activity": {"id": 1, "name": "Desenvolvimento"}, "dates": dates,
+            "total": {"hours": minutes // 60, "minutes": minutes % 60, "label": f"{minutes / 60:.2f}"},
+        }
+
+
+class OrangeHRMSimulator:
+    """Servidor HTTP/1.1 (keep-alive) com contagem de pedidos por template de endpoint."""
+
+    def __init__(self, data: SimData, latency: float = 0.0, p429: float = 0.0, p5xx: float = 0.0,
+                 host: str = "127.0.0.1", port: int = 0, max_in_flight: int = 0, seed: int = 1,
+                 reports: bool = True, report_batch: bool = False):
+        self.data = data
+        self.reports = reports
+        self.report_batch = report_batch
+        self.latency, self.p429, self.p5xx = latency, p429, p5xx
+        self.max_in_flight = max_in_flight
+        self.refresh_token = "rt0"
+        self.counts: Dict[str, int] = {}
+        self.connections = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/web/index.php/"
+
+    def total_requests(self) -> int:
+        with self._lock:
+            return sum(self.counts.values())
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts.clear()
+
+    def start(self) -> "OrangeHRMSimulator":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="orangehrm-sim", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, template: str):
+        with self._lock:
+            self.counts[template] = self.counts.get(template, 0) + 1
+
+    def _chance(self, p: float) -> bool:
+        if p <= 0:
+            return False
+        with self._lock:
+            return self._rnd.random() < p
+
+    def _handler(self):
+        sim = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with sim._lock:
+                    sim.connections += 1
+
+            def _send(self, code: int, body: Any, headers: Optional[Dict[str, str]] = None):
+                raw = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                form = parse_qs(self.rfile.read(length).decode())
+                sim._count("oauth2/token")
+                if sim.latency:
+                    time.sleep(sim.latency)
+                with sim._lock:
+                    if form.get("refresh_token", [""])[0] != sim.refresh_token:
+                        return self._send(400, {"error": "invalid_grant"})
+                    sim.refresh_token = "rt" + str(int(sim.refresh_token[2:]) + 1)
+                    rt = sim.refresh_token
+                self._send(200, {"access_token": "at-" + rt, "refresh_token": rt, "expires_in": 3600, "token_type": "Bearer"})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                path = url.path.split("/api/v2/", 1)[-1]
+                template = re.sub(r"/\d+", "/{n}", path)
+                sim._count(template)
+                with sim._lock:
+                    sim.in_flight += 1
+                    sim.peak_in_flight = max(sim.peak_in_flight, sim.in_flight)
+                    busy = sim.max_in_flight and sim.in_flight > sim.max_in_flight
+                try:
+                    if busy or sim._chance(sim.p429):
+                        return self._send(429, {"error": "Too Many Requests"}, {"Retry-After": "0"})
+                    if sim.latency:
+                        time.sleep(sim.latency)
+                    if sim._chance(sim.p5xx):
+                        return self._send(503, {"error": "Service Unavailable"})
+                    if not (self.headers.get("Authorization") or "").startswith("Bearer at-"):
+                        return self._send(401, {"error": "Unauthorized"})
+                    code, body = sim.route(path, query)
+                    self._send(code, body)
+                finally:
+                    with sim._lock:
+                        sim.in_flight -= 1
+
+        return Handler
+
+    def route(self, path: str, query: Dict[str, str]):
+        """(status, corpo JSON) de um GET autenticado."""
+        data = self.data
+        limit, offset = int(query.get("limit", 50)), int(query.get("offset", 0))
+
+        def page(rows: List[Dict[str, Any]]):
+            return 200, {"data": rows[offset:offset + limit] if limit else rows, "meta": {"total": len(rows)}}
+
+        if path == "pim/employees":
+            rows = data.employees
+            if "email" in query:
+                rows = [e for e in rows if e["workEmail"] == query["email"]]
+            if query.get("sortField") == "employee.empNumber":
+                rows = sorted(rows, key=lambda e: e["empNumber"], reverse=query.get("sortOrder") == "DESC")
+            return page(rows)
+        m = re.fullmatch(r"pim/employees/(\d+)/contact-details", path)
+        if m:
+            contact = data.contacts.get(int(m.group(1)))
+            return (200, {"data": contact}) if contact else (404, {"error": "Not Found"})
+        if path == "admin/users":
+            rows = data.users
+            if "userName" in query:
+                rows = [u for u in rows if u["userName"] == query["userName"]]
+            return page(rows)
+        if path == "time/projects":
+            return page(list(data.projects.values()))
+        m = re.fullmatch(r"time/projects/(\d+)", path)
+        if m:
+            project = data.projects.get(int(m.group(1)))
+            return (200, {"data": project}) if project else (404, {"error": "Not Found"})
+        m = re.fullmatch(r"time/employees/(\d+)/timesheets", path)
+        if m:
+            emp = int(m.group(1))
+            from_date, to_date = query.get("fromDate"), query.get("toDate")
+            rows = [
+                {k: v for k, v in ts.items() if k != "empNumber"}
+                for ts in data.timesheets.values()
+                if ts["empNumber"] == emp
+                and (not from_date or ts["endDate"] >= from_date)
+                and (not to_date or ts["startDate"] <= to_date)
+            ]
+            return page(rows)
+        m = re.fullmatch(r"time/employees/timesheets/(\d+)/entries", path)
+        if m:
+            return 200, {"data": data.entries.get(int(m.group(1)), []), "meta": {}}
+        if path == "time/reports/data" and self.reports:
+            if query.get("name") != "employee" or ("empNumber" not in query and not self.report_batch):
+                return 422, {"error": "Invalid Parameter"}
+            if "empNumber" in query:
+                return page(self.employee_report(int(query["empNumber"]), query.get("fromDate"), query.get("toDate")))
+            return page([dict(row, empNumber=emp) for emp in sorted({ts["empNumber"] for ts in data.timesheets.values()})
+                         for row in self.employee_report(emp, query.get("fromDate"), query.get("toDate"))])
+        return 404, {"error": "Not Found"}
+
+    def employee_report(self, emp: int, from_date: Optional[str], to_date: Optional[str]) -> List[Dict[str, Any]]:
+        """Horas por projeto × atividade de um colaborador, só dos dias dentro do período."""
+        data = self.data
+        totals: Dict[Any, float] = {}
+        for sid, ts in data.timesheets.items():
+            if ts["empNumber"] != emp:
+                continue
+            for e in data.entries.get(sid, []):
+                pid = e["project"]["id"] if "project" in e else e["projectId"]
+                for day, d in e["dates"].items():
+                    if (from_date and day < from_date) or (to_date and day > to_date):
+                        continue
+                    h, m = map(int, d["duration"].split(":"))
+                    key = (pid, (e.get("activity") or {}).get("name", "Desenvolvimento"))
+                    totals[key] = totals.get(key, 0.0) + h + m / 60.0
+        return [{
+            "projectName": data.projects[pid]["name"], "customerName": data.projects[pid]["customer"]["name"],
+            "activityName": activity, "totalDuration": round(hours, 2),
+        } for (pid, activity), hours in sorted(totals.items())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulador local da API OrangeHRM")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--employees", type=int, default=20)
+    parser.add_argument("--weeks", type=int, default=12)
+    parser.add_argument("--projects", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="segundos por pedido")
+    parser.add_argument("--p429", type=float, default=0.0, help="probabilidade de 429")
+    parser.add_argument("--p5xx", type=float, default=0.0, help="probabilidade de 503")
+    parser.add_argument("--max-in-flight", type=int, default=0, help="429 acima deste nº de pedidos em simultâneo")
+    parser.add_argument("--no-reports", action="store_true", help="sem time/reports/data (como instâncias antigas)")
+    parser.add_argument("--report-batch", action="store_true",
+                        help="time/reports/data sem empNumber devolve todos os colaboradores (com empNumber por linha)")
+    args = parser.parse_args()
+    sim = OrangeHRMSimulator(
+        SimData(args.employees, args.weeks, args.projects), latency=args.latency, p429=args.p429,
+        p5xx=args.p5xx, host=args.host, port=args.port, max_in_flight=args.max_in_flight,
+        reports=not args.no_reports, report_batch=args.report_batch,
+    ).start()
+    print(f"Simulador OrangeHRM em {sim.url} (refresh token inicial: rt0). Ctrl+C para terminar.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    main()